@@ -9,8 +9,7 @@ from setuptools import setup
 from src._version import __version__
 
 install_requires = [
-    'pycrypto >=2.6',        # TODO do we need this version
-    'msgpack-python >=0.2',  #      ibidem
+    'msgpack-python >=0.2',  # TODO do we need this version
     'gmpy >=1.15, <2',       #      ibidem
     'yappi >=0.62',          #      ibidem
     'lockfile >=0.8',        #      ibidem
@@ -20,6 +19,8 @@ install_requires = [
     'seccure >=0.2.3',
     'demandimport >=0.2.1',
     'argon2-cffi >=16.1.0',
+    'pyblake2 >=0.9.3',
+    'pycryptodome >=3.7',    # for ChaCha20-Poly1305
     'urwid >=1.3.0',
     'fuzzywuzzy >=0.10.0',
         ]
@@ -55,6 +56,7 @@ setup(
     extras_require = {
         'psafe3-importer': ['twofish'],
         'scrypt': ['scrypt >=0.5.5, !=0.6.0, !=0.6.1'],
+        'x25519': ['pycryptodome >=3.21'],
     },
     entry_points = {
         'console_scripts': [
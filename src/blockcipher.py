@@ -5,6 +5,7 @@ import logging
 import pol.serialization
 
 import Crypto.Cipher.AES
+import Crypto.Cipher.ChaCha20
 import Crypto.Util.Counter
 
 l = logging.getLogger(__name__)
@@ -28,11 +29,17 @@ class BlockCipher(object):
         self.params = params
 
     @staticmethod
-    def setup(params=None):
-        """ Set-up the blockcipher given by `params`. """
+    def setup(params=None, typ='aes'):
+        """ Set-up the blockcipher given by `params`.
+
+            If `params' is None, uses the default parameters of type
+            `typ'. """
         if params is None:
-            params = {'type': 'aes',
-                      'bits': 256 }
+            if typ == 'aes':
+                params = {'type': 'aes',
+                          'bits': 256 }
+            else:
+                params = {'type': typ}
         if ('type' not in params or not isinstance(params['type'], basestring)
                 or params['type'] not in TYPE_MAP):
             raise BlockCipherParameterError("Invalid `type' attribute")
@@ -46,11 +53,16 @@ class BlockCipher(object):
     def keysize(self):
         """ size of key in bytes """
         raise NotImplementedError
+    @property
+    def alignment(self):
+        """ `new_stream' accepts offsets that are a multiple of this """
+        return self.blocksize
 
     def new_stream(self, key, iv, offset=0):
         raise NotImplementedError
 
-class _AESStream(BaseStream):
+class _CipherStream(BaseStream):
+    """ Wraps a PyCryptodome cipher object """
     def __init__(self, cipher):
         self.cipher = cipher
     def encrypt(self, s):
@@ -79,7 +91,7 @@ class AESBlockCipher(BlockCipher):
                                 + offset/16)
         cipher = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_CTR,
                                             counter=ctr)
-        return _AESStream(cipher)
+        return _CipherStream(cipher)
 
     @property
     def blocksize(self):
@@ -88,5 +100,33 @@ class AESBlockCipher(BlockCipher):
     def keysize(self):
         return self.bits / 8
 
+class ChaCha20BlockCipher(BlockCipher):
+    """ ChaCha20 (RFC 7539) is fast without AES instructions.
+
+        It is a stream cipher: a stream at any offset is set up by
+        seeking, without a counter object.  Thus it needs no alignment.
+        The IV is the 96 bit nonce, which is why `blocksize' is 12. """
+
+    def new_stream(self, key, iv, offset=0):
+        if len(key) != 32:
+            raise ValueError("`key' should be 32 bytes long")
+        if len(iv) != 12:
+            raise ValueError("`iv' should be 12 bytes long")
+        cipher = Crypto.Cipher.ChaCha20.new(key=key, nonce=iv)
+        if offset:
+            cipher.seek(offset)
+        return _CipherStream(cipher)
+
+    @property
+    def blocksize(self):
+        return 12
+    @property
+    def keysize(self):
+        return 32
+    @property
+    def alignment(self):
+        return 1
+
 
-TYPE_MAP = {'aes': AESBlockCipher}
+TYPE_MAP = {'aes': AESBlockCipher,
+            'chacha20': ChaCha20BlockCipher}
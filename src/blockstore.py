@@ -0,0 +1,182 @@
+""" Fixed-width storage for the blocks of a safe. """
+
+import sys
+import mmap
+import struct
+
+import pol.serialization
+
+class BlockStore(object):
+    """ Stores the blocks of an `ElGamalSafe'.
+
+        A block is a list of four strings: c1, c2, the public key and the
+        marker.  Instead of a Python list of lists of strings, we keep
+        them in fixed-width slots in a single buffer.  This buffer is laid
+        out as the blocks in a safe file of version 2 (see FORMAT.md):
+
+         1. the markers: for every block the length of its marker as
+            a big-endian 16 bit integer followed by the marker slot;
+         2. the records: for every block the lengths of c1, c2 and the
+            public key followed by their slots.
+
+        Thus the markers, which are all we need to find the blocks of
+        a key, are contiguous.  The buffer is either a `bytearray' or
+        a (copy-on-write) `mmap' of a safe file, in which case the blocks
+        are only read from disk when they are used.  See `shared_copy'
+        for the third option.  The numbers c1 and c2 are decoded on first
+        use and cached until the block changes.
+
+        Indexing and iterating a BlockStore gives blocks as lists, like
+        the `blocks' attribute of a safe of version 1. """
+
+    _length_struct = struct.Struct('>H')
+
+    def __init__(self, n, widths, buf=None, offset=0):
+        self.n = n
+        self.widths = tuple(widths)
+        self.marker_slot_size = 2 + self.widths[3]
+        self.record_size = 6 + sum(self.widths[:3])
+        self._records_offset = offset + n * self.marker_slot_size
+        # offsets of the slots of c1, c2 and the public key in a record
+        self._column_offsets = (6, 6 + self.widths[0],
+                                6 + self.widths[0] + self.widths[1])
+        if buf is None:
+            buf = bytearray(BlockStore.nbytes(n, widths))
+        self._buf = buf
+        self._offset = offset
+        self._shared = False
+        # maps an index to the decoded c1 and c2 of its block
+        self._numbers = {}
+
+    @staticmethod
+    def nbytes(n, widths):
+        """ Returns the size of the buffer of `n' blocks with slots
+            of `widths'. """
+        return n * (2 + widths[3] + 6 + sum(widths[:3]))
+
+    @staticmethod
+    def from_list(blocks, widths):
+        """ Creates a BlockStore with the blocks from the list `blocks'. """
+        ret = BlockStore(len(blocks), widths)
+        for index, block in enumerate(blocks):
+            ret[index] = block
+        return ret
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.n))]
+        return [self.get(index, column) for column in xrange(4)]
+
+    def __setitem__(self, index, block):
+        if len(block) != 4:
+            raise ValueError("A block has four entries")
+        self.write(index, block)
+
+    def __iter__(self):
+        for index in xrange(self.n):
+            yield self[index]
+
+    def __eq__(self, other):
+        if isinstance(other, BlockStore):
+            other = other.to_list()
+        return self.to_list() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def to_list(self):
+        """ Returns the blocks as a list of lists. """
+        return list(self)
+
+    def _slot(self, index, column):
+        """ Returns the offset of the length and of the slot of entry
+            `column' of block `index'. """
+        if not 0 <= index < self.n:
+            raise IndexError(index)
+        if column == 3:
+            offset = self._offset + index * self.marker_slot_size
+            return offset, offset + 2
+        offset = self._records_offset + index * self.record_size
+        return offset + 2 * column, offset + self._column_offsets[column]
+
+    def get(self, index, column):
+        """ Returns entry `column' of block `index'. """
+        length_offset, offset = self._slot(index, column)
+        length = self._length_struct.unpack_from(self._buf, length_offset)[0]
+        if length > self.widths[column]:
+            raise ValueError("Length of entry exceeds its slot")
+        return str(self._buf[offset:offset+length])
+
+    def set(self, index, column, s):
+        """ Sets entry `column' of block `index' to the string `s'. """
+        width = self.widths[column]
+        if len(s) > width:
+            raise ValueError("`s' does not fit in a slot")
+        length_offset, offset = self._slot(index, column)
+        # We clear the rest of the slot: it should not leak the old entry.
+        self._buf[offset:offset+width] = s + '\0' * (width - len(s))
+        self._length_struct.pack_into(self._buf, length_offset, len(s))
+        if column < 2:
+            self._numbers.pop(index, None)
+
+    def write(self, index, block):
+        """ Sets the entries of block `index' to those in `block' that
+            are not None. """
+        for column, s in enumerate(block):
+            if s is not None:
+                self.set(index, column, s)
+
+    def shared_copy(self):
+        """ Returns a copy of the blocks in anonymous shared memory.
+            Worker processes forked afterwards can change the blocks of
+            the copy in place: the changes are visible to every process. """
+        size = BlockStore.nbytes(self.n, self.widths)
+        buf = mmap.mmap(-1, max(size, 1))
+        buf.write(buffer(self._buf, self._offset, size))
+        ret = BlockStore(self.n, self.widths, buf)
+        ret._shared = True
+        return ret
+
+    def copy_record(self, index, other):
+        """ Sets c1, c2 and the public key of block `index' to those in
+            the BlockStore `other', which has slots of the same widths. """
+        if other.widths != self.widths:
+            raise ValueError("`other' has slots of other widths")
+        offset = self._slot(index, 0)[0]
+        self._buf[offset:offset+self.record_size] = other.record(index)
+        self._numbers.pop(index, None)
+
+    def numbers(self, index):
+        """ Returns c1 and c2 of block `index' as numbers. """
+        ret = self._numbers.get(index)
+        if ret is None:
+            ret = (pol.serialization.string_to_number(self.get(index, 0)),
+                   pol.serialization.string_to_number(self.get(index, 1)))
+            self._numbers[index] = ret
+        return ret
+
+    def markers(self):
+        """ Returns the markers of all blocks, as they are laid out. """
+        return str(self._buf[self._offset:self._records_offset])
+
+    def record(self, index):
+        """ Returns c1, c2 and the public key of block `index', as they
+            are laid out. """
+        offset = self._slot(index, 0)[0]
+        return str(self._buf[offset:offset+self.record_size])
+
+    def __sizeof__(self):
+        # If the buffer is an mmap of a file, the blocks are not in our
+        # memory.
+        return (object.__sizeof__(self)
+                    + (sys.getsizeof(self._buf)
+                        if isinstance(self._buf, bytearray) else 0)
+                    + (len(self._buf) if self._shared else 0)
+                    + sys.getsizeof(self._numbers)
+                    + sum(sys.getsizeof(k) + sum(sys.getsizeof(x) for x in v)
+                            for k, v in self._numbers.iteritems()))
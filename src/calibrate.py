@@ -0,0 +1,112 @@
+""" Calibrates the parameters of a new safe to the current machine. """
+
+import time
+import logging
+import collections
+import multiprocessing
+
+import pol.ks
+import pol.safe
+import pol.elgamal
+
+import Crypto.Random
+
+l = logging.getLogger(__name__)
+
+# Default targets in seconds for `calibrate'
+DEFAULT_TARGET_UNLOCK = 0.5
+DEFAULT_TARGET_RERAND = 3.0
+
+# Bounds on the memory cost of argon2 in KiB
+MIN_ARGON2_MEMORY = 8 * 1024
+MAX_ARGON2_MEMORY = 1024 * 1024
+# The memory cost of argon2 in KiB with which we measure its speed
+SAMPLE_ARGON2_MEMORY = 16 * 1024
+ARGON2_PARALLELISM = 4
+
+# Bounds on the number of blocks.  The number of blocks is rounded down
+# to a multiple of BLOCKS_STEP.
+MIN_BLOCKS = 256
+MAX_BLOCKS = 65536
+BLOCKS_STEP = 64
+
+# Number of blocks of the safe on which we measure the speed of scanning,
+# decrypting and rerandomizing blocks
+SAMPLE_BLOCKS = 128
+
+calibration = collections.namedtuple('calibration',
+        ('t', 'm', 'p', 'n_blocks', 'stretch_time', 'unlock_time',
+         'rerand_time'))
+
+def _timed(func):
+    """ Returns the time `func' takes, the best of two runs. """
+    ret = None
+    for i in xrange(2):
+        start_time = time.time()
+        func()
+        duration = time.time() - start_time
+        ret = duration if ret is None else min(ret, duration)
+    return ret
+
+def calibrate(target_unlock=DEFAULT_TARGET_UNLOCK,
+              target_rerand=DEFAULT_TARGET_RERAND, typ='elgamal',
+              gp_bits=1025, n_blocks=None, nworkers=None, use_threads=False,
+              sample_blocks=SAMPLE_BLOCKS):
+    """ Picks the argon2 parameters and the number of blocks of a new safe
+        such that, on this machine, rerandomizing the safe takes about
+        `target_rerand' seconds and opening a container about
+        `target_unlock' seconds.  If `n_blocks' is set, only the argon2
+        parameters are picked.  Returns a `calibration' with the
+        predicted durations.
+
+        We measure the ElGamal operations on a small safe with precomputed
+        group parameters of (about) `gp_bits' bits, with the workers of
+        pol.parallel. """
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    randfunc = Crypto.Random.new().read
+    sample_bits = min(pol.elgamal.PRECOMPUTED_GROUP_PARAMS,
+                      key=lambda bits: abs(bits - gp_bits))
+    safe = pol.safe.Safe.generate(typ, precomputed_gp=True,
+                                  gp_bits=sample_bits,
+                                  n_blocks=sample_blocks, nworkers=nworkers,
+                                  use_threads=use_threads)
+    key = randfunc(safe.kd.size)
+    sl = safe._new_slice(sample_blocks // 2)
+    sl.store(key, randfunc(sl.size), annex=True)
+    safe.trash_freespace()
+    rerand_per_block = _timed(lambda: safe.rerandomize(nworkers=nworkers,
+                                    use_threads=use_threads)) / sample_blocks
+    scan_per_block = _timed(lambda: list(safe._find_slices(
+                                randfunc(safe.kd.size)))) / sample_blocks
+    load_per_block = _timed(lambda: safe._load_slice(key,
+                                sl.first_index)) / len(sl.indices)
+    ks = pol.ks.Argon2KeyStretching.setup(m=SAMPLE_ARGON2_MEMORY,
+                                          p=ARGON2_PARALLELISM)
+    stretch_per_kib = _timed(lambda: ks.stretch('')) / SAMPLE_ARGON2_MEMORY
+    l.debug('calibrate: per block %.2fms rerandomizing, %.2fms scanning, '+
+            '%.2fms decrypting; %.2fms per MiB stretching',
+                rerand_per_block * 1000, scan_per_block * 1000,
+                load_per_block * 1000, stretch_per_kib * 1024 * 1000)
+    # The number of blocks follows from the rerandomization target.
+    if n_blocks is None:
+        n_blocks = int(target_rerand / rerand_per_block)
+        n_blocks = min(max(n_blocks - n_blocks % BLOCKS_STEP, MIN_BLOCKS),
+                       MAX_BLOCKS)
+    # To open a container, we scan all blocks and decrypt its main slice,
+    # which takes about a sixth of the blocks (see `pol init').  We spend
+    # what is left of `target_unlock' on key stretching.
+    open_time = (n_blocks * scan_per_block
+                    + n_blocks // 6 * load_per_block)
+    budget = target_unlock - open_time
+    m = int(budget / stretch_per_kib)
+    t = 1
+    if m > MAX_ARGON2_MEMORY:
+        t = max(1, int(budget / (MAX_ARGON2_MEMORY * stretch_per_kib)))
+        m = MAX_ARGON2_MEMORY
+    m = max(m - m % 1024, MIN_ARGON2_MEMORY)
+    stretch_time = t * m * stretch_per_kib
+    return calibration(t=t, m=m, p=ARGON2_PARALLELISM, n_blocks=n_blocks,
+                       stretch_time=stretch_time,
+                       unlock_time=open_time + stretch_time,
+                       rerand_time=n_blocks * rerand_per_block)
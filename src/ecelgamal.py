@@ -0,0 +1,161 @@
+""" El-Gamal on an elliptic curve.
+
+    The scalar multiplications are done by pycryptodome.  The additions
+    of points, which are cheap, we do ourselves in affine coordinates:
+    for pycryptodome, the overhead of a call is larger than the addition.
+
+    A point is a pair (x, y) of numbers.  We never meet the point at
+    infinity, but with negligible probability.  If we do, we raise
+    a ValueError. """
+
+import collections
+
+# pycryptodome
+import Crypto.PublicKey.ECC
+
+# gmpy
+import gmpy
+
+import pol.serialization
+
+curve_parameters = collections.namedtuple('curve_parameters',
+            ('name', 'p', 'b', 'order', 'g', 'data_size', 'point_size'))
+
+def _curve_parameters(name, p, b, order, gx, gy):
+    p, b, order = gmpy.mpz(p), gmpy.mpz(b), gmpy.mpz(order)
+    return curve_parameters(name=name, p=p, b=b, order=order,
+                            g=(gmpy.mpz(gx), gmpy.mpz(gy)),
+                            data_size=(gmpy.numdigits(p, 2) - 9) // 8,
+                            point_size=len(pol.serialization.number_to_string(
+                                                2 * p - 1)))
+
+# The curves y^2 = x^3 - 3x + b we support.  Only secp256r1 (NIST P-256)
+# is available in every version of pycryptodome we support.
+CURVES = {'secp256r1': _curve_parameters('secp256r1',
+        0xffffffff00000001000000000000000000000000ffffffffffffffffffffffff,
+        0x5ac635d8aa3a93e7b3ebbd55769886bc651d06b0cc53b0f63bce3c3e27d2604b,
+        0xffffffff00000000ffffffffffffffffbce6faada7179e84f3b9cac2fc632551,
+        0x6b17d1f2e12c4247f8bce6e563a440f277037d812deb33a0f4a13945d898c296,
+        0x4fe342e2fe1a7f9b8ee7eb4a7c0f9e162bce33576b315ececbb6406837bf51f5)}
+
+def mul(curve, point, k):
+    """ Returns `k' times `point'. """
+    # Older versions of pycryptodome only know P-256 and do not accept
+    # the name of the curve.
+    assert curve.name == 'secp256r1'
+    ret = Crypto.PublicKey.ECC.EccPoint(long(point[0]),
+                                        long(point[1])) * long(k)
+    if ret.is_point_at_infinity():
+        raise ValueError("The product is the point at infinity")
+    return (gmpy.mpz(int(ret.x)), gmpy.mpz(int(ret.y)))
+
+def add(curve, P, Q):
+    """ Returns the sum of the points `P' and `Q'. """
+    p = curve.p
+    if P[0] == Q[0]:
+        if (P[1] + Q[1]) % p == 0:
+            raise ValueError("The sum is the point at infinity")
+        # As a = -3, the slope of the tangent is 3 (x^2 - 1) / 2y.
+        slope = 3 * (P[0] * P[0] - 1) * gmpy.invert(2 * P[1], p) % p
+    else:
+        slope = (Q[1] - P[1]) * gmpy.invert((Q[0] - P[0]) % p, p) % p
+    x = (slope * slope - P[0] - Q[0]) % p
+    return (x, (slope * (P[0] - x) - P[1]) % p)
+
+def neg(curve, P):
+    """ Returns the inverse of the point `P'. """
+    return (P[0], (curve.p - P[1]) % curve.p)
+
+def _y_for_x(curve, x):
+    """ Returns a y such that (x, y) is on the curve, or None. """
+    p = curve.p
+    rhs = (x * x * x - 3 * x + curve.b) % p
+    # As p = 3 mod 4, this is a square root of rhs, if there is one.
+    y = pow(rhs, (p + 1) // 4, p)
+    return y if y * y % p == rhs else None
+
+def point_to_string(curve, P):
+    """ Serializes the point `P' as the number x if y is even and x + p
+        otherwise, padded to `point_size' bytes. """
+    return pol.serialization.number_to_string(
+                P[0] + curve.p * (P[1] % 2)).ljust(curve.point_size, '\0')
+
+def string_to_point(curve, s):
+    """ Inverse of `point_to_string'.  Raises a ValueError if `s' does
+        not encode a point on the curve. """
+    if len(s) != curve.point_size:
+        raise ValueError("A point should be %s bytes" % curve.point_size)
+    n = pol.serialization.string_to_number(s)
+    x, parity = n % curve.p, n // curve.p
+    if parity > 1:
+        raise ValueError("Not a point")
+    y = _y_for_x(curve, x)
+    if y is None:
+        raise ValueError("Not a point on the curve")
+    return (x, y if y % 2 == parity else curve.p - y)
+
+def points_to_string(curve, points):
+    return ''.join(point_to_string(curve, P) for P in points)
+
+def string_to_points(curve, s):
+    """ Inverse of `points_to_string' """
+    size = curve.point_size
+    if len(s) % size:
+        raise ValueError("Not a list of points")
+    return [string_to_point(curve, s[i:i+size])
+                for i in xrange(0, len(s), size)]
+
+def string_to_curve(curve, s):
+    """ Encodes the string `s' of at most `data_size' bytes as a point.
+
+        Let n be the number represented by `s'.  We take the point with
+        the smallest x-coordinate of the form n + c 2^(8 data_size).  About
+        half of the x-coordinates are on the curve. """
+    step = 2 ** (8 * curve.data_size)
+    x = pol.serialization.string_to_number(s)
+    assert x < step
+    while True:
+        if x >= curve.p:
+            raise ValueError("Failed to encode the string as a point")
+        y = _y_for_x(curve, x)
+        if y is not None:
+            return (x, y)
+        x += step
+
+def curve_to_string(curve, P):
+    """ Inverse of `string_to_curve' """
+    return pol.serialization.number_to_string(
+                P[0] % 2 ** (8 * curve.data_size)).ljust(curve.data_size, '\0')
+
+def pubkey_from_privkey(curve, privkey):
+    return mul(curve, curve.g, privkey)
+
+def encrypt(curve, string, pubkeys, r):
+    """ Encrypts `string' with the random exponent `r' for the public
+        keys `pubkeys': a part of `data_size' bytes per public key.
+        Returns c1 and the list of points c2, which share c1. """
+    size = curve.data_size
+    c1 = mul(curve, curve.g, r)
+    c2 = [add(curve, string_to_curve(curve, string[size*i:size*(i+1)]),
+                     mul(curve, pubkey, r))
+            for i, pubkey in enumerate(pubkeys)]
+    return c1, c2
+
+def decrypt(curve, c1, c2, privkeys):
+    """ Decrypts the ciphertext (`c1', `c2') created by `encrypt' with
+        the private keys `privkeys'. """
+    return ''.join(curve_to_string(curve,
+                        add(curve, P, neg(curve, mul(curve, c1, privkey))))
+                    for P, privkey in zip(c2, privkeys))
+
+def rerandomization_factors(curve, pubkeys, s):
+    """ Returns what `rerandomize' adds to a ciphertext for the public
+        keys `pubkeys' with random exponent `s'. """
+    return (mul(curve, curve.g, s),
+            [mul(curve, pubkey, s) for pubkey in pubkeys])
+
+def rerandomize(curve, c1, c2, factors):
+    """ Rerandomizes the ciphertext (`c1', `c2') with the `factors'
+        returned by `rerandomization_factors'. """
+    return (add(curve, c1, factors[0]),
+            [add(curve, P, f) for P, f in zip(c2, factors[1])])
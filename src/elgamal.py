@@ -9,7 +9,7 @@ import itertools
 import collections
 import multiprocessing
 
-# pycrypto
+# pycryptodome
 import demandimport
 import Crypto.Util.number as number
 
@@ -93,21 +93,66 @@ PRECOMPUTED_GROUP_PARAMS = {
             '05523817cb087debb711289e28db4fd35da61ad6e4c39106e01']
         }
 
-if not number._fastmath:
-    l.warning("pycrypto not built with _fastmath module.  A lot will be quite "+
-              "slow")
+# Upper bound on the size in bytes of the table of a FixedBaseExp
+FIXED_BASE_TABLE_SIZE = 8 * 1024 * 1024
 
 def _find_safe_prime_initializer(args, kwargs):
     Crypto.Random.atfork()
     kwargs['randfunc'] = Crypto.Random.new().read
 
-def _find_safe_prime(bits, randfunc=None):
-    """ Finds a safe prime of `bits` bits """
-    r = gmpy.mpz(number.getRandomNBitInteger(bits-1, randfunc))
-    q = gmpy.next_prime(r)
-    p = 2*q+1
-    if gmpy.is_prime(p):
-        return p
+def _small_primes(bound):
+    """ Returns the odd primes below `bound'. """
+    sieve = bytearray([1]) * bound
+    sieve[0:2] = '\0\0'
+    for i in xrange(2, int(bound ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i*i::i] = bytearray(len(xrange(i*i, bound, i)))
+    return [i for i in xrange(3, bound) if sieve[i]]
+
+# Number of candidates q a call to _find_safe_prime sieves at once
+SAFE_PRIME_SIEVE_WINDOW = 4096
+
+# The candidates q for which q or 2q+1 has a factor in this table are
+# discarded before any primality test.
+SAFE_PRIME_SIEVE_PRIMES = _small_primes(8192)
+
+def _sieve_safe_prime_candidates(q0, window):
+    """ Returns the offsets i below `window' such that neither q = q0 + 2i
+        nor 2q + 1 is divisible by a prime in SAFE_PRIME_SIEVE_PRIMES.
+        `q0' should be odd and larger than the primes in the table. """
+    sieve = bytearray([1]) * window
+    for s in SAFE_PRIME_SIEVE_PRIMES:
+        r = int(q0 % s)
+        half = (s + 1) // 2     # the inverse of 2 modulo s
+        # q is divisible by s iff i = -q0/2 mod s and 2q + 1 is divisible
+        # by s iff q = -1/2 mod s, that is: iff i = (-1/2 - q0)/2 mod s.
+        for i in ((s - r) * half % s, (s - half - r) * half % s):
+            if i < window:
+                sieve[i::s] = bytearray(len(xrange(i, window, s)))
+    return [i for i in xrange(window) if sieve[i]]
+
+def _find_safe_prime(bits, randfunc=None, window=SAFE_PRIME_SIEVE_WINDOW):
+    """ Searches a random window of `window' candidates for a safe prime
+        of `bits' bits.  Returns None if there is none.
+
+        The candidates q = q0 + 2i of the window are sieved first.  Only
+        the survivors get a Fermat test for q and 2q+1 and, if they pass,
+        a full primality test.  The windows are aligned, so windows of
+        different calls and different workers are disjoint or equal. """
+    # q has bits-1 bits: it lies in [2^(bits-2), 2^(bits-1)).
+    window = min(window, 2 ** max(bits - 4, 0))
+    span = 2 * window
+    k = number.getRandomRange(2 ** (bits - 2) // span,
+                              2 ** (bits - 1) // span, randfunc)
+    q0 = gmpy.mpz(k * span + 1)
+    two = gmpy.mpz(2)
+    for i in _sieve_safe_prime_candidates(q0, window):
+        q = q0 + 2 * i
+        p = 2 * q + 1
+        if pow(two, q - 1, q) != 1 or pow(two, p - 1, p) != 1:
+            continue
+        if gmpy.is_prime(q) and gmpy.is_prime(p):
+            return p
 
 def precomputed_group_params(bits=1025):
     """ Return precomputed group parameters.
@@ -130,10 +175,14 @@ def generate_group_params(bits=1025, nworkers=None, use_threads=False,
     l.debug('Searching for a %s bit safe prime p as modulus on %s workers',
                 bits, nworkers)
     safe_prime_density = asymptotic_safe_prime_density / (bits - 1)
+    # A call to _find_safe_prime tries SAFE_PRIME_SIEVE_WINDOW odd
+    # candidates q, of which about 2/ln(q) are prime.
+    candidate_density = safe_prime_density * 2 / ((bits - 1) * math.log(2))
     if progress:
         progress('p', None)
         def _progress(n):
-            progress('p', pol.progressbar.coin(safe_prime_density, n))
+            progress('p', pol.progressbar.coin(candidate_density,
+                                        n * SAFE_PRIME_SIEVE_WINDOW))
     else:
         _progress = None
     p = pol.parallel.parallel_try(_find_safe_prime, (bits,),
@@ -159,22 +208,198 @@ def generate_group_params(bits=1025, nworkers=None, use_threads=False,
     l.debug('Found one in %.2fs', time.time() - start_time)
     return group_parameters(p=p, g=g)
 
-def pubkey_from_privkey(privkey, gp):
+def verify_group_params(gp, bits):
+    """ Checks that `gp' are group parameters of `bits' bits as
+        `generate_group_params' generates them: p is a safe prime and
+        g generates the whole group.  Raises ValueError if not. """
+    p, g = gmpy.mpz(gp.p), gmpy.mpz(gp.g)
+    if gmpy.numdigits(p, 2) != bits:
+        raise ValueError("p should have %s bits" % bits)
+    if not gmpy.is_prime(p) or not gmpy.is_prime((p - 1) / 2):
+        raise ValueError("p should be a safe prime")
+    q = (p - 1) / 2
+    if not 3 <= g < p:
+        raise ValueError("g should be in [3, p)")
+    if pow(g, 2, p) == 1 or pow(g, q, p) == 1 or divmod(p-1, g)[1] == 0:
+        raise ValueError("g should generate the group")
+    if divmod(p - 1, gmpy.invert(g, p))[1] == 0:
+        raise ValueError("the inverse of g should not divide p - 1")
+
+def fixed_base_window(bits, exponent_bits=None,
+                        max_table_size=FIXED_BASE_TABLE_SIZE):
+    """ Returns the largest window that keeps the table of a FixedBaseExp
+        for a `bits' bit modulus and `exponent_bits' bit exponents
+        within `max_table_size' bytes. """
+    if exponent_bits is None:
+        exponent_bits = bits
+    window = 1
+    while window < 8:
+        rows = -(-exponent_bits // (window + 1))
+        if rows * (2 ** (window + 1) - 1) * (bits // 8 + 1) > max_table_size:
+            break
+        window += 1
+    return window
+
+class FixedBaseExp(object):
+    """ Computes powers of the generator of the group `gp' using a table
+        of precomputed powers.
+
+        The exponent is split in windows of `window' bits.  The table
+        contains g^(j 2^(i window)) for every window i and every digit j.
+        Thus g^x is the product of a single entry for each window: there
+        is no need to square.
+
+        Only exponents of at most `exponent_bits' bits are covered by
+        the table.  It defaults to the size of p. """
+
+    def __init__(self, gp, window=None, table=None, exponent_bits=None):
+        self.gp = gp
+        self.bits = gmpy.numdigits(gp.p, 2)
+        self.exponent_bits = (self.bits if exponent_bits is None
+                                    else exponent_bits)
+        self.window = (fixed_base_window(self.bits, self.exponent_bits)
+                            if window is None else window)
+        self.mask = 2 ** self.window - 1
+        self.rows = -(-self.exponent_bits // self.window)
+        self.table = self._compute_table() if table is None else table
+
+    def _compute_table(self):
+        p = self.gp.p
+        table = []
+        base = gmpy.mpz(self.gp.g)
+        for i in xrange(self.rows):
+            row = [gmpy.mpz(1), base]
+            for j in xrange(2, self.mask + 1):
+                row.append(row[-1] * base % p)
+            table.append(row)
+            base = row[-1] * base % p
+        return table
+
+    def __call__(self, x):
+        """ Returns g^x mod p """
+        if x < 0 or gmpy.numdigits(x, 2) > self.rows * self.window:
+            return pow(self.gp.g, x, self.gp.p)
+        p = self.gp.p
+        mask = self.mask
+        window = self.window
+        ret = gmpy.mpz(1)
+        x = long(x)
+        for row in self.table:
+            if not x:
+                break
+            digit = x & mask
+            if digit:
+                ret = ret * row[digit] % p
+            x >>= window
+        return ret
+
+# Maps (p, g, exponent_bits) to an already computed FixedBaseExp
+_fixed_base_exps = {}
+_fixed_base_exps_lock = threading.Lock()
+
+def fixed_base_exp(gp, exponent_bits=None):
+    """ Returns a FixedBaseExp for `gp' and exponents of at most
+        `exponent_bits' bits.
+
+        The table is only computed once per process.  We do not store it on
+        disk: loading it is not faster than computing it. """
+    bits = gmpy.numdigits(gp.p, 2)
+    if exponent_bits is None:
+        exponent_bits = bits
+    with _fixed_base_exps_lock:
+        key = (gp.p, gp.g, exponent_bits)
+        if key in _fixed_base_exps:
+            return _fixed_base_exps[key]
+        start_time = time.time()
+        ret = FixedBaseExp(gp, exponent_bits=exponent_bits)
+        l.debug('Computed fixed-base table in %.2fs',
+                    time.time() - start_time)
+        _fixed_base_exps[key] = ret
+        return ret
+
+def subgroup_params(gp):
+    """ Returns the group parameters for the subgroup of quadratic residues
+        of the group `gp'.  If p = 2q + 1 is a safe prime, then it has
+        prime order q. """
+    return group_parameters(p=gp.p, g=pow(gp.g, 2, gp.p))
+
+def pubkey_from_privkey(privkey, gp, gexp=None):
+    """ Returns the public key for `privkey'.  If given, uses the
+        FixedBaseExp `gexp' to compute the power of g. """
+    if gexp is not None:
+        return gexp(privkey)
     return pow(gp.g, privkey, gp.p)
 def string_to_group(s):
     return pol.serialization.string_to_number(s)
 def group_to_string(n, size):
     # TODO is mpz.binary() stable?
     return pol.serialization.number_to_string(n).ljust(size, '\0')
+def string_to_qr(s, gp):
+    """ Encodes the string `s' as a quadratic residue modulo the safe
+        prime p = 2q + 1.
+
+        Let n be the number represented by `s'.  We require n < q.  As
+        p = 3 mod 4, -1 is not a quadratic residue.  Thus exactly one of
+        n + 1 and p - n - 1 is a quadratic residue. """
+    m = string_to_group(s) + 1
+    return m if gmpy.legendre(m, gp.p) == 1 else gp.p - m
+def qr_to_string(n, gp, size):
+    """ Inverse of `string_to_qr' """
+    m = n if n <= (gp.p - 1) / 2 else gp.p - n
+    return group_to_string(m - 1, size)
 def decrypt(c1, c2, privkey, gp, size):
     s = pow(c1, privkey, gp.p)
     invs = gmpy.invert(s, gp.p)
     return group_to_string((invs * c2) % gp.p, size)
-def encrypt(string, pubkey, gp, size, randfunc):
+def decrypt_qr(c1, c2, privkey, gp, size):
+    """ Decrypts a ciphertext created with `encrypt_qr' """
+    s = pow(c1, privkey, gp.p)
+    invs = gmpy.invert(s, gp.p)
+    return qr_to_string((invs * c2) % gp.p, gp, size)
+def decrypt_many(pairs, privkeys, gp, size):
+    """ Decrypts the ciphertexts `pairs' = [(c1, c2), ...] with the
+        respective private keys in `privkeys'.
+
+        Uses Montgomery's trick to invert all shared secrets with
+        a single modular inversion. """
+    return [group_to_string(n, size)
+                for n in _decrypt_many(pairs, privkeys, gp)]
+def decrypt_many_qr(pairs, privkeys, gp, size):
+    """ Decrypts many ciphertexts created with `encrypt_qr'.
+        See `decrypt_many'. """
+    return [qr_to_string(n, gp, size)
+                for n in _decrypt_many(pairs, privkeys, gp)]
+def _decrypt_many(pairs, privkeys, gp):
+    p = gp.p
+    ss = [pow(c1, privkey, p) for (c1, c2), privkey in zip(pairs, privkeys)]
+    if not ss:
+        return []
+    # products[i] is the product of ss[0], ..., ss[i]
+    products = []
+    product = gmpy.mpz(1)
+    for s in ss:
+        product = product * s % p
+        products.append(product)
+    # inv is the inverse of products[i] at the start of iteration i
+    inv = gmpy.invert(product, p)
+    ret = [None] * len(ss)
+    for i in xrange(len(ss) - 1, -1, -1):
+        invs = inv * products[i-1] % p if i else inv
+        inv = inv * ss[i] % p
+        ret[i] = invs * pairs[i][1] % p
+    return ret
+def encrypt(string, pubkey, gp, size, randfunc, gexp=None):
     # TODO how small may size be?
-    number = string_to_group(string)
-    r = string_to_group(randfunc(size))
-    c1 = pow(gp.g, r, gp.p)
+    return _encrypt(string_to_group(string), pubkey, gp,
+                    string_to_group(randfunc(size)), gexp)
+def encrypt_qr(string, pubkey, gp, exponent_size, randfunc, gexp=None):
+    """ Encrypts `string' in the subgroup of quadratic residues with
+        a random exponent of `exponent_size' bytes.  `gp' should be
+        the parameters returned by `subgroup_params'. """
+    return _encrypt(string_to_qr(string, gp), pubkey, gp,
+                    string_to_group(randfunc(exponent_size)), gexp)
+def _encrypt(number, pubkey, gp, r, gexp):
+    c1 = gexp(r) if gexp is not None else pow(gp.g, r, gp.p)
     s = pow(pubkey, r, gp.p)
     c2 = (number * s) % gp.p
     return (c1, c2)
@@ -1,10 +1,21 @@
 """ Implementation of envelopes  """
 
+import struct
 import logging
 
 import seccure
+import pyblake2
 
 import Crypto.Random
+import Crypto.Cipher.ChaCha20_Poly1305
+
+# X25519 requires PyCryptodome 3.21, which does not support Python 2.6.
+# It is installed with the `x25519' extra.
+try:
+    import Crypto.Protocol.DH
+    have_x25519 = hasattr(Crypto.Protocol.DH, 'import_x25519_private_key')
+except ImportError:
+    have_x25519 = False
 
 l = logging.getLogger(__name__)
 
@@ -21,11 +32,17 @@ class Envelope(object):
         self.params = params
 
     @staticmethod
-    def setup(params=None):
-        """ Set-up the Envelope given by `params`. """
+    def setup(params=None, typ='seccure'):
+        """ Set-up the Envelope given by `params`.
+
+            If `params' is None, uses the default parameters of type
+            `typ'. """
         if params is None:
-            params = {'type': 'seccure',
-                      'curve': 'secp160r1'}
+            if typ == 'seccure':
+                params = {'type': 'seccure',
+                          'curve': 'secp160r1'}
+            else:
+                params = {'type': typ}
         if ('type' not in params or not isinstance(params['type'], basestring)
                 or params['type'] not in TYPE_MAP):
             raise EnvelopeParameterError("Invalid `type' attribute")
@@ -41,6 +58,14 @@ class Envelope(object):
         """ Opens ciphertext returned by `seal' with the private
             key `privkey' """
         raise NotImplementedError
+    def seal_many(self, msgs, pubkey):
+        """ Seals each message in `msgs' for public key `pubkey'.
+            Returns the list of ciphertexts. """
+        return [self.seal(msg, pubkey) for msg in msgs]
+    def open_many(self, ciphertexts, privkey):
+        """ Opens each ciphertext in `ciphertexts' with the private
+            key `privkey'.  Returns the list of messages. """
+        return [self.open(ciphertext, privkey) for ciphertext in ciphertexts]
 
 class SeccureEnvelope(Envelope):
     """ Implementation of Envelope using a modified version of the
@@ -72,5 +97,99 @@ class SeccureEnvelope(Envelope):
     def open(self, ciphertext, privkey):
         p = self.curve.passphrase_to_privkey(privkey)
         return self.curve.decrypt(ciphertext, p)
+    def open_many(self, ciphertexts, privkey):
+        p = self.curve.passphrase_to_privkey(privkey)
+        return [self.curve.decrypt(ciphertext, p)
+                    for ciphertext in ciphertexts]
+
+class X25519Envelope(Envelope):
+    """ Implementation of Envelope with X25519 and ChaCha20-Poly1305.
+
+        A ciphertext is the ephemeral public key, the nonce, the
+        encrypted message and the tag.  The messages sealed by one call
+        of `seal_many' share an ephemeral key and differ in nonce, such
+        that `open_many' needs a single key agreement for them. """
+
+    # Personalization of BLAKE2b with which we hash the shared secret
+    PERSON = 'pol.envelope'
+    KEY_SIZE = 32
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    def __init__(self, params):
+        super(X25519Envelope, self).__init__(params)
+        if not have_x25519:
+            raise EnvelopeParameterError("`x25519' requires "+
+                                         "PyCryptodome >= 3.21")
+        self.nonce_struct = struct.Struct('>4xQ')
+
+    def _symmetric_key(self, shared, ephemeral_pubkey):
+        return pyblake2.blake2b(shared + ephemeral_pubkey,
+                                digest_size=32, person=self.PERSON).digest()
+
+    def _agree(self, privkey, pubkey):
+        """ Returns the shared secret of the key objects `privkey' and the
+            public key `pubkey' as string. """
+        return Crypto.Protocol.DH.key_agreement(static_priv=privkey,
+                static_pub=Crypto.Protocol.DH.import_x25519_public_key(pubkey),
+                kdf=lambda x: x)
+
+    def generate_keypair(self, randfunc=None):
+        if randfunc is None:
+            randfunc = Crypto.Random.new().read
+        privkey = randfunc(self.KEY_SIZE)
+        pubkey = Crypto.Protocol.DH.import_x25519_private_key(
+                    privkey).public_key().export_key(format='raw')
+        return (pubkey, privkey)
+    def seal(self, msg, pubkey):
+        return self.seal_many([msg], pubkey)[0]
+    def open(self, ciphertext, privkey):
+        return self.open_many([ciphertext], privkey)[0]
+    def seal_many(self, msgs, pubkey, randfunc=None):
+        if not msgs:
+            return []
+        ephemeral_pubkey, ephemeral_privkey = self.generate_keypair(randfunc)
+        key = self._symmetric_key(self._agree(
+                    Crypto.Protocol.DH.import_x25519_private_key(
+                                        ephemeral_privkey), pubkey),
+                    ephemeral_pubkey)
+        ret = []
+        for i, msg in enumerate(msgs):
+            nonce = self.nonce_struct.pack(i)
+            ct, tag = Crypto.Cipher.ChaCha20_Poly1305.new(key=key,
+                            nonce=nonce).encrypt_and_digest(msg)
+            ret.append(''.join((ephemeral_pubkey, nonce, ct, tag)))
+        return ret
+    def open_many(self, ciphertexts, privkey):
+        if not ciphertexts:
+            return []
+        # Importing a private key costs as much as a key agreement: we
+        # do it once for all ciphertexts.
+        p = Crypto.Protocol.DH.import_x25519_private_key(privkey)
+        # Maps an ephemeral public key to the symmetric key
+        keys = {}
+        ret = []
+        for ciphertext in ciphertexts:
+            if len(ciphertext) < (self.KEY_SIZE + self.NONCE_SIZE
+                                    + self.TAG_SIZE):
+                raise ValueError("Ciphertext is too short")
+            ephemeral_pubkey = ciphertext[:self.KEY_SIZE]
+            nonce = ciphertext[self.KEY_SIZE:self.KEY_SIZE+self.NONCE_SIZE]
+            key = keys.get(ephemeral_pubkey)
+            if key is None:
+                key = self._symmetric_key(self._agree(p, ephemeral_pubkey),
+                                          ephemeral_pubkey)
+                keys[ephemeral_pubkey] = key
+            ret.append(Crypto.Cipher.ChaCha20_Poly1305.new(key=key,
+                            nonce=nonce).decrypt_and_verify(
+                                ciphertext[self.KEY_SIZE+self.NONCE_SIZE:
+                                                    -self.TAG_SIZE],
+                                ciphertext[-self.TAG_SIZE:]))
+        return ret
+
+TYPE_MAP = {'seccure': SeccureEnvelope,
+            'x25519': X25519Envelope}
 
-TYPE_MAP = {'seccure': SeccureEnvelope}
+# The types of envelope that can be set up with the installed libraries
+AVAILABLE_TYPES = sorted(typ for typ in TYPE_MAP
+                            if typ != 'x25519' or have_x25519)
@@ -0,0 +1,102 @@
+""" A per-user pool of group parameters generated ahead of time.
+
+    Generating the group parameters for a new safe can take minutes.
+    `fill' generates them in advance (see `pol gp-pool fill') and `take'
+    hands out every entry exactly once, such that no two safes share
+    group parameters. """
+
+import os
+import errno
+import logging
+import binascii
+import tempfile
+
+import gmpy
+import msgpack
+
+import pol.elgamal
+import pol.serialization
+
+l = logging.getLogger(__name__)
+
+DEFAULT_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', '~/.cache'),
+                            'pol', 'gp-pool')
+
+def _entries(path, bits):
+    """ Returns the names of the entries of `bits' bits in the pool. """
+    try:
+        names = os.listdir(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    prefix = '%s-' % bits
+    return sorted(name for name in names
+                    if name.startswith(prefix) and name.endswith('.gp'))
+
+def count(bits, path=DEFAULT_PATH):
+    """ Returns the number of entries of `bits' bits in the pool. """
+    return len(_entries(os.path.expanduser(path), bits))
+
+def add(gp, path=DEFAULT_PATH):
+    """ Adds the group parameters `gp' to the pool. """
+    path = os.path.expanduser(path)
+    try:
+        os.makedirs(path, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    name = '%s-%s.gp' % (gmpy.numdigits(gp.p, 2),
+                         binascii.hexlify(os.urandom(8)))
+    # Write the entry under a name `take' ignores and rename it, such that
+    # `take' never sees a partial entry.
+    with tempfile.NamedTemporaryFile(dir=path, prefix='.new-',
+                                     delete=False) as f:
+        f.write(msgpack.packb([pol.serialization.number_to_string(x)
+                                    for x in gp]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(f.name, os.path.join(path, name))
+
+def take(bits, path=DEFAULT_PATH):
+    """ Removes an entry of `bits' bits from the pool and returns it.
+        Returns None if there is none. """
+    path = os.path.expanduser(path)
+    for name in _entries(path, bits):
+        # Only one process succeeds to rename an entry.  That one owns it.
+        taken = os.path.join(path, '.taken-' + name)
+        try:
+            os.rename(os.path.join(path, name), taken)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        try:
+            with open(taken, 'rb') as f:
+                p, g = [pol.serialization.string_to_number(x)
+                            for x in msgpack.unpackb(f.read())]
+            # Anyone who can write to the pool could have planted a weak
+            # group.  Thus we check the entry as thoroughly as
+            # `generate_group_params' guarantees it.
+            gp = pol.elgamal.group_parameters(p=p, g=g)
+            pol.elgamal.verify_group_params(gp, bits)
+        except (ValueError, TypeError) as e:
+            l.warning('Ignoring malformed entry %s of the group parameter '+
+                        'pool: %s', name, e)
+            continue
+        finally:
+            os.unlink(taken)
+        l.debug('Took group parameters %s from the pool', name)
+        return gp
+    return None
+
+def fill(bits, n, path=DEFAULT_PATH, nworkers=None, use_threads=False,
+                progress=None):
+    """ Generates group parameters of `bits' bits until the pool holds
+        `n' of them.  Returns the number of entries added. """
+    added = 0
+    while count(bits, path) < n:
+        add(pol.elgamal.generate_group_params(bits, nworkers=nworkers,
+                        use_threads=use_threads, progress=progress), path)
+        added += 1
+    return added
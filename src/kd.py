@@ -4,6 +4,7 @@ import logging
 import hashlib
 import struct
 
+import pyblake2
 import Crypto.Random
 
 l = logging.getLogger(__name__)
@@ -21,17 +22,21 @@ class KeyDerivation(object):
         self.params = params
 
     @staticmethod
-    def setup(params=None, randfunc=None):
+    def setup(params=None, randfunc=None, typ='sha'):
         """ Set-up the keyderivation given by `params`.
         
-            If `params' is None, generates new parameters.  In that case
-            `randfunc' is used to generate a salt. """
+            If `params' is None, generates new parameters of type `typ'.
+            In that case `randfunc' is used to generate a salt. """
         if params is None:
             if randfunc is None:
                 randfunc = Crypto.Random.new().read
-            params = {'type': 'sha',
-                      'bits': 256,
-                      'salt': randfunc(32)}
+            if typ == 'sha':
+                params = {'type': 'sha',
+                          'bits': 256,
+                          'salt': randfunc(32)}
+            else:
+                params = {'type': typ,
+                          'salt': randfunc(32)}
         if ('type' not in params or not isinstance(params['type'], basestring)
                 or params['type'] not in TYPE_MAP):
             raise KeyDerivationParameterError("Invalid `type' attribute")
@@ -44,6 +49,14 @@ class KeyDerivation(object):
         """ Derives a key of `length' bytes from the list of strings `args'. """
         raise NotImplementedError
 
+    def prefixed(self, args):
+        """ Returns a function `f' such that `f(rest, length)' equals
+            `self.derive(args + rest, length)'.
+
+            Implementations may precompute the part of the derivation
+            that only depends on `args'. """
+        return lambda rest, length=32: self.derive(args + rest, length)
+
     @property
     def size(self):
         """ The "natural" size of the key-derivation """
@@ -68,30 +81,152 @@ class SHAKeyDerivation(KeyDerivation):
         self.bits = params['bits']
         self.salt = params['salt']
         self.word_struct = struct.Struct(">H")
-
-    def _derive(self, args):
-        """ Derives `self.bits' bit key from args """
+        # The digests of the salt and the counter words are the same for
+        # every derivation: we compute them once.
+        self._salt_digest = self._new_hash(self.salt).digest()
+        # Maps i to the digest of the `i'th counter word.  The value only
+        # depends on the key, which makes it safe to share between threads.
+        self._counter_digests = {}
+
+    def _new_hash(self, s=''):
         if self.bits == 256:
-            new_hash = hashlib.sha256
-        else:
-            assert False
-        oh = new_hash()
-        for arg in args:
-            oh.update(new_hash(arg).digest())
-        return oh.digest()
+            return hashlib.sha256(s)
+        assert False
 
-    def derive(self, args, length=32):
-        ret = ''
+    def _midstate(self, args):
+        """ Returns the hash object that has absorbed `args' """
+        oh = self._new_hash()
+        for arg in args:
+            oh.update(self._new_hash(arg).digest())
+        return oh
+
+    def _counter_digest(self, i):
+        """ Returns the digest of the `i'th counter word """
+        ret = self._counter_digests.get(i)
+        if ret is None:
+            ret = self._new_hash(self.word_struct.pack(i)).digest()
+            self._counter_digests[i] = ret
+        return ret
+
+    def _derive_from_midstate(self, oh, length):
+        """ Derives a key of `length' bytes from the hash object `oh'
+            returned by `_midstate' """
+        ret = []
         byts = self.bits / 8
         n = length / byts
         if length % byts != 0:
             n += 1
         for i in xrange(n):
-            ret += self._derive(args + [self.word_struct.pack(i), self.salt])
-        return ret[:length]
+            h = oh.copy()
+            h.update(self._counter_digest(i))
+            h.update(self._salt_digest)
+            ret.append(h.digest())
+        return ''.join(ret)[:length]
+
+    def derive(self, args, length=32):
+        return self._derive_from_midstate(self._midstate(args), length)
+
+    def prefixed(self, args):
+        midstate = self._midstate(args)
+        def derive(rest, length=32):
+            oh = midstate.copy()
+            for arg in rest:
+                oh.update(self._new_hash(arg).digest())
+            return self._derive_from_midstate(oh, length)
+        return derive
 
     @property
     def size(self):
         return self.bits / 8
 
-TYPE_MAP = {'sha': SHAKeyDerivation}
+class BLAKE2KeyDerivation(KeyDerivation):
+    """ Key derivation with keyed and personalized BLAKE2b.
+
+        The salt is the key of BLAKE2b and the arguments are absorbed
+        with their length as prefix.  A key of up to 64 bytes is a single
+        BLAKE2b digest of that length.  Longer keys are expanded from a
+        64 byte root digest with one BLAKE2b digest per 64 bytes. """
+
+    # Personalization of BLAKE2b: separates pol from other uses
+    PERSON = 'pol.kd'
+    # Maximum size of a single BLAKE2b digest
+    MAX_DIGEST_SIZE = 64
+
+    def __init__(self, params):
+        super(BLAKE2KeyDerivation, self).__init__(params)
+        if not 'salt' in params:
+            raise KeyDerivationParameterError("Missing param `salt'")
+        if not isinstance(params['salt'], basestring):
+            raise KeyDerivationParameterError("`salt' should be a string")
+        if len(params['salt']) > 64:
+            raise KeyDerivationParameterError("`salt' is too long")
+        self.salt = params['salt']
+        self.length_struct = struct.Struct(">I")
+        # Maps a length to the hash object that has absorbed nothing yet.
+        # Its parameters depend on the length.
+        self._initial_states = {}
+
+    def _initial_state(self, length):
+        """ Returns the hash object from which a key of `length' bytes
+            is derived. """
+        ret = self._initial_states.get(length)
+        if ret is None:
+            if length <= self.MAX_DIGEST_SIZE:
+                ret = pyblake2.blake2b(digest_size=length, key=self.salt,
+                                       person=self.PERSON)
+            else:
+                # The root of a longer key.  Its digest differs from that
+                # of a 64 byte key by `inner_size' and depends on the
+                # length by `node_offset'.
+                ret = pyblake2.blake2b(digest_size=self.MAX_DIGEST_SIZE,
+                                       key=self.salt, person=self.PERSON,
+                                       node_offset=length,
+                                       inner_size=self.MAX_DIGEST_SIZE)
+            self._initial_states[length] = ret
+        return ret
+
+    def _absorb(self, h, args):
+        for arg in args:
+            h.update(self.length_struct.pack(len(arg)))
+            h.update(arg)
+
+    def _finish(self, h, length):
+        """ Returns the key of `length' bytes from the hash object `h' """
+        if length <= self.MAX_DIGEST_SIZE:
+            return h.digest()
+        root = h.digest()
+        ret = []
+        for i in xrange(0, length, self.MAX_DIGEST_SIZE):
+            ret.append(pyblake2.blake2b(root,
+                        digest_size=min(self.MAX_DIGEST_SIZE, length - i),
+                        person=self.PERSON,
+                        node_offset=i // self.MAX_DIGEST_SIZE,
+                        node_depth=1,
+                        inner_size=self.MAX_DIGEST_SIZE).digest())
+        return ''.join(ret)
+
+    def derive(self, args, length=32):
+        h = self._initial_state(length).copy()
+        self._absorb(h, args)
+        return self._finish(h, length)
+
+    def prefixed(self, args):
+        # Maps a length to the hash object that has absorbed `args'
+        midstates = {}
+        def derive(rest, length=32):
+            midstate = midstates.get(length)
+            if midstate is None:
+                midstate = self._initial_state(length).copy()
+                self._absorb(midstate, args)
+                midstates[length] = midstate
+            h = midstate.copy()
+            self._absorb(h, rest)
+            return self._finish(h, length)
+        return derive
+
+    @property
+    def size(self):
+        return 32
+
+TYPE_MAP = {'sha': SHAKeyDerivation,
+            'blake2': BLAKE2KeyDerivation}
@@ -1,6 +1,9 @@
 """ Implementation of key stretching  """
 
 import logging
+import multiprocessing
+
+import pol.parallel
 
 import Crypto.Random
 
@@ -13,6 +16,10 @@ import argon2 # argon2-cffi
 
 l = logging.getLogger(__name__)
 
+# Upper bound on the memory in bytes used by the concurrent stretches
+# of `KeyStretching.stretch_many'
+STRETCH_MANY_MAX_MEMORY = 512 * 1024 * 1024
+
 class KeyStretchingParameterError(ValueError):
     pass
 
@@ -51,6 +58,30 @@ class KeyStretching(object):
     def stretch(self, password):
         raise NotImplementedError
 
+    @property
+    def memory(self):
+        """ The approximate memory in bytes a single stretch uses. """
+        raise NotImplementedError
+
+    def stretch_many(self, passwords, nworkers=None,
+                        max_memory=STRETCH_MANY_MAX_MEMORY):
+        """ Returns the stretched keys of `passwords', in order.
+
+            The passwords are stretched concurrently in at most `nworkers'
+            threads --- the stretching functions release the GIL --- but
+            never more at once than fit in `max_memory' bytes.  Every
+            distinct password is stretched once. """
+        unique = list(set(passwords))
+        if nworkers is None:
+            nworkers = multiprocessing.cpu_count()
+        nworkers = max(1, min(nworkers, len(unique),
+                              max_memory // max(self.memory, 1)))
+        l.debug('stretch_many: %s passwords on %s threads',
+                    len(unique), nworkers)
+        keys = dict(zip(unique, pol.parallel.parallel_map(self.stretch,
+                                unique, nworkers=nworkers, use_threads=True)))
+        return [keys[password] for password in passwords]
+
 
 class ScryptKeyStretching(KeyStretching):
     """ scrypt is the default for key stretching """
@@ -79,6 +110,11 @@ class ScryptKeyStretching(KeyStretching):
                            #p=self.params['p'],
                            N=2**self.params['Nexp'])
 
+    @property
+    def memory(self):
+        # scrypt uses 128 r N bytes; we use the default r = 8.
+        return 128 * 8 * 2**self.params['Nexp']
+
     @staticmethod
     def setup(params=None, randfunc=None):
         if params is None:
@@ -120,5 +156,24 @@ class Argon2KeyStretching(KeyStretching):
                             version=self.params['v'],
                             type=argon2.low_level.Type.D)
 
+    @property
+    def memory(self):
+        return self.params['m'] * 1024
+
+    @staticmethod
+    def setup(params=None, randfunc=None, t=1, m=102400, p=4):
+        """ Like `KeyStretching.setup', but generates parameters with
+            time cost `t', memory cost `m' KiB and parallelism `p'. """
+        if params is None:
+            if randfunc is None:
+                randfunc = Crypto.Random.new().read
+            params = {'type': 'argon2',
+                      'salt': randfunc(32),
+                      't': t,
+                      'v': argon2.low_level.ARGON2_VERSION,
+                      'm': m,
+                      'p': p}
+        return KeyStretching.setup(params)
+
 TYPE_MAP = {'scrypt': ScryptKeyStretching,
             'argon2': Argon2KeyStretching}
@@ -38,9 +38,14 @@ import re
 
 import pol
 import pol.vi
+import pol.kd
 import pol.ks
 import pol.text
 import pol.safe
+import pol.envelope
+import pol.blockcipher
+import pol.gppool
+import pol.calibrate
 import pol.passgen
 import pol.terminal
 import pol.humanize
@@ -75,6 +80,20 @@ cracktimes = {'seconds':     10,
               'ages':        10*60*60*24*365*1000000,
               'astronomical':10*60*60*24*365*1000000000}
 
+# Number of seconds to wait for a safe that is locked by another pol.
+# Can be changed with `lock-timeout' in the configuration file.
+LOCK_TIMEOUT = 60
+
+def _seconds(s):
+    """ Parses a duration such as `0.5' or `0.5s' for argparse. """
+    try:
+        ret = float(s[:-1] if s.endswith('s') else s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid duration: %r' % s)
+    if ret <= 0:
+        raise argparse.ArgumentTypeError('duration should be positive')
+    return ret
+
 # TODO add commands
 #   pol rename
 #       regenerate
@@ -110,6 +129,10 @@ class Program(object):
                     help='Profile performance of main process')
         g_advanced.add_argument('--config-file', '-C', type=str, metavar='PATH',
                     help='Path to pol configuration file.')
+        g_advanced.add_argument('--read-only', action='store_true',
+                    help='Open the safe without waiting for other pols '+
+                            'and without changing or rerandomizing it.  '+
+                            'For list, get, copy, raw and export')
         subparsers = parser.add_subparsers(title='commands')
 
         # pol init
@@ -121,6 +144,26 @@ class Program(object):
         p_init_b.add_argument('--force', '-f', action='store_true',
                     help='Remove any existing safe')
         p_init_a = p_init.add_argument_group('advanced options')
+        p_init_a.add_argument('--type', '-T', default='elgamal',
+                        choices=sorted(pol.safe.TYPE_MAP),
+                    help='Type of safe.  elgamal-q is faster, but stores '+
+                            'a bit less per block.  elgamal-ec uses an '+
+                            'elliptic curve: its blocks are smaller and '+
+                            'it ignores --rerand-bits')
+        p_init_a.add_argument('--key-derivation', default='sha',
+                        choices=sorted(pol.kd.TYPE_MAP),
+                    help='Key derivation of the safe.  blake2 is faster; '+
+                            'sha is the default')
+        p_init_a.add_argument('--block-cipher', default='aes',
+                        choices=sorted(pol.blockcipher.TYPE_MAP),
+                    help='Cipher of the safe.  chacha20 is faster on '+
+                            'processors without AES instructions; aes is '+
+                            'the default')
+        p_init_a.add_argument('--envelope', default='seccure',
+                        choices=pol.envelope.AVAILABLE_TYPES,
+                    help='Public key encryption of the entries added with '+
+                            'an append-password.  x25519 is faster; '+
+                            'seccure is the default')
         p_init_a.add_argument('--rerand-bits', '-R', type=int, default=1025,
                     help='Minimal size in bits of prime used for '+
                             'rerandomization')
@@ -132,8 +175,18 @@ class Program(object):
                             'interactively')
         p_init_a.add_argument('--i-know-its-unsafe', action='store_true',
                     help='Required for obviously unsafe actions')
-        p_init_a.add_argument('--blocks', '-N', type=int, default=1024,
-                    help='Number of blocks in the safe')
+        p_init_a.add_argument('--blocks', '-N', type=int,
+                    help='Number of blocks in the safe.  Default: 1024 or, '+
+                            'with a target, calibrated')
+        p_init_a.add_argument('--target-unlock', type=_seconds,
+                        metavar='SECONDS',
+                    help='Calibrate the key stretching such that opening '+
+                            'a container takes about this long, e.g. 0.5s')
+        p_init_a.add_argument('--target-rerand', type=_seconds,
+                        metavar='SECONDS',
+                    help='Calibrate the number of blocks such that '+
+                            'rerandomizing the safe takes about this long, '+
+                            'e.g. 3s')
         p_init_a.add_argument('-K', '--keyfiles', nargs='*', metavar='PATH',
                     help='Compose passwords with the contents of these files')
         p_init.set_defaults(func=self.cmd_init)
@@ -427,6 +480,26 @@ class Program(object):
                     help='Compose passwords with the contents of these files')
         p_vi.set_defaults(func=self.cmd_vi)
 
+        # pol gp-pool
+        p_gp_pool = subparsers.add_parser('gp-pool', add_help=False,
+                    help='Manage the pool of group parameters for new safes')
+        p_gp_pool_b = p_gp_pool.add_argument_group('basic options')
+        p_gp_pool_b.add_argument('-h', '--help', action='help',
+                    help='show this help message and exit')
+        gp_pool_subparsers = p_gp_pool.add_subparsers(title='actions')
+        p_gp_pool_fill = gp_pool_subparsers.add_parser('fill', add_help=False,
+                    help='Generate group parameters in advance, such that '+
+                            '`pol init\' need not')
+        p_gp_pool_fill_b = p_gp_pool_fill.add_argument_group('basic options')
+        p_gp_pool_fill_b.add_argument('-h', '--help', action='help',
+                    help='show this help message and exit')
+        p_gp_pool_fill_b.add_argument('--bits', '-b', type=int, default=1025,
+                    help='Size in bits of the group parameters.  See '+
+                            '`pol init --rerand-bits\'')
+        p_gp_pool_fill_b.add_argument('-n', type=int, default=4,
+                    help='Number of group parameters the pool should hold')
+        p_gp_pool_fill.set_defaults(func=self.cmd_gp_pool_fill)
+
         # pol speed
         p_speed = subparsers.add_parser('speed',
                         add_help=False,
@@ -486,6 +559,40 @@ class Program(object):
         with open(cached_path, 'w') as f:
             msgpack.dump(self.config, f)
 
+    def _load_rerandomize_options(self):
+        """ Sets self.rerandomize_options from the `rerandomize' section
+            of the configuration file.  For instance:
+
+                rerandomize:
+                    workers: 1
+                    nice: 10
+                    max-duration: 60
+                    checkpoint-interval: 10 """
+        self.rerandomize_options = {}
+        config = self.config.get('rerandomize', {})
+        if not isinstance(config, dict):
+            sys.stderr.write("configuration file: `rerandomize' should "+
+                                "be a mapping\n")
+            return -18
+        for key, option, _type in (('workers', 'rerandomize_nworkers', int),
+                                   ('nice', 'nice', int),
+                                   ('max-duration', 'max_duration', float),
+                                   ('checkpoint-interval',
+                                        'checkpoint_interval', float)):
+            if key not in config:
+                continue
+            try:
+                value = _type(config[key])
+            except (TypeError, ValueError):
+                value = -1
+            # A negative niceness would require privileges.
+            if value < 0:
+                sys.stderr.write(("configuration file: `rerandomize.%s' "+
+                                    "should be a non-negative number\n")
+                                        % key)
+                return -18
+            self.rerandomize_options[option] = value
+
     def main(self, argv, exitcode_pipe_fd):
         """ Main entry point.
 
@@ -498,6 +605,7 @@ class Program(object):
             self.do_not_exit_when_closing_safe = False
             self.exitcode_pipe_fd = exitcode_pipe_fd 
             self.in_background = False
+            self.readonly = False
 
             if 'POL_PROFILE' in os.environ:
                 profiling = True
@@ -542,6 +650,16 @@ class Program(object):
                                 else (self.config['keyfiles']
                                         if 'keyfiles' in self.config
                                     else None))
+            try:
+                self.lock_timeout = float(self.config.get('lock-timeout',
+                                                          LOCK_TIMEOUT))
+            except (TypeError, ValueError):
+                sys.stderr.write("configuration file: `lock-timeout' "+
+                                    "should be a number\n")
+                return -18
+            ret = self._load_rerandomize_options()
+            if ret:
+                return ret
 
             # Execute command
             ret = self._run_command()
@@ -636,48 +754,118 @@ class Program(object):
                         appendpw if appendpw else None))
         if interactive:
             print
-        if not self.args.precomputed_gp:
+        if (pol.safe.TYPE_MAP[self.args.type].uses_group_params
+                and not self.args.precomputed_gp
+                and not pol.gppool.count(self.args.rerand_bits)):
             print 'Generating group parameters for this safe. This can take a while ...'
+            print 'Run `pol gp-pool fill\' to generate them in advance.'
         # TODO generate group parameters in parallel
-        progressbar = pol.progressbar.ProbablisticProgressBar()
-        progressbar.start()
-        def progress(step, x):
-            if step == 'p' and x is None:
-                progressbar.start()
-            elif step == 'p' and x:
-                progressbar(x)
-            elif step == 'g':
-                progressbar.end()
+        n_blocks = self.args.blocks
+        ks = None
+        if (self.args.target_unlock is not None
+                or self.args.target_rerand is not None):
+            c = self._calibrate()
+            n_blocks = c.n_blocks
+            ks = pol.ks.Argon2KeyStretching.setup(t=c.t, m=c.m, p=c.p)
+        elif n_blocks is None:
+            n_blocks = 1024
+        progress = self._group_params_progress()
         try:
-            blocks_per_container = int(math.floor(self.args.blocks / 6.0))
+            blocks_per_container = int(math.floor(n_blocks / 6.0))
             with pol.safe.create(os.path.expanduser(self.safe_path),
                                  override=self.args.force,
+                                 typ=self.args.type,
                                  nworkers=self.args.workers,
                                  gp_bits=self.args.rerand_bits,
                                  progress=progress,
                                  precomputed_gp=self.args.precomputed_gp,
                                  use_threads=self.args.threads,
-                                 n_blocks=self.args.blocks) as safe:
-                for i, mlapw in enumerate(pws):
-                    mpw, lpw, apw = mlapw
-                    print '  allocating container #%s ...' % (i+1)
-                    c = safe.new_container(mpw, lpw, apw,
-                                    additional_keys=self.additional_keys,
-                                    nblocks=blocks_per_container)
-                print '  trashing freespace ...'
-                safe.trash_freespace()
+                                 ks=ks,
+                                 kd=pol.kd.KeyDerivation.setup(
+                                        typ=self.args.key_derivation),
+                                 blockcipher=pol.blockcipher.BlockCipher.setup(
+                                        typ=self.args.block_cipher),
+                                 envelope=pol.envelope.Envelope.setup(
+                                        typ=self.args.envelope),
+                                 n_blocks=n_blocks) as safe:
+                print '  allocating %s containers and trashing freespace ...' % (
+                            len(pws))
+                safe.new_containers(pws, additional_keys=self.additional_keys,
+                                    nblocks=blocks_per_container,
+                                    trash_freespace=True)
         except pol.safe.SafeAlreadyExistsError:
             print '%s exists.  Use -f to override.' % self.safe_path
             return -10
 
+    def _calibrate(self):
+        """ Calibrates the parameters of the new safe to the targets
+            and prints the predicted cost of the commands. """
+        target_unlock = self.args.target_unlock
+        if target_unlock is None:
+            target_unlock = pol.calibrate.DEFAULT_TARGET_UNLOCK
+        target_rerand = self.args.target_rerand
+        if target_rerand is None:
+            target_rerand = pol.calibrate.DEFAULT_TARGET_RERAND
+        print 'Calibrating the safe to this machine ...'
+        c = pol.calibrate.calibrate(target_unlock=target_unlock,
+                                    target_rerand=target_rerand,
+                                    typ=self.args.type,
+                                    gp_bits=self.args.rerand_bits,
+                                    n_blocks=self.args.blocks,
+                                    nworkers=self.args.workers,
+                                    use_threads=self.args.threads)
+        print '  argon2:     t=%s, m=%sMiB, p=%s' % (c.t, c.m // 1024, c.p)
+        print '  blocks:     %s' % c.n_blocks
+        print '  predicted:  %.2fs to open a container (%.2fs stretching),' % (
+                    c.unlock_time, c.stretch_time)
+        print '              %.2fs to rerandomize the safe' % c.rerand_time
+        if c.unlock_time > target_unlock * 1.5:
+            print '  Opening a container will take longer than targeted.'
+            print '  Use fewer blocks to open it faster.'
+        return c
+
+    def _group_params_progress(self):
+        """ Returns a `progress' function for generate_group_params
+            that shows a progressbar. """
+        progressbar = pol.progressbar.ProbablisticProgressBar()
+        progressbar.start()
+        def progress(step, x):
+            if step == 'p' and x is None:
+                progressbar.start()
+            elif step == 'p' and x:
+                progressbar(x)
+            elif step == 'g':
+                progressbar.end()
+        return progress
+
+    def cmd_gp_pool_fill(self):
+        bits = self.args.bits
+        n = pol.gppool.count(bits)
+        if n >= self.args.n:
+            print 'The pool already has %s group parameters of %s bits.' % (
+                        n, bits)
+            return
+        # Generating takes a while: do not get in the way of anything else.
+        try:
+            os.nice(19)
+        except OSError as e:
+            l.warning("Failed to change niceness: %s", e)
+        print 'Generating %s group parameters of %s bits. This can take a while ...' % (
+                    self.args.n - n, bits)
+        pol.gppool.fill(bits, self.args.n, nworkers=self.args.workers,
+                        use_threads=self.args.threads,
+                        progress=self._group_params_progress())
+
     def cmd_touch(self):
         with self._open_safe() as safe:
             safe.touch()
 
     def cmd_raw(self):
-        with self._open_safe() as safe:
+        with self._open_safe(allow_readonly=True) as safe:
             d = dict(safe.data)
-            if not self.args.blocks:
+            if self.args.blocks:
+                d['blocks'] = d['blocks'].to_list()
+            else:
                 del d['blocks']
             pprint.pprint(d)
             if not self.args.passwords:
@@ -694,12 +882,12 @@ class Program(object):
                         pprint.pprint(container.secret_data)
 
     def cmd_get(self):
-        with self._open_safe() as safe:
+        password = self._password('Enter password: ')
+        with self._open_safe(allow_readonly=True,
+                             passwords=[password]) as safe:
             found_one = False
             entries = []
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 try:
@@ -738,12 +926,11 @@ class Program(object):
             print entry.secret
 
     def cmd_remove(self):
-        with self._open_safe() as safe:
+        password = self._password('Enter password: ')
+        with self._open_safe(passwords=[password]) as safe:
             found_one = False
             entries = []
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 try:
@@ -783,12 +970,12 @@ class Program(object):
             print 'Clipboard access not available.'
             print 'Use `pol get\' to print secrets.'
             return -7
-        with self._open_safe() as safe:
+        password = self._password('Enter password: ')
+        with self._open_safe(allow_readonly=True,
+                             passwords=[password]) as safe:
             found_one = False
             entries = []
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 try:
@@ -848,12 +1035,11 @@ class Program(object):
     def _store(self, pw):
         """ Common code of `pol put', `pol generate' and `pol paste' -
             stores `pw' to an entry self.args.key. """
-        with self._open_safe() as safe:
+        password = self._password('Enter (append-)password: ')
+        with self._open_safe(passwords=[password]) as safe:
             found_one = False
             stored = False
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter (append-)password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 try:
@@ -904,10 +1090,9 @@ class Program(object):
             return
         found_one = False
         stored = False
-        with self._open_safe() as safe:
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter (append-)password: ')):
+        password = self._password('Enter (append-)password: ')
+        with self._open_safe(passwords=[password]) as safe:
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 try:
@@ -965,7 +1150,7 @@ class Program(object):
                 passwords = [getpass.getpass('Enter password: ')]
         else:
             passwords = self.args.passwords
-        with self._open_safe() as safe:
+        with self._open_safe(passwords=passwords) as safe:
             # First, generate the file to edit
             editfile = {}
             container_id = 1
@@ -1045,11 +1230,11 @@ class Program(object):
                 return -16
         else:
             regex = None
-        with self._open_safe() as safe:
+        password = self._password('Enter (list-)password: ')
+        with self._open_safe(allow_readonly=True,
+                             passwords=[password]) as safe:
             found_one = False
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter (list-)password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 else:
@@ -1099,12 +1284,11 @@ class Program(object):
                 f.close()
 
         # Then, open the pol safe
-        with self._open_safe() as safe:
+        password = self._password('Enter (append-)password: ')
+        with self._open_safe(passwords=[password]) as safe:
             found_one = False
             the_container = None
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter (append-)password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 if container.can_add:
@@ -1139,12 +1323,11 @@ class Program(object):
                 fkeyfile.close()
 
         # Secondly, find a container
-        with self._open_safe() as safe:
+        password = self._password('Enter (append-)password: ')
+        with self._open_safe(passwords=[password]) as safe:
             found_one = False
             the_container = None
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                        else getpass.getpass('Enter (append-)password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 if container.can_add:
@@ -1185,12 +1368,11 @@ class Program(object):
             header, records = pol.importers.psafe3.load(f, ps3pwd)
 
         # Secondly, find a container
-        with self._open_safe() as safe:
+        password = self._password('Enter (append-)password: ')
+        with self._open_safe(passwords=[password]) as safe:
             found_one = False
             the_container = None
-            for container in self._open_containers(safe,
-                    self.args.password if self.args.password
-                            else getpass.getpass('Enter (append-)password: ')):
+            for container in self._open_containers(safe, password):
                 if not found_one:
                     found_one = True
                 if container.can_add:
@@ -1270,10 +1452,10 @@ class Program(object):
                 f = open(self.args.path, 'w')
                 close_f = True
             writer = csv.writer(f)
-            with self._open_safe() as safe:
-                for container in self._open_containers(safe,
-                        self.args.password if self.args.password
-                                else getpass.getpass('Enter password: ')):
+            password = self._password('Enter password: ')
+            with self._open_safe(allow_readonly=True,
+                                 passwords=[password]) as safe:
+                for container in self._open_containers(safe, password):
                     found_one = True
                     for entry in container.list():
                         rows_written += 1
@@ -1295,15 +1477,42 @@ class Program(object):
         sys.stderr.write("  moved entries into container: %s\n" % (
                 pol.humanize.join([entry[0] for entry in entries])))
     @contextlib.contextmanager
-    def _open_safe(self):
+    def _open_safe(self, allow_readonly=False, passwords=None):
+        """ Opens the safe.  If `allow_readonly' is set, the command does
+            not change the safe and we honour --read-only.
+
+            The `passwords', by default those given on the command line,
+            are stretched while the safe is loaded. """
+        if self.args.read_only and not allow_readonly:
+            sys.stderr.write("Ignoring --read-only: this command "+
+                                "changes the safe.\n")
+        self.readonly = self.args.read_only and allow_readonly
+        if passwords is None:
+            passwords = (getattr(self.args, 'passwords', None)
+                            or filter(None, [getattr(self.args, 'password',
+                                                     None)]))
+        if passwords:
+            self._ensure_keyfiles_are_loaded()
         with pol.safe.open(os.path.expanduser(self.safe_path),
+                           prestretch=passwords,
+                           additional_keys=self.additional_keys,
+                           readonly=self.readonly,
                            nworkers=self.args.workers,
                            use_threads=self.args.threads,
-                           progress=Program._RerandProgress(self)) as safe:
+                           progress=Program._RerandProgress(self),
+                           lock_timeout=self.lock_timeout,
+                           on_lock_wait=self._notify_lock_wait,
+                           **self.rerandomize_options) as safe:
             yield safe
             if not self.do_not_exit_when_closing_safe:
                 self._go_into_background()
 
+    def _notify_lock_wait(self):
+        """ Tells the user that we wait for another pol to release the
+            safe.  Otherwise pol would seem to hang. """
+        sys.stderr.write("Waiting for lock on %s (at most %gs) ...\n" % (
+                            self.safe_path, self.lock_timeout))
+
     def _go_into_background(self):
         """ Tells the parent-process (if any) to exit.  This will return
             the user to the command-line, while we can finish up by
@@ -1347,10 +1556,19 @@ class Program(object):
             with open(keyfile) as f:
                 self.additional_keys.append(f.read())
 
+    def _password(self, prompt):
+        """ Returns the password given on the command line, or asks for it.
+            We ask before the safe is opened, such that the password is
+            stretched while the safe is loaded. """
+        return (self.args.password if self.args.password
+                    else getpass.getpass(prompt))
+
     def _open_containers(self, safe, password):
         self._ensure_keyfiles_are_loaded()
+        # A read-only safe is not stored: moving entries would be in vain.
         return safe.open_containers(password,
                         on_move_append_entries=self._on_move_append_entries,
+                        move_append_entries=not self.readonly,
                         additional_keys=self.additional_keys)
 
     def _handle_uncaught_exception(self):
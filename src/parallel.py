@@ -1,10 +1,17 @@
 """ Extensions to Python's multiprocessing. """
 
+import os
 import time
 import Queue
 import threading
+import traceback
 import multiprocessing
 
+class WorkerError(Exception):
+    """ Raised by `parallel_imap' when a worker raised an exception.  The
+        argument is the traceback of that exception. """
+    pass
+
 def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
                         nworkers=None, progress=None, progress_interval=0.1,
                         initializer=None, use_threads=False):
@@ -27,6 +34,18 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
                         with (args, kwargs) as arguments.  `initializer`
                         may change args, kwargs.
             `use_threads`   specifies to use threads instead of processes. """
+    return list(parallel_imap(func, seq, args, kwargs, chunk_size, nworkers,
+                              progress, progress_interval, initializer,
+                              use_threads))
+
+def parallel_imap(func, seq, args=None, kwargs=None, chunk_size=1,
+                        nworkers=None, progress=None, progress_interval=0.1,
+                        initializer=None, use_threads=False):
+    """ Similar to `parallel_map', but returns an iterator which yields
+        the results in order as soon as they are available.
+
+        If the iterator is closed before it is exhausted, the workers
+        are stopped.  See `parallel_map' for the arguments. """
     # Shortcut for when there is only one chunk:
     if args is None:
         args = ()
@@ -35,9 +54,12 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
     if len(seq) <= chunk_size:
         if initializer is not None:
             initializer(args, kwargs)
-        return  [func(x, *args, **kwargs) for x in seq]
+        for x in seq:
+            yield func(x, *args, **kwargs)
+        return
     # We got more than one chunk --- we will need workers:
-    def worker(c_func, c_args, c_kwargs, c_input, c_output, c_initializer):
+    def worker(c_func, c_args, c_kwargs, c_input, c_output, c_initializer,
+                    c_stop):
         try:
             if c_initializer is not None:
                 c_initializer(c_args, c_kwargs)
@@ -45,6 +67,10 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
                 p = c_input.get()
                 if p is None:
                     break
+                if c_stop.is_set():
+                    # We are asked to stop.  We skip the remaining chunks
+                    # until we see our sentinel.
+                    continue
                 i, xs = p
                 ys = []
                 for x in xs:
@@ -52,6 +78,13 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
                 c_output.put((i, ys))
         except KeyboardInterrupt:
             pass
+        except Exception:
+            # Without this, we would wait forever for the chunk.
+            c_output.put((None, traceback.format_exc()))
+            # Consume the remaining chunks up to our sentinel.  Otherwise
+            # the feeder thread of the parent might block on a full pipe.
+            while c_input.get() is not None:
+                pass
     if nworkers is None:
         nworkers = multiprocessing.cpu_count()
     p_input = multiprocessing.Queue()
@@ -59,12 +92,16 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
     processes = []
     N = len(seq)
     n = 0
-    ret = [None]*N
+    # Chunks that arrived before the chunks preceding them
+    pending = {}
+    next_i = 0
     constr = threading.Thread if use_threads else multiprocessing.Process
+    p_stop = (threading.Event() if use_threads else multiprocessing.Event())
     try:
         for i in xrange(nworkers):
             process = constr(target=worker, args=(func, args, kwargs, p_output,
-                                                    p_input, initializer))
+                                                    p_input, initializer,
+                                                    p_stop))
             processes.append(process)
             process.start()
         # Add the elements to be mapped to the queue
@@ -78,16 +115,45 @@ def parallel_map(func, seq, args=None, kwargs=None, chunk_size=1,
                             if progress else float('inf'))
         while n < N:
             i, ys = p_input.get()
-            ret[i:i+len(ys)] = ys
+            if i is None:
+                raise WorkerError(ys)
+            pending[i] = ys
             n += len(ys)
             if time.time() > next_update:
                 next_update = time.time() + progress_interval
                 progress(n)
+            while next_i in pending:
+                ys = pending.pop(next_i)
+                next_i += len(ys)
+                for y in ys:
+                    yield y
     except KeyboardInterrupt:
         for process in processes:
             process.terminate()
         raise
-    return ret
+    finally:
+        if n < N:
+            # We have been closed early: tell the workers to stop.
+            p_stop.set()
+            _stop_workers(processes, p_input)
+        else:
+            # The workers have seen their sentinels and are exiting.
+            for process in processes:
+                process.join()
+
+def _stop_workers(processes, p_input):
+    """ Waits for the workers of `parallel_imap' that have been asked to
+        stop.  They skip the remaining chunks, but finish the one they are
+        working on.  We discard those results: if we would leave them in
+        the queue, its feeder thread would block and we would hang on
+        exit. """
+    while any(process.is_alive() for process in processes):
+        try:
+            p_input.get(timeout=0.05)
+        except Queue.Empty:
+            pass
+    for process in processes:
+        process.join()
 
 def parallel_try(func, args=None, kwargs=None, nworkers=None, progress=None,
                         progress_interval=0.1, update_interval=0.05,
@@ -172,3 +238,94 @@ def parallel_try(func, args=None, kwargs=None, nworkers=None, progress=None,
             process.terminate()
         raise
     return p_input.get()
+
+class BackgroundMap(object):
+    """ Maps `func' over `seq' in a single worker in the background,
+        until it is done or `stop' is called.  The worker process runs
+        with the lowest priority.
+
+            `chunk_size`    number of elements the worker maps before it
+                        checks whether it should stop
+            `initializer`   called in the worker with (args, kwargs) as
+                        arguments.  See `parallel_map'.
+            `use_threads`   specifies to use a thread instead of a process.
+    """
+    def __init__(self, func, seq, args=None, kwargs=None, chunk_size=8,
+                        initializer=None, use_threads=False):
+        self.func = func
+        self.seq = seq
+        self.args = () if args is None else args
+        self.kwargs = {} if kwargs is None else kwargs
+        self.chunk_size = chunk_size
+        self.initializer = initializer
+        self.use_threads = use_threads
+        self._worker = None
+
+    @staticmethod
+    def _work(c_func, c_seq, c_args, c_kwargs, c_chunk_size, c_initializer,
+                    c_output, c_stop, c_nice):
+        try:
+            if c_nice:
+                try:
+                    os.nice(19)
+                except OSError:
+                    pass
+            if c_initializer is not None:
+                c_initializer(c_args, c_kwargs)
+            for i in xrange(0, len(c_seq), c_chunk_size):
+                if c_stop.is_set():
+                    break
+                c_output.put((i, [c_func(x, *c_args, **c_kwargs)
+                                    for x in c_seq[i:i+c_chunk_size]]))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            c_output.put(None)
+
+    def start(self):
+        """ Starts the worker """
+        assert self._worker is None
+        if self.use_threads:
+            self._output = Queue.Queue()
+            self._stop = threading.Event()
+            constr = threading.Thread
+        else:
+            self._output = multiprocessing.Queue()
+            self._stop = multiprocessing.Event()
+            constr = multiprocessing.Process
+        self._worker = constr(target=BackgroundMap._work,
+                              args=(self.func, self.seq, self.args,
+                                    self.kwargs, self.chunk_size,
+                                    self.initializer, self._output,
+                                    self._stop, not self.use_threads))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def stop(self):
+        """ Stops the worker.  Returns a dictionary that maps the index of
+            every element of `seq' that was mapped to its image. """
+        ret = {}
+        if self._worker is None:
+            return ret
+        self._stop.set()
+        died = False
+        while True:
+            try:
+                p = self._output.get(timeout=0.1)
+            except Queue.Empty:
+                if self._worker.is_alive():
+                    continue
+                # The worker died without sending its sentinel.  Its last
+                # results might still be underway.
+                if died:
+                    break
+                died = True
+                continue
+            if p is None:
+                break
+            i, ys = p
+            for j, y in enumerate(ys):
+                ret[i + j] = y
+        self._worker.join()
+        self._worker = None
+        return ret
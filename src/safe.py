@@ -1,30 +1,39 @@
 """ Implementation of pol safes.  See `Safe`. """
 
 import os
-import shutil
+import mmap
 import time
+import errno
 import struct
 import logging
 import os.path
 import weakref
 import binascii
 import tempfile
+import threading
 import contextlib
 import collections
 import multiprocessing
 
 import pol.serialization
 import pol.blockcipher
+import pol.blockstore
+import pol.gppool
 import pol.parallel
 import pol.envelope
 import pol.xrandom
 import pol.elgamal
+import pol.ecelgamal
 import pol.ks
 import pol.kd
 
 import lockfile
 import msgpack
-import gmpy
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # TODO Generating random numbers seems CPU-bound.  Does the default random
 #      generator wait for a certain amount of entropy?
@@ -34,6 +43,30 @@ import Crypto.Random.random as random
 l = logging.getLogger(__name__)
 
 SAFE_MAGIC = 'pol\n' + binascii.unhexlify('d163d4977a2cf681ad9a6cfe98ab')
+# Magic of a safe of version 2, which stores its blocks in fixed-width
+# records.  See doc/FORMAT.md.
+SAFE_MAGIC_V2 = 'pol\n' + binascii.unhexlify('0cffd3b2ddb1596fa4500ccc4f28')
+
+# Size of the header and of the rerandomize-offset of a safe of version 2
+_V2_INT_STRUCT = struct.Struct('>I')
+
+# The maximum number of base keys of which we cache the derived keys.
+# See `ElGamalSafe.KeyContext'.
+KEY_CONTEXT_CACHE_SIZE = 16
+
+# Interval in seconds in which `open' polls for the lock on a safe
+LOCK_POLL_INTERVAL = 0.05
+
+# A request to stop rerandomizing is ignored if it has not been renewed
+# for this many seconds.  See `_request_preemption'.
+PREEMPTION_REQUEST_TIMEOUT = 5
+
+# Size of the buffer of the file to which `_store_safe' writes.  The safe
+# is written block by block.
+STORE_BUFFER_SIZE = 1024 * 1024
+
+# The length of the marker of a block.  See `ElGamalSafe.KeyContext'.
+MARKER_SIZE = 32
 
 class MissingKey(ValueError):
     pass
@@ -64,7 +97,8 @@ def create(path, override=False, *args, **kwargs):
     """ Generates a new safe.
 
         Contrary to `Safe.generate', this function also takes care
-        of locking. """
+        of locking.  The safe is written when the context is left.  Until
+        then, a safe that is overridden is left untouched. """
     locked = False
     try:
         lock = lockfile.FileLock(path)
@@ -72,10 +106,9 @@ def create(path, override=False, *args, **kwargs):
         locked = True
         if os.path.exists(path) and not override:
             raise SafeAlreadyExistsError
-        with _builtin_open(path, 'w') as f:
-            safe = Safe.generate(*args, **kwargs)
-            yield safe
-            safe.store_to_stream(f)
+        safe = Safe.generate(*args, **kwargs)
+        yield safe
+        _store_safe(safe, path)
     except lockfile.AlreadyLocked:
         raise SafeLocked
     finally:
@@ -86,37 +119,270 @@ _builtin_open = open
 
 @contextlib.contextmanager
 def open(path, readonly=False, progress=None, nworkers=None, use_threads=False,
-                    always_rerandomize=True):
+                    always_rerandomize=True, rerandomize_nworkers=None,
+                    nice=None, max_duration=None, checkpoint_interval=None,
+                    lock_timeout=0, on_lock_wait=None, prestretch=None,
+                    additional_keys=None):
     """ Loads a safe from the filesystem.
 
         Contrary to `Safe.load_from_stream', this function also takes care
-        of locking. """
-    # TODO Allow multiple readers.
+        of locking.  If the safe is locked, we wait at most `lock_timeout'
+        seconds.  In the meantime, we ask the process that holds the lock
+        to stop rerandomizing: we will rerandomize ourselves.  If we have
+        to wait, `on_lock_wait' is called once before we do.
+
+        When the safe is closed, it is rerandomized with
+        `rerandomize_nworkers' (or `nworkers') workers.  See
+        `ElGamalSafe.rerandomize' for `nice', `max_duration' and
+        `checkpoint_interval'.
+
+        A `readonly' safe is neither rerandomized nor stored.  Thus we do
+        not take the lock: any number of readers can load the safe, also
+        while another process holds the lock.  They get the last safe that
+        was stored.  (Without `fcntl', readers take the lock as well.)
+
+        The passwords in `prestretch' (composed with `additional_keys')
+        are stretched in the background as soon as the safe is loaded,
+        while we prepare the safe for encryption and rerandomization. """
+    shared = readonly and fcntl is not None
     locked = False
     try:
-        lock = lockfile.FileLock(path)
-        lock.acquire(0)
-        locked = True
+        if not shared:
+            lock = _acquire_lock(path, lock_timeout, on_lock_wait)
+            locked = True
         if not os.path.exists(path):
             raise SafeNotFoundError
-        with _builtin_open(path) as f:
+        with (_open_committed(path) if shared
+                    else _builtin_open(path)) as f:
             safe = Safe.load_from_stream(f, nworkers, use_threads)
-        yield safe
+        if not readonly and always_rerandomize:
+            # Precompute for `rerandomize' while we wait for the user.
+            safe.start_rerandomization_pool()
+        # We start the thread after forking the pool's worker.
+        if prestretch:
+            safe.prestretch(prestretch, additional_keys, wait=False)
         if not readonly:
-            safe.autosave_containers()
-            if safe.touched or always_rerandomize:
-                safe.rerandomize(progress=progress,
-                                 nworkers=nworkers,
-                                 use_threads=use_threads)
-                with tempfile.NamedTemporaryFile(delete=False) as f:
-                    safe.store_to_stream(f)
-                    shutil.move(f.name, path)
+            safe._precompute()
+        try:
+            yield safe
+            # No thread should run when the workers are forked.
+            safe._wait_for_prestretch()
+            if not readonly:
+                safe.autosave_containers()
+                if safe.touched or always_rerandomize:
+                    # We store the safe while we rerandomize it.
+                    _store_safe(safe, path, lambda f: safe.rerandomize(
+                                     progress=progress,
+                                     nworkers=(rerandomize_nworkers
+                                                    or nworkers),
+                                     use_threads=use_threads,
+                                     nice=nice, max_duration=max_duration,
+                                     checkpoint=lambda: _store_safe(safe,
+                                                                    path),
+                                     checkpoint_interval=checkpoint_interval,
+                                     stop=_preemption_check(safe, path),
+                                     stream=f))
+        finally:
+            safe.stop_rerandomization_pool()
     except lockfile.AlreadyLocked:
         raise SafeLocked
     finally:
         if locked:
             lock.release()
 
+def _acquire_lock(path, timeout, on_wait=None):
+    """ Acquires the lock on the safe at `path' and returns it.  Waits at
+        most `timeout' seconds and meanwhile requests preemption.  Calls
+        `on_wait' when it starts to wait. """
+    lock = lockfile.FileLock(path)
+    deadline = time.time() + timeout
+    requested = False
+    try:
+        while True:
+            try:
+                lock.acquire(0)
+                return lock
+            except lockfile.AlreadyLocked:
+                if time.time() >= deadline:
+                    raise
+            if not requested:
+                l.info("%s is locked; waiting ...", path)
+                if on_wait is not None:
+                    on_wait()
+            _request_preemption(path)
+            requested = True
+            time.sleep(LOCK_POLL_INTERVAL)
+    finally:
+        if requested:
+            _withdraw_preemption_request(path)
+
+def _preemption_request_path(path):
+    return path + '.preempt'
+
+def _request_preemption(path):
+    """ Asks the process that has locked the safe at `path' to stop
+        rerandomizing.  The request is renewed by touching a file, such
+        that a request left behind by a killed process is ignored after
+        `PREEMPTION_REQUEST_TIMEOUT' seconds. """
+    request_path = _preemption_request_path(path)
+    try:
+        with _builtin_open(request_path, 'a'):
+            pass
+        os.utime(request_path, None)
+    except (IOError, OSError) as e:
+        l.debug("Failed to request preemption: %s", e)
+
+def _preemption_requested(path):
+    """ Returns whether another process waits for the safe at `path'. """
+    try:
+        mtime = os.stat(_preemption_request_path(path)).st_mtime
+    except OSError:
+        return False
+    return time.time() - mtime < PREEMPTION_REQUEST_TIMEOUT
+
+def _preemption_check(safe, path):
+    """ Returns the `stop' argument of `rerandomize' for `safe'.
+
+        We only give way to a waiting process if the safe is untouched:
+        otherwise the blocks we changed would stand out against blocks that
+        are not rerandomized. """
+    if safe.touched:
+        return None
+    return lambda: _preemption_requested(path)
+
+def _withdraw_preemption_request(path):
+    try:
+        os.unlink(_preemption_request_path(path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            l.debug("Failed to withdraw preemption request: %s", e)
+
+@contextlib.contextmanager
+def _commit_lock(path, exclusive):
+    """ Holds a `fcntl' lock on the safe file at `path' itself.  A
+        process that replaces the safe holds it exclusively, and a reader
+        that does not hold the lockfile takes it shared before it loads
+        the safe.  See `_open_committed'.
+
+        Without `fcntl', or if there is no safe yet, we do nothing: a safe
+        is replaced by a single rename anyway. """
+    fd = None
+    if fcntl is not None:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                l.debug("Failed to open %s: %s", path, e)
+    try:
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        if fd is not None:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+def _open_committed(path):
+    """ Opens the safe at `path' for a reader that does not hold the
+        lockfile.  We wait for a safe that is being replaced and return
+        the new one.
+
+        A stored safe is never changed in place, so we only need the
+        shared `fcntl' lock to see whether the file we opened is still
+        the safe.  We do not keep it: a safe that is mapped into memory
+        keeps its file open. """
+    while True:
+        f = _builtin_open(path)
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            current = os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        except:
+            f.close()
+            raise
+        if current:
+            return f
+        f.close()
+
+def _store_safe(safe, path, store=None):
+    """ Atomically replaces the safe at `path' by `safe'.  When we return,
+        the new safe is on disk.  `store' is called with the file to
+        write to and defaults to `safe.store_to_stream'. """
+    if store is None:
+        store = safe.store_to_stream
+    directory = os.path.dirname(os.path.abspath(path))
+    f = tempfile.NamedTemporaryFile(dir=directory, delete=False,
+                                    bufsize=STORE_BUFFER_SIZE)
+    try:
+        with f:
+            store(f)
+            f.flush()
+            os.fsync(f.fileno())
+        with _commit_lock(path, exclusive=True):
+            os.rename(f.name, path)
+    except:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+    # Make sure the rename itself is on disk.
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _unpack_v2(stream):
+    """ Reads the rest of a safe of version 2 from `stream'.  Returns its
+        attributes with the blocks in a `pol.blockstore.BlockStore'.
+
+        If `stream' is a file, we map it into memory instead of reading
+        the blocks: they are read from disk when they are used. """
+    header_size = _V2_INT_STRUCT.unpack(_read_exactly(stream,
+                                            _V2_INT_STRUCT.size))[0]
+    try:
+        data = msgpack.unpackb(_read_exactly(stream, header_size),
+                               use_list=True)
+    except (msgpack.UnpackValueError, msgpack.ExtraData, ValueError):
+        raise SafeFormatError("Invalid header")
+    if not isinstance(data, dict):
+        raise SafeFormatError("Invalid header")
+    for attr in ('n-blocks', 'block-widths'):
+        if attr not in data:
+            raise SafeFormatError("Missing attr `%s'" % attr)
+    n, widths = data['n-blocks'], data.pop('block-widths')
+    if not isinstance(n, int) or n < 0:
+        raise SafeFormatError("`n-blocks' invalid")
+    if (not isinstance(widths, list) or len(widths) != 4 or not all(
+            isinstance(w, int) and 0 < w < 2**16 for w in widths)):
+        raise SafeFormatError("`block-widths' invalid")
+    size = pol.blockstore.BlockStore.nbytes(n, widths)
+    try:
+        fileno = stream.fileno()
+    except AttributeError:
+        fileno = None
+    if fileno is not None:
+        offset = stream.tell()
+        buf = mmap.mmap(fileno, 0, access=mmap.ACCESS_COPY)
+    else:
+        offset = 0
+        buf = bytearray(stream.read(size + _V2_INT_STRUCT.size + 1))
+    if len(buf) != offset + size + _V2_INT_STRUCT.size:
+        raise SafeFormatError("Size of the blocks does not match "+
+                              "`n-blocks'")
+    rerandomize_offset = _V2_INT_STRUCT.unpack_from(buf, offset + size)[0]
+    if rerandomize_offset:
+        data['rerandomize-offset'] = rerandomize_offset
+    data['blocks'] = pol.blockstore.BlockStore(n, widths, buf, offset)
+    return data
+
+def _read_exactly(stream, size):
+    ret = stream.read(size)
+    if len(ret) != size:
+        raise SafeFormatError("Unexpected end of safe")
+    return ret
+
 class Safe(object):
     """ A pol safe deniably stores containers. (Containers store secrets.) """
 
@@ -158,9 +424,12 @@ class Safe(object):
         start_time = time.time()
         l.debug('Unpacking ...')
         magic = stream.read(len(SAFE_MAGIC))
-        if magic != SAFE_MAGIC:
+        if magic == SAFE_MAGIC:
+            data = msgpack.unpack(stream, use_list=True)
+        elif magic == SAFE_MAGIC_V2:
+            data = _unpack_v2(stream)
+        else:
             raise WrongMagicError
-        data = msgpack.unpack(stream, use_list=True)
         l.debug(' unpacked in %.2fs', time.time() - start_time)
         if ('type' not in data or not isinstance(data['type'], basestring)
                 or data['type'] not in TYPE_MAP):
@@ -177,6 +446,13 @@ class Safe(object):
         """ Create a new container. """
         raise NotImplementedError
 
+    def new_containers(self, passwords, trash_freespace=False):
+        """ Create a new container for every triple (password,
+            list_password, append_password) in `passwords'.  If
+            `trash_freespace' is set, write random data to the free
+            space that remains. """
+        raise NotImplementedError
+
     def open_containers(self, password, additional_keys=[]):
         """ Opens a container.
 
@@ -188,6 +464,28 @@ class Safe(object):
         """ Rerandomizes the safe. """
         raise NotImplementedError
 
+    def prestretch(self, passwords, additional_keys=None, wait=True):
+        """ Stretches `passwords' ahead of `open_containers', concurrently.
+            If `wait' is False, in the background. """
+        pass
+
+    def _wait_for_prestretch(self):
+        """ Waits for the background stretching of `prestretch'. """
+        pass
+
+    def _precompute(self):
+        """ Computes what the safe needs to encrypt and rerandomize. """
+        pass
+
+    def start_rerandomization_pool(self):
+        """ Starts to precompute for `rerandomize' in the background. """
+        pass
+
+    def stop_rerandomization_pool(self):
+        """ Stops the precomputation started by `start_rerandomization_pool'.
+            """
+        pass
+
     def trash_freespace(self):
         """ Writes random data to the free space """
         raise NotImplementedError
@@ -262,6 +560,28 @@ AS_FULL = 0         # the access slice gives full access
 AS_LIST = 1         # the access slice gives list-only access
 AS_APPEND = 2       # the access slice gives append-only access
 
+# Minimal number of blocks handed to a worker at once by `_find_slices'
+SCAN_CHUNK_SIZE = 256
+
+# Minimal number of blocks of a slice decrypted by a worker at once.  The
+# blocks of smaller slices are decrypted in-process: forking workers
+# costs more than the modular inversions it spreads.
+LOAD_BATCH_SIZE = 8
+
+# Size in bytes of the private keys and random exponents of a new
+# `elgamal-q' safe
+EXPONENT_SIZE = 32
+
+# The curve of a new `elgamal-ec' safe and the size in bytes of its
+# exponents: the largest that are smaller than the order of the curve.
+EC_CURVE = 'secp256r1'
+EC_EXPONENT_SIZE = 31
+
+# Number of points per block of a new `elgamal-ec' safe.  A point holds
+# 30 bytes, thus a block holds 240 bytes: a multiple of the block size
+# of every cipher.
+EC_POINTS_PER_BLOCK = 8
+
 MAIN_SLICE_MAGIC = binascii.unhexlify('33653efc')
 APPEND_SLICE_MAGIC = binascii.unhexlify('2d5039ba')
 
@@ -278,6 +598,9 @@ KD_APPEND  = binascii.unhexlify('76001c344cbd9e73a6b5bd48b67266d9')
 class ElGamalSafe(Safe):
     """ Default implementation using rerandomization of ElGamal. """
 
+    # Whether a new safe needs group parameters; see pol.gppool.
+    uses_group_params = True
+
     class MainEntry(Entry):
         def __init__(self, container, index):
             self.container = container
@@ -391,6 +714,8 @@ class ElGamalSafe(Safe):
                 self.append_data = append_data
                 self.secret_data = secret_data
                 self.append_data_updates = {}
+                # Maps a sealed append entry to the opened entry
+                self._opened_append_entries = {}
                 self.autosave = autosave
             else:
                 # We are combining
@@ -412,16 +737,27 @@ class ElGamalSafe(Safe):
             if self.autosave and self.unsaved_changes:
                 self.save()
 
+        def _open_append_entries(self, raw_entries):
+            """ Returns the opened append entries for the sealed
+                entries `raw_entries'.  They are opened in one batch. """
+            todo = [raw_entry for raw_entry in set(raw_entries)
+                        if raw_entry not in self._opened_append_entries]
+            if todo:
+                for raw_entry, pt in zip(todo, self.safe.envelope.open_many(
+                                        todo, self.secret_data.privkey)):
+                    self._opened_append_entries[raw_entry] = \
+                            pol.serialization.string_to_son(pt)
+            return [self._opened_append_entries[raw_entry]
+                        for raw_entry in raw_entries]
+
         def _move_append_entries(self, on_move_append_entries):
             if not self.secret_data:
                 raise MissingKey
             if not self.append_data.entries:
                 return
-            new_entries = []
-            for raw_entry in self.append_data.entries:
-                new_entries.append(pol.serialization.string_to_son(
-                             self.safe.envelope.open(raw_entry,
-                                                self.secret_data.privkey)))
+            new_entries = self._open_append_entries(
+                                self.append_data.entries)
+            self._opened_append_entries = {}
             if on_move_append_entries:
                 on_move_append_entries(new_entries)
             self.append_data = self.append_data._replace(entries=[])
@@ -433,6 +769,14 @@ class ElGamalSafe(Safe):
         def save(self, randfunc=None, annex=False):
             if randfunc is None:
                 randfunc = Crypto.Random.new().read
+            self.safe._store_slices(self._save_jobs(randfunc), randfunc,
+                                    annex)
+            self.unsaved_changes = False
+
+        def _save_jobs(self, randfunc):
+            """ Returns the jobs for `ElGamalSafe._store_slices' that
+                save this container. """
+            jobs = []
             # Update secrets ciphertext
             if self.secret_data:
                 assert self.full_key and self.main_data
@@ -457,36 +801,41 @@ class ElGamalSafe(Safe):
                                         self.main_data.entries))
                 # Serialize and store
                 main_pt = pol.serialization.son_to_string(main_data)
-                self.main_slice.store(self.list_key, main_pt, annex=annex)
+                jobs.append((self.main_slice, self.list_key, main_pt))
             # Write append slice
             if self.append_data:
                 assert self.append_key and self.append_slice
-                # First apply pending updates
-                for index, entry in self.append_data_updates.iteritems():
+                # First apply pending updates.  We seal the updated
+                # entries in one batch.
+                updates = sorted(self.append_data_updates.iteritems())
+                for index, entry in updates:
                     if entry is None:
                         self.append_data.entries[index] = None
-                    else:
-                        self.append_data.entries[index] = self.safe.envelope.seal(
-                                    pol.serialization.son_to_string(entry),
-                                    self.append_data.pubkey)
+                updates = [(index, entry) for index, entry in updates
+                                if entry is not None]
+                for (index, entry), raw_entry in zip(updates,
+                            self.safe.envelope.seal_many(
+                                [pol.serialization.son_to_string(entry)
+                                    for index, entry in updates],
+                                self.append_data.pubkey)):
+                    self.append_data.entries[index] = raw_entry
                 # Then, filter entries marked for deletion
                 append_data = self.append_data._replace(
                         entries=filter(lambda x: x is not None,
                                         self.append_data.entries))
                 # Serialize and store
                 append_pt = pol.serialization.son_to_string(append_data)
-                self.append_slice.store(self.append_key, append_pt, annex=annex)
-            self.unsaved_changes = False
+                jobs.append((self.append_slice, self.append_key, append_pt))
+            return jobs
 
         def get_by_id(self, identifier):
             kind, i = identifier
             if kind == 'm':
                 return ElGamalSafe.MainEntry(self, i)
             assert kind == 'a'
-            return ElGamalSafe.AppendEntry(self, i, 
-                                *self.safe.envelope.open(
-                                        self.append_data.entries[i],
-                                        self.secret_data.privkey))
+            return ElGamalSafe.AppendEntry(self, i,
+                                *self._open_append_entries(
+                                        [self.append_data.entries[i]])[0])
 
         def list_ids(self):
             if not self.main_data:
@@ -509,12 +858,13 @@ class ElGamalSafe(Safe):
                 if entry is None:
                     continue
                 ret.append(ElGamalSafe.MainEntry(self, i))
-            # TODO cache?
             if self.secret_data and self.append_data:
-                for i, raw_entry in enumerate(self.append_data.entries):
-                    ret.append(ElGamalSafe.AppendEntry(self, i,
-                                *self.safe.envelope.open(raw_entry,
-                                        self.secret_data.privkey)))
+                indices = [i for i, raw_entry
+                                in enumerate(self.append_data.entries)
+                                if raw_entry is not None]
+                for i, entry in zip(indices, self._open_append_entries(
+                            [self.append_data.entries[i] for i in indices])):
+                    ret.append(ElGamalSafe.AppendEntry(self, i, *entry))
             return ret
 
         def get(self, key):
@@ -527,12 +877,11 @@ class ElGamalSafe(Safe):
                     continue
                 yield ElGamalSafe.MainEntry(self, i)
             if self.secret_data and self.append_data:
-                for i, raw_entry in enumerate(self.append_data.entries):
-                    if raw_entry is None:
-                        continue
-                    entry = pol.serialization.string_to_son(
-                                self.safe.envelope.open(raw_entry,
-                                            self.secret_data.privkey))
+                indices = [i for i, raw_entry
+                                in enumerate(self.append_data.entries)
+                                if raw_entry is not None]
+                for i, entry in zip(indices, self._open_append_entries(
+                            [self.append_data.entries[i] for i in indices])):
                     if entry[0] != key:
                         continue
                     yield ElGamalSafe.AppendEntry(self, i, *entry)
@@ -576,6 +925,8 @@ class ElGamalSafe(Safe):
             key = randfunc(self.safe.kd.size)
             pt = randfunc(self.size)
             self.store(key, pt, randfunc, annex=True)
+            # The key is thrown away.  There is no use in caching it.
+            self.safe._forget_key(key)
         @property
         def first_index(self):
             return self.indices[0]
@@ -592,76 +943,92 @@ class ElGamalSafe(Safe):
 
         def store(self, key, value, randfunc=None, annex=False):
             """ Stores `value' in the slice """
-            if randfunc is None:
-                randfunc = Crypto.Random.new().read
+            self.safe._store_slices([(self, key, value)], randfunc, annex)
+
+        def _ciphertext(self, key, value, randfunc):
+            """ Returns the ciphertext of the blocks of this slice when
+                it stores `value' with `key'. """
             bpb = self.safe.bytes_per_block
             # First, get the full length plaintext string
             total_size = self.size
             if len(value) > total_size:
                 raise ValueError("`value' too large")
-            time_started = time.time()
-            l.debug('Slice.store: storing @%s; %s blocks; %s/%sB',
-                    self.indices[0], len(self.indices), len(value),
-                    total_size)
             # Secondly, generate an IV and get a cipherstream
             iv = randfunc(self.safe.cipher.blocksize)
             cipher = self.safe._cipherstream(key, iv)
-            # Thirdly, prepare the ciphertext
+            # Finally, prepare the ciphertext
             plaintext = (self.safe._index_to_bytes(len(self.indices))
                           + ''.join([self.safe._index_to_bytes(index)
                                       for index in self.indices[1:]])
                           + self.safe._slice_size_to_bytes(len(value))
                           + value).ljust(bpb * len(self.indices), '\0')
-            ciphertext = (self.safe.kd([self.safe._cipherstream_key(key)],
-                                        length=self.safe.cipher.blocksize)
+            return (self.safe._key_context(key).symmkey_hash
                                 + iv
                                 + cipher.encrypt(plaintext))
-            # Finally, write the blocks
-            for index, raw_block in pol.parallel.parallel_map(
-                    self._store_block,
-                    [(ciphertext[bpb*indexindex:bpb*(indexindex+1)], index)
-                        for indexindex, index in enumerate(self.indices)],
-                    args=(key, annex),
-                    initializer=self._store_block_initializer,
-                    nworkers=self.safe.nworkers,
-                    use_threads=self.safe.use_threads,
-                    chunk_size=8):
-                if raw_block is None:
-                    raise WrongKeyError
-                self.safe._write_block(index, raw_block)
-            self._value = value
-            duration = time.time() - time_started
-            l.debug('Slice.store:  ... done in %.3f (%.1f block/s)',
-                        duration, len(self.indices) / duration)
-            self.safe.touch()
 
-        def _store_block(self, ct_index, key, annex, randfunc):
-            try:
-                ct, index = ct_index
-                return index, self.safe._eg_encrypt_block(key, index, ct,
-                                                randfunc, annex=annex)
-            except WrongKeyError:
-                # TODO it would  be prettier if parallel_map passes the
-                #      exception
-                return index, None
-        def _store_block_initializer(self, args, kwargs):
-            Crypto.Random.atfork()
-            kwargs['randfunc'] = Crypto.Random.new().read
+    class KeyContext(object):
+        """ Caches everything that is derived from a single base key:
+            the key of the cipherstream, its hash and the markers and
+            private keys of the blocks. """
+        def __init__(self, safe, key):
+            self.safe = safe
+            self.cipherstream_key = safe.kd([key, KD_SYMM],
+                                            length=safe.cipher.keysize)
+            self.symmkey_hash = safe.kd([self.cipherstream_key],
+                                        length=safe.cipher.blocksize)
+            self._marker_kd = safe.kd.prefixed([key, KD_MARKER])
+            self._privkey_kd = safe.kd.prefixed([key, KD_ELGAMAL])
+            self._markers = {}
+            self._privkeys = {}
+
+        def marker(self, index):
+            """ Returns the marker of block `index' """
+            ret = self._markers.get(index)
+            if ret is None:
+                ret = self._marker_kd([self.safe._index_to_bytes(index)],
+                                      length=MARKER_SIZE)
+                self._markers[index] = ret
+            return ret
+
+        def privkey(self, index):
+            """ Returns the elgamal private key for block `index' """
+            ret = self._privkeys.get(index)
+            if ret is None:
+                # TODO is it safe to reduce the size of privkey by this much?
+                ret = self.safe._privkey_from_string(
+                        self._privkey_kd([self.safe._index_to_bytes(index)],
+                                         length=self.safe.privkey_size))
+                self._privkeys[index] = ret
+            return ret
 
     def __init__(self, data, nworkers, use_threads):
         super(ElGamalSafe, self).__init__(data, nworkers, use_threads)
+        # maps a base key to its KeyContext, least recently used first
+        self._key_contexts = collections.OrderedDict()
+        # Guards `_key_contexts': with `use_threads', the workers that
+        # scan and load blocks look up the KeyContext concurrently.
+        self._key_contexts_lock = threading.Lock()
+        # maps a composite password to its stretched key; see `prestretch'
+        self._prestretched = {}
+        self._prestretch_thread = None
+        # see `gexp'
+        self._gexp = None
+        # see `start_rerandomization_pool'
+        self._rerandomization_pool = None
+        self._rerandomization_pool_order = None
+        self.rerandomization_stats = None
         # maps first index of mainslice and/or appendslice to
         # a wealref to an already opened Container.
         self._opened_containers = {}
         # Check if `data' makes sense.
         self.free_blocks = set([])
-        for attr in ('group-params', 'n-blocks', 'blocks', 'block-index-size',
-                            'slice-size'):
+        for attr in ('n-blocks', 'blocks', 'block-index-size', 'slice-size'):
             if not attr in data:
                 raise SafeFormatError("Missing attr `%s'" % attr)
-        for attr, _type in {'blocks': list,
-                            'group-params': list,
-                            'block-index-size': int,
+        if not isinstance(data['blocks'], (list,
+                                           pol.blockstore.BlockStore)):
+            raise SafeFormatError("`blocks' should be a `%s'" % list)
+        for attr, _type in {'block-index-size': int,
                             'slice-size': int,
                             'bytes-per-block': int,
                             'n-blocks': int}.iteritems():
@@ -669,12 +1036,10 @@ class ElGamalSafe(Safe):
                 raise SafeFormatError("`%s' should be a `%s'" % (attr, _type))
         if not len(data['blocks']) == data['n-blocks']:
             raise SafeFormatError("Amount of blocks isn't `n-blocks'")
-        if not len(data['group-params']) == 2:
-            raise SafeFormatError("`group-params' should contain 2 elements")
-        # TODO Should we check whether the group parameters are safe?
-        for x in data['group-params']:
-            if not isinstance(x, basestring):
-                raise SafeFormatError("`group-params' should contain strings")
+        if 'rerandomize-offset' in data and (
+                not isinstance(data['rerandomize-offset'], int)
+                or not 0 <= data['rerandomize-offset'] < data['n-blocks']):
+            raise SafeFormatError("`rerandomize-offset' invalid")
         if data['slice-size'] == 2:
             self._slice_size_struct = struct.Struct('>H')
         elif data['slice-size'] == 4:
@@ -689,54 +1054,117 @@ class ElGamalSafe(Safe):
             self._block_index_struct = struct.Struct('>I')
         else:
             raise SafeFormatError("`block-index-size' invalid")
+        self._setup_group(data)
+        self._setup_blocks(data)
+
+    def _setup_group(self, data):
+        """ Checks and sets up the group from the attributes in `data' """
+        if not 'group-params' in data:
+            raise SafeFormatError("Missing attr `group-params'")
+        if not isinstance(data['group-params'], list):
+            raise SafeFormatError("`group-params' should be a `%s'" % list)
+        if not len(data['group-params']) == 2:
+            raise SafeFormatError("`group-params' should contain 2 elements")
+        # TODO Should we check whether the group parameters are safe?
+        for x in data['group-params']:
+            if not isinstance(x, basestring):
+                raise SafeFormatError("`group-params' should contain strings")
+        self._group_params = pol.elgamal.group_parameters(
+                    *[pol.serialization.string_to_number(x)
+                        for x in data['group-params']])
         if 2** (data['bytes-per-block']*8) >= self.group_params.p:
             raise SafeFormatError("`bytes-per-block' larger than "+
                                   "`group-params' allow")
-    @staticmethod
-    def generate(n_blocks=1024, block_index_size=2, slice_size=4,
+
+    def _block_widths(self):
+        """ Returns the largest sizes of c1, c2, the public key and the
+            marker of a block. """
+        width = len(pol.serialization.number_to_string(self.group_params.p))
+        return [width, width, width, MARKER_SIZE]
+
+    def _setup_blocks(self, data):
+        """ Checks the blocks in `data' and replaces them by a
+            `pol.blockstore.BlockStore'. """
+        widths = self._block_widths()
+        if isinstance(data['blocks'], pol.blockstore.BlockStore):
+            if any(a < b for a, b in zip(data['blocks'].widths, widths)):
+                raise SafeFormatError("`block-widths' too small")
+            return
+        for block in data['blocks']:
+            if not isinstance(block, list) or len(block) != 4:
+                raise SafeFormatError("A block should be a list of four "+
+                                      "entries")
+            for column, x in enumerate(block):
+                if not isinstance(x, basestring):
+                    raise SafeFormatError("A block should contain strings")
+                if len(x) > widths[column]:
+                    if column < 3:
+                        raise SafeFormatError("A block contains a number "+
+                                              "outside the group")
+                    widths[column] = len(x)
+        data['blocks'] = pol.blockstore.BlockStore.from_list(data['blocks'],
+                                                             widths)
+
+    def store_to_stream(self, stream):
+        """ Stores the Safe to `stream' in the format of version 2. """
+        self._store_blocks_to_stream(stream, xrange(self.nblocks))
+
+    @classmethod
+    def generate(cls, n_blocks=1024, block_index_size=2, slice_size=4,
                     ks=None, kd=None, envelope=None, blockcipher=None,
                     gp_bits=1025, precomputed_gp=False, nworkers=None,
-                    use_threads=False, progress=None):
-        """ Creates a new safe. """
+                    use_threads=False, progress=None,
+                    gp_pool=pol.gppool.DEFAULT_PATH):
+        """ Creates a new safe.
+
+            Unless `precomputed_gp' is set, the group parameters are taken
+            from the pool at `gp_pool' (see pol.gppool), if it has an
+            entry of `gp_bits' bits, and generated otherwise.  Set
+            `gp_pool' to None to always generate them. """
         # TODO check whether block_index_size, slice_size, gp_bits and
         #      n_blocks are sane.
         # First, set the defaults
-        if precomputed_gp:
-            gp = pol.elgamal.precomputed_group_params(gp_bits)
-        else:
-            gp = pol.elgamal.generate_group_params(bits=gp_bits,
-                    nworkers=nworkers, progress=progress,
-                    use_threads=use_threads)
         if ks is None:
             ks = pol.ks.KeyStretching.setup()
         if kd is None:
             kd = pol.kd.KeyDerivation.setup()
         if blockcipher is None:
-            cipher = pol.blockcipher.BlockCipher.setup()
+            blockcipher = pol.blockcipher.BlockCipher.setup()
+        cipher = blockcipher
         if envelope is None:
             envelope = pol.envelope.Envelope.setup()
-        # Now, calculate the useful bytes per block
-        bytes_per_block = (gp_bits - 1) / 8
-        bytes_per_block = bytes_per_block - bytes_per_block % cipher.blocksize
         # Initialize the safe object
-        safe = ElGamalSafe(
-                {'type': 'elgamal',
-                 'n-blocks': n_blocks,
-                 'bytes-per-block': bytes_per_block,
+        data = cls._group_data(cipher, gp_bits, precomputed_gp, nworkers,
+                               use_threads, progress, gp_pool)
+        data.update(
+                {'n-blocks': n_blocks,
                  'block-index-size': block_index_size,
                  'slice-size': slice_size,
-                 'group-params': [pol.serialization.number_to_string(x)
-                                         for x in gp],
                  'key-stretching': ks.params,
                  'key-derivation': kd.params,
                  'envelope': envelope.params,
                  'block-cipher': cipher.params,
-                 'blocks': [['','','',''] for i in xrange(n_blocks)]},
-                        nworkers, use_threads)
+                 'blocks': [['','','',''] for i in xrange(n_blocks)]})
+        safe = cls(data, nworkers, use_threads)
         # Mark all blocks as free
         safe.mark_free(xrange(n_blocks))
         return safe
 
+    @staticmethod
+    def _group_data(cipher, gp_bits, precomputed_gp, nworkers, use_threads,
+                        progress, gp_pool):
+        """ Creates a new group and returns the attributes of a new safe
+            that depend on it. """
+        gp = _new_group_params(gp_bits, precomputed_gp, nworkers,
+                               use_threads, progress, gp_pool)
+        # Calculate the useful bytes per block
+        bytes_per_block = (gp_bits - 1) / 8
+        bytes_per_block = bytes_per_block - bytes_per_block % cipher.alignment
+        return {'type': 'elgamal',
+                'bytes-per-block': bytes_per_block,
+                'group-params': [pol.serialization.number_to_string(x)
+                                        for x in gp]}
+
     def open_containers(self, password, additional_keys=None, autosave=True,
                             move_append_entries=True,
                             on_move_append_entries=None):
@@ -745,8 +1173,7 @@ class ElGamalSafe(Safe):
             If there are entries in the append-slice, `on_move_append_entries'
             will be called with the entries as only argument. """
         l.debug('open_containers: Stretching key')
-        access_key = self.ks(self._composite_password(
-                                    password, additional_keys))
+        access_key = self._stretch(password, additional_keys)
         l.debug('open_containers: Searching for access slice ...')
         for sl in self._find_slices(access_key):
             access_data = access_tuple(*pol.serialization.string_to_son(
@@ -834,13 +1261,53 @@ class ElGamalSafe(Safe):
         The new container is saved directly after creation.  The
         `autosave' argument dictates whether the returned Container
         object should be saved again when the Safe is closed.  """
+        return self.new_containers([(password, list_password,
+                                     append_password)],
+                                   additional_keys, nblocks, randfunc,
+                                   autosave)[0]
+
+    def new_containers(self, passwords, additional_keys=None, nblocks=170,
+                            randfunc=None, autosave=False,
+                            trash_freespace=False):
+        """ Creates a container for every triple (password, list_password,
+            append_password) in `passwords'.  Returns the containers.
+
+            Like `new_container', but all slices are allocated up front
+            and the blocks of all containers are written in a single
+            parallel job.  If `trash_freespace' is set, the free space
+            that remains is trashed in that job as well. """
+        if randfunc is None:
+            randfunc = Crypto.Random.new().read
+        self.prestretch([pw for pws in passwords for pw in pws if pw],
+                        additional_keys)
+        containers = []
+        jobs = []
+        for password, list_password, append_password in passwords:
+            container, container_jobs = self._plan_container(password,
+                        list_password, append_password, additional_keys,
+                        nblocks, randfunc, autosave)
+            containers.append(container)
+            jobs.extend(container_jobs)
+        trash = []
+        if trash_freespace:
+            trash = list(self.free_blocks)
+            self.free_blocks = set()
+        l.debug('new_containers: writing %s slices and %s free blocks',
+                    len(jobs), len(trash))
+        self._store_slices(jobs, randfunc, annex=True, trash=trash)
+        for container in containers:
+            container.unsaved_changes = False
+        return containers
+
+    def _plan_container(self, password, list_password, append_password,
+                            additional_keys, nblocks, randfunc, autosave):
+        """ Allocates the slices for a new container.  Returns the
+            container and the jobs for `_store_slices' that write it. """
         # TODO support access blocks of more than one block in size.
         # TODO check append_slice_size makes sense
         append_slice_size = 5
         append_slice, append_data = None, None
         pubkey, privkey = None, None
-        if randfunc is None:
-            randfunc = Crypto.Random.new().read
         if len(self.free_blocks) < nblocks:
             raise SafeFullError
         # Divide blocks
@@ -868,33 +1335,31 @@ class ElGamalSafe(Safe):
         list_key = self.kd([full_key, KD_LIST])
         append_key = self.kd([list_key, KD_APPEND])
         # Derive keys from passwords
-        as_full_key = self.ks(self._composite_password(
-                                password, additional_keys))
+        as_full_key = self._stretch(password, additional_keys)
         if append_password:
-            as_append_key = self.ks(self._composite_password(
-                                append_password, additional_keys))
+            as_append_key = self._stretch(append_password, additional_keys)
         if list_password:
-            as_list_key = self.ks(self._composite_password(
-                                list_password, additional_keys))
+            as_list_key = self._stretch(list_password, additional_keys)
         # Create access slices
-        l.debug('new_container: creating access slices')
-        as_full.store(as_full_key, pol.serialization.son_to_string(
+        jobs = [(as_full, as_full_key, pol.serialization.son_to_string(
                     access_tuple(magic=AS_MAGIC,
                                  type=AS_FULL,
                                  index=main_slice.first_index,
-                                 key=full_key)), annex=True)
+                                 key=full_key)))]
         if append_password:
-            as_append.store(as_append_key, pol.serialization.son_to_string(
-                    access_tuple(magic=AS_MAGIC,
-                                 type=AS_APPEND,
-                                 index=append_slice.first_index,
-                                 key=append_key)), annex=True)
+            jobs.append((as_append, as_append_key,
+                    pol.serialization.son_to_string(
+                        access_tuple(magic=AS_MAGIC,
+                                     type=AS_APPEND,
+                                     index=append_slice.first_index,
+                                     key=append_key))))
         if list_password:
-            as_list.store(as_list_key, pol.serialization.son_to_string(
-                    access_tuple(magic=AS_MAGIC,
-                                 type=AS_LIST,
-                                 index=main_slice.first_index,
-                                 key=list_key)), annex=True)
+            jobs.append((as_list, as_list_key,
+                    pol.serialization.son_to_string(
+                        access_tuple(magic=AS_MAGIC,
+                                     type=AS_LIST,
+                                     index=main_slice.first_index,
+                                     key=list_key))))
         # Initialize main and append slices
         if append_slice:
             append_data = append_tuple(magic=APPEND_SLICE_MAGIC,
@@ -920,10 +1385,9 @@ class ElGamalSafe(Safe):
             self._opened_containers[append_slice.first_index] = ref
         assert main_slice.first_index not in self._opened_containers
         self._opened_containers[main_slice.first_index] = ref
-        # Save the container
-        l.debug('new_container: saving')
-        container.save(randfunc=randfunc, annex=True)
-        return container
+        # The container is saved with the access slices
+        jobs.extend(container._save_jobs(randfunc))
+        return container, jobs
 
     @property
     def nblocks(self):
@@ -935,6 +1399,17 @@ class ElGamalSafe(Safe):
         """ Number of bytes stored per block. """
         return self.data['bytes-per-block']
 
+    @property
+    def exponent_size(self):
+        """ The size in bytes of the random exponents used for encryption
+            and rerandomization.  None if they are as large as the group. """
+        return None
+
+    @property
+    def privkey_size(self):
+        """ The size in bytes of the private key of a block """
+        return self.bytes_per_block
+
     @property
     def block_index_size(self):
         """ Size of a block index. """
@@ -949,20 +1424,38 @@ class ElGamalSafe(Safe):
     @property
     def group_params(self):
         """ The group parameters. """
-        return pol.elgamal.group_parameters(
-                    *[pol.serialization.string_to_number(x)
-                        for x in self.data['group-params']])
+        return self._group_params
+
+    @property
+    def gexp(self):
+        """ The pol.elgamal.FixedBaseExp for the generator of the group.
+
+            It is computed on first use.  Access it before forking
+            workers, such that they share it. """
+        if self._gexp is None:
+            self._gexp = pol.elgamal.fixed_base_exp(self.group_params,
+                    None if self.exponent_size is None
+                            else self.exponent_size * 8)
+        return self._gexp
+
+    def _precompute(self):
+        """ Computes the tables used to encrypt and rerandomize.  Called
+            before workers are forked, such that they share them. """
+        self.gexp
 
     def mark_free(self, indices):
         """ Marks the given indices as free. """
         self.free_blocks.update(indices)
 
     def trash_freespace(self):
+        """ Fills every free block with a fresh random block.  See
+            `_random_block'.  The blocks are filled in parallel. """
         if not self.free_blocks:
             return
-        l.debug('trash_freespace: trashing')
-        sl = self._new_slice(len(self.free_blocks))
-        sl.trash()
+        trash = list(self.free_blocks)
+        l.debug('trash_freespace: trashing %s blocks', len(trash))
+        self.free_blocks = set()
+        self._store_slices([], trash=trash)
 
     def autosave_containers(self):
         for container_ref in self._opened_containers.itervalues():
@@ -970,29 +1463,231 @@ class ElGamalSafe(Safe):
             if container and container.autosave and container.unsaved_changes:
                 container.save()
 
-    def rerandomize(self, nworkers=None, use_threads=False, progress=None):
+    def rerandomize(self, nworkers=None, use_threads=False, progress=None,
+                        nice=None, max_duration=None, checkpoint=None,
+                        checkpoint_interval=None, stop=None, stream=None):
         """ Rerandomizes blocks: they will still decrypt to the same
-            plaintext. """
+            plaintext.
+
+            We start at the block after the last one rerandomized by a
+            previous call, see `rerandomize-offset'.  If `max_duration' is
+            set, we stop after that many seconds.  The workers run with
+            niceness `nice'.  If `checkpoint_interval' is set, we call
+            `checkpoint' every that many seconds.  It should store the
+            safe: every block is rerandomized on its own, thus the partial
+            result is valid.  We also stop as soon as `stop' returns True.
+
+            If the safe has been touched, we ignore `max_duration' and
+            `checkpoint_interval': the changed blocks would stand out
+            against the blocks we did not get to.
+
+            If `stream' is set, we store the safe to it afterwards.  If we
+            start at block 0 and neither `max_duration' nor
+            `checkpoint_interval' applies, we store each block as soon as
+            it is rerandomized, such that computation and I/O overlap. """
         _progress = None
         if progress is not None:
             def _progress(n):
                 progress(float(n) / self.nblocks)
         if not nworkers:
             nworkers = multiprocessing.cpu_count()
-        l.debug("Rerandomizing %s blocks on %s workers ...",
-                    self.nblocks, nworkers)
+        if self.touched:
+            max_duration = None
+            checkpoint_interval = None
+        offset = self.data.get('rerandomize-offset', 0)
+        l.debug("Rerandomizing %s blocks from %s on %s workers ...",
+                    self.nblocks, offset, nworkers)
         start_time = time.time()
-        gp = self.group_params
-        self.data['blocks'] = pol.parallel.parallel_map(_eg_rerandomize_block,
-                        self.data['blocks'], args=(gp.g, gp.p),
+        factors = self.stop_rerandomization_pool()
+        n_precomputed = 0
+        for index, f in factors.iteritems():
+            if f is not None and f[0] == self.data['blocks'].get(index, 2):
+                n_precomputed += 1
+        self._precompute()
+        order = self._rerandomize_order()
+        parent_pid = os.getpid()
+        def _initializer(args, kwargs):
+            # With a single chunk, `parallel_imap' calls us in this process.
+            _eg_rerandomize_block_initializer(args, kwargs,
+                        None if use_threads or os.getpid() == parent_pid
+                            else nice)
+        # The workers rerandomize a copy of the blocks in place, in shared
+        # memory: only the indices of the blocks go through the queues.
+        # The copy replaces the blocks right away.  The workers run ahead
+        # of us: if we stop early, we put back the blocks we did not get to.
+        old_blocks = self.data['blocks']
+        blocks = old_blocks.shared_copy()
+        self.data['blocks'] = blocks
+        results = pol.parallel.parallel_imap(
+                        self._rerandomize_stored_block, order,
+                        args=(blocks, factors),
                         nworkers=nworkers, use_threads=use_threads,
-                        initializer=_eg_rerandomize_block_initializer,
+                        initializer=_initializer,
                         chunk_size=16, progress=_progress)
-        secs = time.time() - start_time
-        kbps = self.nblocks * gmpy.numdigits(gp.p,2) / 1024.0 / 8.0 / secs
+        def _blocks():
+            # Yields the index of every block in `order': first the
+            # rerandomized ones, then those we did not get to.
+            n_done = 0
+            next_checkpoint = (time.time() + checkpoint_interval
+                                    if checkpoint_interval is not None
+                                    else float('inf'))
+            try:
+                for _ in results:
+                    index = order[n_done]
+                    n_done += 1
+                    yield index
+                    now = time.time()
+                    if (max_duration is not None
+                            and now - start_time >= max_duration
+                            and n_done < self.nblocks):
+                        l.debug(" out of time after %s blocks", n_done)
+                        break
+                    if (stop is not None and n_done < self.nblocks
+                            and stop()):
+                        l.debug(" asked to stop after %s blocks", n_done)
+                        break
+                    if checkpoint is not None and now >= next_checkpoint:
+                        self._set_rerandomize_offset((offset + n_done)
+                                                            % self.nblocks)
+                        checkpoint()
+                        next_checkpoint = time.time() + checkpoint_interval
+            finally:
+                results.close()
+                for index in order[n_done:]:
+                    blocks.copy_record(index, old_blocks)
+                self._set_rerandomize_offset((offset + n_done) % self.nblocks)
+                self.rerandomization_stats = {
+                            'blocks': n_done,
+                            'precomputed': n_precomputed,
+                            'seconds': time.time() - start_time}
+            for index in order[n_done:]:
+                yield index
+        if (stream is not None and offset == 0 and max_duration is None
+                and checkpoint_interval is None):
+            self._store_blocks_to_stream(stream, _blocks())
+        else:
+            for index in _blocks():
+                pass
+            if stream is not None:
+                self.store_to_stream(stream)
         if progress is not None:
             progress(1.0)
-        l.debug(" done in %.2fs; that is %.2f KB/s", secs, kbps)
+        stats = self.rerandomization_stats
+        l.info("Rerandomized %s blocks in %.2fs; %s were precomputed",
+                stats['blocks'], stats['seconds'], n_precomputed)
+
+    def _store_blocks_to_stream(self, stream, indices):
+        """ Stores the safe to `stream' in the format of version 2.
+            `indices' yields the index of every block in order, as soon as
+            it may be written.  The markers do not change while we
+            rerandomize: they are written first.  `rerandomize-offset'
+            comes after the blocks, for it might change while we wait
+            for them. """
+        start_time = time.time()
+        l.debug('Packing ...')
+        blocks = self.data['blocks']
+        header = dict((key, value) for key, value in self.data.iteritems()
+                        if key not in ('blocks', 'rerandomize-offset'))
+        header['block-widths'] = list(blocks.widths)
+        packed_header = msgpack.packb(header)
+        stream.write(SAFE_MAGIC_V2)
+        stream.write(_V2_INT_STRUCT.pack(len(packed_header)))
+        stream.write(packed_header)
+        stream.write(blocks.markers())
+        for index in indices:
+            stream.write(blocks.record(index))
+        stream.write(_V2_INT_STRUCT.pack(
+                        self.data.get('rerandomize-offset', 0)))
+        l.debug(' packed in %.2fs', time.time() - start_time)
+
+    def _rerandomize_order(self):
+        """ Returns the indices of the blocks in the order in which
+            `rerandomize' will process them. """
+        offset = self.data.get('rerandomize-offset', 0)
+        return range(offset, self.nblocks) + range(offset)
+
+    def _set_rerandomize_offset(self, offset):
+        if offset:
+            self.data['rerandomize-offset'] = offset
+        else:
+            self.data.pop('rerandomize-offset', None)
+
+    def start_rerandomization_pool(self):
+        """ Starts to compute the factors `rerandomize' needs for each
+            block in a background worker with low priority.  We call this
+            when the safe is loaded, such that most of the work is done
+            while we wait for the user to enter a password. """
+        if self._rerandomization_pool is not None:
+            return
+        # If `rerandomize' stops early, it will have used the factors
+        # of the first blocks in its order.
+        self._rerandomization_pool_order = self._rerandomize_order()
+        self._rerandomization_pool = pol.parallel.BackgroundMap(
+                        self._block_rerandomization_factors,
+                        self._rerandomization_pool_order,
+                        initializer=self._rerandomization_pool_initializer,
+                        use_threads=self.use_threads)
+        self._rerandomization_pool.start()
+
+    def stop_rerandomization_pool(self):
+        """ Stops the background worker started by
+            `start_rerandomization_pool'.  Returns a dictionary that maps
+            block indices to the factors that have been computed. """
+        if self._rerandomization_pool is None:
+            return {}
+        order = self._rerandomization_pool_order
+        ret = dict((order[i], factors) for i, factors
+                        in self._rerandomization_pool.stop().iteritems())
+        self._rerandomization_pool = None
+        return ret
+
+    def _rerandomization_pool_initializer(self, args, kwargs):
+        Crypto.Random.atfork()
+        self._precompute()
+
+    def _block_rerandomization_factors(self, index):
+        """ Returns the factors to rerandomize block `index'.  We read
+            its public key here, such that the pool starts right away. """
+        return self._rerandomization_factors(self.data['blocks'].get(index, 2))
+
+    def _rerandomization_factors(self, raw_pubkey):
+        """ Returns the factors to rerandomize a block with public key
+            `raw_pubkey'.  The first factor is `raw_pubkey' itself, such
+            that we can check whether the block changed in the meantime.
+            Returns None for blocks that have never been written. """
+        if not raw_pubkey:
+            return None
+        gp = self.group_params
+        if self.exponent_size is None:
+            s = random.randint(2, int(gp.p))
+        else:
+            s = random.getrandbits(self.exponent_size * 8)
+        pubkey = pol.serialization.string_to_number(raw_pubkey)
+        return (raw_pubkey, self.gexp(s), pow(pubkey, s, gp.p))
+
+    def _apply_rerandomization_factors(self, raw_b, factors):
+        p = self.group_params.p
+        raw_b[0] = pol.serialization.number_to_string(
+                    pol.serialization.string_to_number(raw_b[0])
+                        * factors[1] % p)
+        raw_b[1] = pol.serialization.number_to_string(
+                    pol.serialization.string_to_number(raw_b[1])
+                        * factors[2] % p)
+
+    def _rerandomize_stored_block(self, index, blocks, factors):
+        """ Rerandomizes block `index' of the `pol.blockstore.BlockStore'
+            `blocks' in place using the precomputed `factors', if they
+            still apply. """
+        raw_b = [blocks.get(index, 0), blocks.get(index, 1),
+                 blocks.get(index, 2)]
+        f = factors.get(index)
+        if f is None or f[0] != raw_b[2]:
+            f = self._rerandomization_factors(raw_b[2])
+        if f is None:
+            return
+        self._apply_rerandomization_factors(raw_b, f)
+        blocks.set(index, 0, raw_b[0])
+        blocks.set(index, 1, raw_b[1])
 
     def _new_slice(self, nblocks):
         """ Allocates a new slice with `nblocks' space. """
@@ -1007,26 +1702,104 @@ class ElGamalSafe(Safe):
         ret = ElGamalSafe.Slice(self, indices)
         return ret
 
+    def _store_slices(self, jobs, randfunc=None, annex=False, trash=()):
+        """ Stores values in several slices.  `jobs' is a list of triples
+            (slice, key, value).  The blocks of all slices are encrypted
+            in a single parallel job.  The blocks with an index in `trash'
+            are replaced by random blocks in the same job. """
+        if not jobs and not trash:
+            return
+        if randfunc is None:
+            randfunc = Crypto.Random.new().read
+        bpb = self.bytes_per_block
+        time_started = time.time()
+        work = []
+        for sl, key, value in jobs:
+            l.debug('_store_slices: storing @%s; %s blocks; %s/%sB',
+                    sl.first_index, len(sl.indices), len(value), sl.size)
+            ciphertext = sl._ciphertext(key, value, randfunc)
+            work.extend((ciphertext[bpb*indexindex:bpb*(indexindex+1)],
+                            index, key)
+                        for indexindex, index in enumerate(sl.indices))
+        work.extend((None, index, None) for index in trash)
+        # We compute the tables for the fixed-base exponentiation before
+        # the workers are forked.
+        self._precompute()
+        for index, raw_block in pol.parallel.parallel_map(
+                self._store_block, work, args=(annex,),
+                initializer=self._store_block_initializer,
+                nworkers=self.nworkers, use_threads=self.use_threads,
+                chunk_size=8):
+            if raw_block is None:
+                raise WrongKeyError
+            self._write_block(index, raw_block)
+        for sl, key, value in jobs:
+            sl._value = value
+        duration = time.time() - time_started
+        l.debug('_store_slices:  ... done in %.3f (%.1f block/s)',
+                    duration, len(work) / duration)
+        self.touch()
+
+    def _store_block(self, ct_index_key, annex, randfunc):
+        try:
+            ct, index, key = ct_index_key
+            if key is None:
+                return index, self._random_block(randfunc)
+            return index, self._eg_encrypt_block(key, index, ct, randfunc,
+                                                 annex=annex)
+        except WrongKeyError:
+            # TODO it would  be prettier if parallel_map passes the
+            #      exception
+            return index, None
+    def _store_block_initializer(self, args, kwargs):
+        Crypto.Random.atfork()
+        kwargs['randfunc'] = Crypto.Random.new().read
+
     def _find_slices(self, key):
-        """ Find slices that are opened by base key `key' """
-        symmkey_hash = self.kd([self._cipherstream_key(key)],
-                            length=self.cipher.blocksize)
-        # TODO parallelize this
-        for index in xrange(self.nblocks):
-            try:
-                pt = self._eg_decrypt_block(key, index)
-            except WrongKeyError:
-                continue
-            # We got a block.  Is it the first block?
-            if pt.startswith(symmkey_hash):
-                yield self._load_slice_from_first_block(key, index, pt)
+        """ Find slices that are opened by base key `key'
+
+            The blocks are scanned in parallel.  A slice is yielded as
+            soon as its first block has been found. """
+        symmkey_hash = self._key_context(key).symmkey_hash
+        nworkers = (self.nworkers if self.nworkers
+                        else multiprocessing.cpu_count())
+        # Checking a marker is cheap.  Thus we hand out the blocks in large
+        # contiguous chunks to keep the overhead of the workers low.
+        chunk_size = max(SCAN_CHUNK_SIZE,
+                         -(-self.nblocks // (nworkers * 4)))
+        found = False
+        try:
+            for index, pt in enumerate(pol.parallel.parallel_imap(
+                        self._scan_block, range(self.nblocks),
+                        args=(key, symmkey_hash),
+                        nworkers=nworkers,
+                        use_threads=self.use_threads,
+                        chunk_size=chunk_size)):
+                if pt is not None:
+                    found = True
+                    yield self._load_slice_from_first_block(key, index, pt)
+        finally:
+            # Do not keep the keys of, for instance, mistyped passwords.
+            if not found:
+                self._forget_key(key)
+
+    def _scan_block(self, index, key, symmkey_hash):
+        """ Returns the plaintext of block `index' if it is the first
+            block of a slice opened by `key'.  Otherwise returns None. """
+        try:
+            pt = self._eg_decrypt_block(key, index)
+        except WrongKeyError:
+            return None
+        # We got a block.  Is it the first block?
+        if not pt.startswith(symmkey_hash):
+            return None
+        return pt
 
     def _load_slice(self, key, index):
         """ Loads the slice with first block `index' encrypted
             with base key `key' """
         fb = self._eg_decrypt_block(key, index)
-        symmkey_hash = self.kd([self._cipherstream_key(key)],
-                            length=self.cipher.blocksize)
+        symmkey_hash = self._key_context(key).symmkey_hash
         if not fb.startswith(symmkey_hash):
             raise WrongKeyError
         return self._load_slice_from_first_block(key, index, fb)
@@ -1057,17 +1830,22 @@ class ElGamalSafe(Safe):
                             pt[offset:offset+self.block_index_size]))
             offset += self.block_index_size
             indices_to_read -= 1
-        # Read the remaining blocks
+        # Read the remaining blocks.  Every worker gets a single contiguous
+        # batch of blocks, which it decrypts with a single modular inversion
+        # and a single cipherstream.  A single batch is decrypted in-process.
+        nworkers = (self.nworkers if self.nworkers
+                        else multiprocessing.cpu_count())
+        todo = range(indexindex+1, len(indices))
+        batch_size = max(LOAD_BATCH_SIZE, -(-len(todo) // nworkers))
         pt += ''.join(pol.parallel.parallel_map(
-                self._load_block,
-                [(ii*self.bytes_per_block - self.cipher.blocksize*2,
-                                indices[ii])
-                        for ii in xrange(indexindex+1, len(indices))],
+                self._load_blocks,
+                [(todo[i]*self.bytes_per_block - self.cipher.blocksize*2,
+                        [indices[ii] for ii in todo[i:i+batch_size]])
+                        for i in xrange(0, len(todo), batch_size)],
                 args=(self._cipherstream_key(key), key, iv),
                 initializer=self._load_block_initializer,
-                nworkers=self.nworkers,
-                use_threads=self.use_threads,
-                chunk_size=8))
+                nworkers=nworkers,
+                use_threads=self.use_threads))
         # Read size
         size = self._slice_size_from_bytes(pt[offset:offset+self.slice_size])
         offset += self.slice_size
@@ -1089,49 +1867,84 @@ class ElGamalSafe(Safe):
 
     # TODO if we use a cipherstream in counter block mode, then we can
     #      slices on multiple cores.
+    def _key_context(self, key):
+        """ Returns the KeyContext for the base key `key' """
+        with self._key_contexts_lock:
+            ret = self._key_contexts.pop(key, None)
+            if ret is None:
+                ret = ElGamalSafe.KeyContext(self, key)
+                while len(self._key_contexts) >= KEY_CONTEXT_CACHE_SIZE:
+                    self._key_contexts.popitem(last=False)
+            self._key_contexts[key] = ret
+            return ret
+    def _forget_key(self, key):
+        """ Drops the cached KeyContext for `key', if there is one """
+        with self._key_contexts_lock:
+            self._key_contexts.pop(key, None)
     def _cipherstream_key(self, key):
-        return self.kd([key, KD_SYMM], length=self.cipher.keysize)
+        return self._key_context(key).cipherstream_key
     def _cipherstream(self, key, iv):
         """ Returns a blockcipher stream for key `key' """
         return self.cipher.new_stream(self._cipherstream_key(key), iv)
     def _marker_for_block(self, key, index):
         """ Returns the key used to mark a block at `index' as owned
             by `key' """
-        # TODO make this faster with a secure RNG?
-        return self.kd([key, KD_MARKER, self._index_to_bytes(index)])
+        return self._key_context(key).marker(index)
     def _privkey_for_block(self, key, index):
         """ Returns the elgamal private key for the block `index' """
-        # TODO is it safe to reduce the size of privkey by this much?
-        return pol.serialization.string_to_number(
-                    self.kd([key, KD_ELGAMAL, self._index_to_bytes(index)],
-                            length=self.bytes_per_block))
+        return self._key_context(key).privkey(index)
 
     # ElGamal encryption and decryption
     def _load_block_initializer(self, args, kwargs):
         Crypto.Random.atfork()
-    def _load_block(self, offset_index, cipherstream_key, key, iv):
-        offset, index = offset_index
+    def _load_blocks(self, offset_indices, cipherstream_key, key, iv):
+        offset, indices = offset_indices
         return self.cipher.new_stream(cipherstream_key, iv,
-                offset=offset).decrypt(self._eg_decrypt_block(key, index))
+                offset=offset).decrypt(''.join(
+                            self._eg_decrypt_blocks(key, indices)))
 
     def _eg_decrypt_block(self, key, index):
         """ Decrypts the block `index' with `key' """
-        marker = self._marker_for_block(key, index)
-        if self.data['blocks'][index][3] != marker:
-            raise WrongKeyError
-        privkey = self._privkey_for_block(key, index)
-        gp = self.group_params
-        c1 = pol.serialization.string_to_number(self.data['blocks'][index][0])
-        c2 = pol.serialization.string_to_number(self.data['blocks'][index][1])
-        return pol.elgamal.decrypt(c1, c2, privkey, gp, self.bytes_per_block)
+        return self._eg_decrypt_blocks(key, [index])[0]
+    def _eg_decrypt_blocks(self, key, indices):
+        """ Decrypts the blocks `indices' with `key' """
+        kc = self._key_context(key)
+        blocks = self.data['blocks']
+        pairs = []
+        for index in indices:
+            if blocks.get(index, 3) != kc.marker(index):
+                raise WrongKeyError
+            pairs.append(self._eg_ciphertext(index))
+        return self._eg_decrypt_many(pairs,
+                        [kc.privkey(index) for index in indices])
+    def _eg_ciphertext(self, index):
+        """ Returns c1 and c2 of block `index' as `_eg_decrypt_many'
+            takes them. """
+        return self.data['blocks'].numbers(index)
+    def _eg_decrypt_many(self, pairs, privkeys):
+        return pol.elgamal.decrypt_many(pairs, privkeys, self.group_params,
+                                        self.bytes_per_block)
+    def _eg_encrypt_raw(self, s, raw_pubkey, randfunc):
+        """ Encrypts `s' for the raw public key `raw_pubkey'.  Returns the
+            raw c1 and c2. """
+        c1, c2 = self._eg_encrypt(s,
+                    pol.serialization.string_to_number(raw_pubkey), randfunc)
+        return (pol.serialization.number_to_string(c1),
+                pol.serialization.number_to_string(c2))
+    def _eg_encrypt(self, s, pubkey, randfunc):
+        return pol.elgamal.encrypt(s, pubkey, self.group_params,
+                                   self.bytes_per_block, randfunc, self.gexp)
+    def _eg_pubkey(self, privkey):
+        """ Returns the raw public key for `privkey' """
+        return pol.serialization.number_to_string(
+                    pol.elgamal.pubkey_from_privkey(privkey,
+                                    self.group_params, self.gexp))
+    def _privkey_from_string(self, s):
+        """ Converts the output of the key derivation to a private key """
+        return pol.serialization.string_to_number(s)
     def _write_block(self, index, block):
         """ Apply changes returned by `_eg_encrypt_block'. """
-        self.data['blocks'][index][0] = block[0]
-        self.data['blocks'][index][1] = block[1]
-        if block[2] is not None:
-            self.data['blocks'][index][2] = block[2]
-        if block[3] is not None:
-            self.data['blocks'][index][3] = block[3]
+        self.data['blocks'].write(index, block)
     def _eg_encrypt_block(self, key, index, s, randfunc, annex=False):
         """ Returns the changed entries for block `index' such that it
             encrypts `s' using `key'.  Use `_write_block' to apply. """
@@ -1139,43 +1952,270 @@ class ElGamalSafe(Safe):
         # be called in a separate process.
         assert len(s) <= self.bytes_per_block
         ret = [None, None, None, None]
-        privkey = self._privkey_for_block(key, index)
-        gp = self.group_params
         marker = self._marker_for_block(key, index)
-        if self.data['blocks'][index][3] != marker:
+        if self.data['blocks'].get(index, 3) != marker:
             if not annex:
                 raise WrongKeyError
-            pubkey = pol.elgamal.pubkey_from_privkey(privkey, gp)
-            binary_pubkey = pol.serialization.number_to_string(pubkey)
-            ret[2] = binary_pubkey
+            ret[2] = self._eg_pubkey(self._privkey_for_block(key, index))
             ret[3] = marker
+            raw_pubkey = ret[2]
         else:
-            pubkey = pol.serialization.string_to_number(
-                        self.data['blocks'][index][2])
+            raw_pubkey = self.data['blocks'].get(index, 2)
         # TODO is it safe to pick r so much smaller than p?
-        c1, c2 = pol.elgamal.encrypt(s, pubkey, gp,
-                                     self.bytes_per_block, randfunc)
-        ret[0] = pol.serialization.number_to_string(c1)
-        ret[1] = pol.serialization.number_to_string(c2)
+        ret[0], ret[1] = self._eg_encrypt_raw(s, raw_pubkey, randfunc)
         return ret
+    def _random_block(self, randfunc):
+        """ Returns a block that cannot be told apart from a block in use:
+            random data encrypted for a random private key, with a random
+            marker.  It is independent of any other block. """
+        raw_pubkey = self._eg_pubkey(self._privkey_from_string(
+                                randfunc(self.privkey_size)))
+        c1, c2 = self._eg_encrypt_raw(randfunc(self.bytes_per_block),
+                                      raw_pubkey, randfunc)
+        return [c1, c2, raw_pubkey, randfunc(MARKER_SIZE)]
+    def prestretch(self, passwords, additional_keys=None, wait=True):
+        """ Stretches `passwords' concurrently, such that the next call
+            to `open_containers' or `new_containers' with one of them
+            need not stretch it again.  If `wait' is False, we stretch
+            in a background thread and return at once: the stretching
+            functions release the GIL, so the caller can go on. """
+        self._wait_for_prestretch()
+        composites = [composite for composite in set(
+                            self._composite_password(password,
+                                                     additional_keys)
+                                for password in passwords)
+                        if composite not in self._prestretched]
+        if not composites:
+            return
+        def _prestretch():
+            self._prestretched.update(zip(composites,
+                                      self.ks.stretch_many(composites,
+                                                nworkers=self.nworkers)))
+        if wait:
+            _prestretch()
+            return
+        self._prestretch_thread = threading.Thread(target=_prestretch)
+        self._prestretch_thread.daemon = True
+        self._prestretch_thread.start()
+    def _wait_for_prestretch(self):
+        """ Waits for the thread started by `prestretch', if any.  If it
+            failed, the passwords are simply stretched again on use. """
+        if self._prestretch_thread is not None:
+            self._prestretch_thread.join()
+            self._prestretch_thread = None
+    def _stretch(self, password, additional_keys):
+        """ Returns the stretched key for `password'.  A key stretched by
+            `prestretch' is used once and then forgotten. """
+        composite = self._composite_password(password, additional_keys)
+        self._wait_for_prestretch()
+        key = self._prestretched.pop(composite, None)
+        if key is None:
+            key = self.ks(composite)
+        return key
     def _composite_password(self, password, additional_keys):
         additional_keys = list(sorted(additional_keys
                                         if additional_keys else []))
         return (self.kd([password] + additional_keys)
                             if additional_keys else password)
 
-def _eg_rerandomize_block_initializer(args, kwargs):
+class ElGamalQSafe(ElGamalSafe):
+    """ A variant of ElGamalSafe that works in the subgroup of quadratic
+        residues, which has prime order q when p = 2q + 1 is a safe prime.
+
+        In a group of prime order, short private keys and random exponents
+        are fine.  We use exponents of `exponent-size' bytes, which makes
+        encryption and rerandomization a lot cheaper. """
+
+    def __init__(self, data, nworkers, use_threads):
+        super(ElGamalQSafe, self).__init__(data, nworkers, use_threads)
+        if not 'exponent-size' in data:
+            raise SafeFormatError("Missing attr `exponent-size'")
+        if not isinstance(data['exponent-size'], int):
+            raise SafeFormatError("`exponent-size' should be a `%s'" % int)
+        gp = self.group_params
+        q = (gp.p - 1) / 2
+        if gp.p % 4 != 3:
+            raise SafeFormatError("`group-params' should have p = 3 mod 4")
+        if gp.g <= 1 or pow(gp.g, q, gp.p) != 1:
+            raise SafeFormatError("`group-params' should have a generator "+
+                                  "of the quadratic residues")
+        if data['exponent-size'] < 16 or 2 ** (data['exponent-size']*8) >= q:
+            raise SafeFormatError("`exponent-size' invalid")
+        # We encode a plaintext n as n + 1 or -(n + 1).  See
+        # pol.elgamal.string_to_qr.
+        if 2 ** (data['bytes-per-block']*8) > q:
+            raise SafeFormatError("`bytes-per-block' larger than "+
+                                  "`group-params' allow")
+
+    @staticmethod
+    def _group_data(cipher, gp_bits, precomputed_gp, nworkers, use_threads,
+                        progress, gp_pool):
+        gp = _new_group_params(gp_bits, precomputed_gp, nworkers,
+                               use_threads, progress, gp_pool)
+        # We need n + 1 <= q for every plaintext n.  Thus we lose a bit
+        # with respect to ElGamalSafe.
+        bytes_per_block = (gp_bits - 2) / 8
+        bytes_per_block = bytes_per_block - bytes_per_block % cipher.alignment
+        return {'type': 'elgamal-q',
+                'bytes-per-block': bytes_per_block,
+                'exponent-size': EXPONENT_SIZE,
+                'group-params': [pol.serialization.number_to_string(x)
+                        for x in pol.elgamal.subgroup_params(gp)]}
+
+    @property
+    def exponent_size(self):
+        return self.data['exponent-size']
+
+    @property
+    def privkey_size(self):
+        return self.exponent_size
+
+    def _eg_decrypt_many(self, pairs, privkeys):
+        return pol.elgamal.decrypt_many_qr(pairs, privkeys,
+                        self.group_params, self.bytes_per_block)
+    def _eg_encrypt(self, s, pubkey, randfunc):
+        return pol.elgamal.encrypt_qr(s, pubkey, self.group_params,
+                        self.exponent_size, randfunc, self.gexp)
+
+class ECElGamalSafe(ElGamalSafe):
+    """ A variant of ElGamalSafe that uses El-Gamal on an elliptic curve.
+
+        A point holds fewer bytes than a block, so a block consists of
+        `points-per-block' points, each encrypted for a public key of its
+        own.  They share the random point c1.  At the same security level,
+        the points are a lot smaller than elements of a modular group.
+        See pol.ecelgamal. """
+
+    uses_group_params = False
+
+    def _setup_group(self, data):
+        for attr, _type in {'curve': basestring,
+                            'exponent-size': int,
+                            'points-per-block': int}.iteritems():
+            if not attr in data:
+                raise SafeFormatError("Missing attr `%s'" % attr)
+            if not isinstance(data[attr], _type):
+                raise SafeFormatError("`%s' should be a `%s'" % (attr, _type))
+        if not data['curve'] in pol.ecelgamal.CURVES:
+            raise SafeFormatError("Unsupported `curve'")
+        self._curve = pol.ecelgamal.CURVES[data['curve']]
+        if (data['exponent-size'] < 16
+                or 2 ** (data['exponent-size']*8) >= self._curve.order):
+            raise SafeFormatError("`exponent-size' invalid")
+        if data['points-per-block'] < 1:
+            raise SafeFormatError("`points-per-block' invalid")
+        if (data['bytes-per-block'] >
+                data['points-per-block'] * self._curve.data_size):
+            raise SafeFormatError("`bytes-per-block' larger than "+
+                                  "`curve' allows")
+
+    @staticmethod
+    def _group_data(cipher, gp_bits, precomputed_gp, nworkers, use_threads,
+                        progress, gp_pool):
+        # The curve is fixed: there are no group parameters to generate.
+        curve = pol.ecelgamal.CURVES[EC_CURVE]
+        bytes_per_block = EC_POINTS_PER_BLOCK * curve.data_size
+        bytes_per_block = bytes_per_block - bytes_per_block % cipher.alignment
+        return {'type': 'elgamal-ec',
+                'bytes-per-block': bytes_per_block,
+                'curve': EC_CURVE,
+                'exponent-size': EC_EXPONENT_SIZE,
+                'points-per-block': EC_POINTS_PER_BLOCK}
+
+    def _block_widths(self):
+        size = self.curve.point_size
+        return [size, size * self.points_per_block,
+                size * self.points_per_block, MARKER_SIZE]
+
+    @property
+    def curve(self):
+        """ The pol.ecelgamal.curve_parameters """
+        return self._curve
+
+    @property
+    def group_params(self):
+        raise AttributeError("An `elgamal-ec' safe has no group parameters")
+
+    @property
+    def exponent_size(self):
+        return self.data['exponent-size']
+
+    @property
+    def points_per_block(self):
+        return self.data['points-per-block']
+
+    @property
+    def privkey_size(self):
+        return self.exponent_size * self.points_per_block
+
+    def _precompute(self):
+        # pycryptodome has its own tables for the base point.
+        pass
+
+    def _random_exponent(self, s):
+        """ Converts `exponent_size' random bytes into an exponent. """
+        # Zero would give the point at infinity.
+        return max(pol.serialization.string_to_number(s), 1)
+    def _privkey_from_string(self, s):
+        es = self.exponent_size
+        return [self._random_exponent(s[i:i+es])
+                    for i in xrange(0, len(s), es)]
+    def _eg_pubkey(self, privkey):
+        return pol.ecelgamal.points_to_string(self.curve,
+                    [pol.ecelgamal.pubkey_from_privkey(self.curve, x)
+                        for x in privkey])
+    def _eg_encrypt_raw(self, s, raw_pubkey, randfunc):
+        c1, c2 = pol.ecelgamal.encrypt(self.curve, s,
+                    pol.ecelgamal.string_to_points(self.curve, raw_pubkey),
+                    self._random_exponent(randfunc(self.exponent_size)))
+        return (pol.ecelgamal.point_to_string(self.curve, c1),
+                pol.ecelgamal.points_to_string(self.curve, c2))
+    def _eg_ciphertext(self, index):
+        blocks = self.data['blocks']
+        return (pol.ecelgamal.string_to_point(self.curve,
+                                              blocks.get(index, 0)),
+                pol.ecelgamal.string_to_points(self.curve,
+                                               blocks.get(index, 1)))
+    def _eg_decrypt_many(self, pairs, privkeys):
+        return [pol.ecelgamal.decrypt(self.curve, c1, c2, privkey
+                                        )[:self.bytes_per_block]
+                    for (c1, c2), privkey in zip(pairs, privkeys)]
+
+    def _rerandomization_factors(self, raw_pubkey):
+        if not raw_pubkey:
+            return None
+        s = random.getrandbits(self.exponent_size * 8)
+        return (raw_pubkey,) + pol.ecelgamal.rerandomization_factors(
+                    self.curve,
+                    pol.ecelgamal.string_to_points(self.curve, raw_pubkey),
+                    max(s, 1))
+    def _apply_rerandomization_factors(self, raw_b, factors):
+        c1, c2 = pol.ecelgamal.rerandomize(self.curve,
+                    pol.ecelgamal.string_to_point(self.curve, raw_b[0]),
+                    pol.ecelgamal.string_to_points(self.curve, raw_b[1]),
+                    factors[1:])
+        raw_b[0] = pol.ecelgamal.point_to_string(self.curve, c1)
+        raw_b[1] = pol.ecelgamal.points_to_string(self.curve, c2)
+
+def _new_group_params(gp_bits, precomputed_gp, nworkers, use_threads,
+                        progress, gp_pool):
+    if precomputed_gp:
+        return pol.elgamal.precomputed_group_params(gp_bits)
+    if gp_pool is not None:
+        gp = pol.gppool.take(gp_bits, gp_pool)
+        if gp is not None:
+            return gp
+    return pol.elgamal.generate_group_params(bits=gp_bits, nworkers=nworkers,
+                        progress=progress, use_threads=use_threads)
+
+def _eg_rerandomize_block_initializer(args, kwargs, nice=None):
     Crypto.Random.atfork()
-def _eg_rerandomize_block(raw_b, g, p):
-    """ Rerandomizes raw_b given group parameters g and p. """
-    s = random.randint(2, int(p))
-    b = [pol.serialization.string_to_number(raw_b[0]),
-         pol.serialization.string_to_number(raw_b[1]),
-         pol.serialization.string_to_number(raw_b[2])]
-    b[0] = (b[0] * pow(g, s, p)) % p
-    b[1] = (b[1] * pow(b[2], s, p)) % p
-    raw_b[0] = pol.serialization.number_to_string(b[0])
-    raw_b[1] = pol.serialization.number_to_string(b[1])
-    return raw_b
-
-TYPE_MAP = {'elgamal': ElGamalSafe}
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError as e:
+            l.warning("Failed to change niceness: %s", e)
+
+TYPE_MAP = {'elgamal': ElGamalSafe,
+            'elgamal-q': ElGamalQSafe,
+            'elgamal-ec': ECElGamalSafe}
@@ -1,39 +1,89 @@
 """ Speed measurements of components of pol """
 
+import sys
 import timeit
 import functools
+import multiprocessing
 
 import pol.kd
 import pol.ks
+import pol.safe
 import pol.elgamal
+import pol.ecelgamal
+import pol.blockstore
+import pol.serialization
 import pol.envelope
 import pol.blockcipher
 
+import gmpy
 import Crypto.Random
+import Crypto.Util.number
+
+def _find_safe_prime_unsieved(bits, randfunc):
+    r = gmpy.mpz(Crypto.Util.number.getRandomNBitInteger(bits-1, randfunc))
+    q = gmpy.next_prime(r)
+    p = 2*q+1
+    if gmpy.is_prime(p):
+        return p
+
+def _search_safe_prime(find, bits, randfunc):
+    while find(bits, randfunc) is None:
+        pass
 
 def main(program):
     data = []
-    kd = pol.kd.KeyDerivation.setup()
-    data.append(('kd.derive (1000x)',
-            timeit.repeat(functools.partial(kd.derive, ['']),
-                                repeat=3, number=1000)))
+    for typ in sorted(pol.kd.TYPE_MAP):
+        kd = pol.kd.KeyDerivation.setup(typ=typ)
+        data.append(('kd.derive (%s, 1000x)' % typ,
+                timeit.repeat(functools.partial(kd.derive, ['']),
+                                    repeat=3, number=1000)))
+        # The markers and private keys of blocks, as in ElGamalSafe
+        marker_kd = kd.prefixed(['!'*32, 'marker'])
+        data.append(('kd.prefixed (%s, 1000x 32B)' % typ,
+                timeit.repeat(functools.partial(marker_kd, ['\0\1'], 32),
+                                    repeat=3, number=1000)))
+        data.append(('kd.prefixed (%s, 1000x 128B)' % typ,
+                timeit.repeat(functools.partial(marker_kd, ['\0\1'], 128),
+                                    repeat=3, number=1000)))
+    for typ in sorted(pol.kd.TYPE_MAP):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=1024,
+                        kd=pol.kd.KeyDerivation.setup(typ=typ), nworkers=1)
+        safe._new_slice(2).store('key', '!', annex=True)
+        def find_slices():
+            # Forget the derived keys, as a new pol process would.
+            safe._key_contexts.clear()
+            list(safe._find_slices('key'))
+        data.append(('_find_slices (%s, 1024 blocks, 1 worker)' % typ,
+                timeit.repeat(find_slices, repeat=3, number=1)))
 
     ks = pol.ks.KeyStretching.setup()
     data.append(('ks.stretch', timeit.repeat(functools.partial(ks.stretch, ''),
                                 repeat=3, number=1)))
+    data.append(('ks.stretch_many (4 passwords)',
+            timeit.repeat(functools.partial(ks.stretch_many,
+                                ['a', 'b', 'c', 'd']), repeat=3, number=1)))
+
+    for typ in sorted(pol.blockcipher.TYPE_MAP):
+        bs = pol.blockcipher.BlockCipher.setup(typ=typ)
+        iv = '!' * bs.blocksize
+        def bs_encrypt():
+            s = bs.new_stream('!'*32, iv)
+            s.encrypt(' '*20480)
+        data.append(('blockcipher encrypt (%s, 500x 20KB)' % typ,
+                timeit.repeat(bs_encrypt, repeat=3, number=500)))
 
-    bs = pol.blockcipher.BlockCipher.setup()
-    def bs_encrypt():
-        s = bs.new_stream('!'*32, '!'*16)
-        s.encrypt(' '*20480)
-    data.append(('blockcipher encrypt (500x 20KB)', timeit.repeat(bs_encrypt,
-                                repeat=3, number=500)))
+        def bs_decrypt():
+            s = bs.new_stream('!'*32, iv)
+            s.decrypt(' '*20480)
+        data.append(('blockcipher decrypt (%s, 500x 20KB)' % typ,
+                timeit.repeat(bs_decrypt, repeat=3, number=500)))
 
-    def bs_decrypt():
-        s = bs.new_stream('!'*32, '!'*16)
-        s.decrypt(' '*20480)
-    data.append(('blockcipher decrypt (500x 20KB)', timeit.repeat(bs_decrypt,
-                                repeat=3, number=500)))
+        # As when a single block of a slice is decrypted
+        def bs_decrypt_block():
+            s = bs.new_stream('!'*32, iv, offset=1024)
+            s.decrypt(' '*128)
+        data.append(('blockcipher new_stream (%s, 10000x 128B)' % typ,
+                timeit.repeat(bs_decrypt_block, repeat=3, number=10000)))
 
     randfunc = Crypto.Random.new().read
     data.append(('random (1000x 64B)',
@@ -44,6 +94,7 @@ def main(program):
             timeit.repeat(functools.partial(randfunc, 1024*1024),
                                 repeat=3, number=5)))
 
+    kd = pol.kd.KeyDerivation.setup()
     gp = pol.elgamal.precomputed_group_params()
     privkey = pol.elgamal.string_to_group(kd([], length=128))
     pubkey = pol.elgamal.pubkey_from_privkey(privkey, gp)
@@ -59,6 +110,43 @@ def main(program):
             timeit.repeat(functools.partial(pol.elgamal.decrypt,
                                 c1, c2, privkey, gp, 128),
                             repeat=3, number=100)))
+    data.append(('EG decrypt_many (100 blocks)',
+            timeit.repeat(functools.partial(pol.elgamal.decrypt_many,
+                                [(c1, c2)]*100, [privkey]*100, gp, 128),
+                            repeat=3, number=1)))
+
+    for bits in (1025, 2049, 4097):
+        bgp = pol.elgamal.precomputed_group_params(bits)
+        x = pol.elgamal.string_to_group(randfunc(bits // 8))
+        gexp = pol.elgamal.fixed_base_exp(bgp)
+        data.append(('EG pow(g, x, p) (%s bits, 100x)' % bits,
+                timeit.repeat(functools.partial(pow, bgp.g, x, bgp.p),
+                                repeat=3, number=100)))
+        data.append(('EG fixed-base g^x (%s bits, 100x)' % bits,
+                timeit.repeat(functools.partial(gexp, x),
+                                repeat=3, number=100)))
+
+    curve = pol.ecelgamal.CURVES['secp256r1']
+    x = pol.serialization.string_to_number(randfunc(31))
+    point = pol.ecelgamal.mul(curve, curve.g, x)
+    data.append(('EC mul (secp256r1, 100x)',
+            timeit.repeat(functools.partial(pol.ecelgamal.mul, curve,
+                                point, x), repeat=3, number=100)))
+    data.append(('EC add (secp256r1, 100x)',
+            timeit.repeat(functools.partial(pol.ecelgamal.add, curve,
+                                point, curve.g), repeat=3, number=100)))
+    # As for a block of an `elgamal-ec' safe, which holds 240 bytes
+    privkeys = [pol.serialization.string_to_number(randfunc(31))
+                    for i in xrange(8)]
+    pubkeys = [pol.ecelgamal.pubkey_from_privkey(curve, privkey)
+                    for privkey in privkeys]
+    c1, c2 = pol.ecelgamal.encrypt(curve, '!'*240, pubkeys, x)
+    data.append(('EC encrypt (240B, 10x)',
+            timeit.repeat(functools.partial(pol.ecelgamal.encrypt, curve,
+                                '!'*240, pubkeys, x), repeat=3, number=10)))
+    data.append(('EC decrypt (240B, 10x)',
+            timeit.repeat(functools.partial(pol.ecelgamal.decrypt, curve,
+                                c1, c2, privkeys), repeat=3, number=10)))
 
     data.append(('string_to_number (10000x)',
             timeit.repeat(functools.partial(pol.serialization.string_to_number,
@@ -69,28 +157,116 @@ def main(program):
             timeit.repeat(functools.partial(pol.serialization.number_to_string,
                             number), repeat=3, number=10000)))
 
-    data.append(('_find_safe_prime',
-            timeit.repeat(functools.partial(pol.elgamal._find_safe_prime,
-                            1025, randfunc), repeat=3, number=1)))
+    # Time to find a safe prime with the sieve and, as a reference,
+    # with a primality test after every call to next_prime.
+    for bits in (512, 1025):
+        data.append(('_find_safe_prime (%s bits)' % bits,
+                timeit.repeat(functools.partial(_search_safe_prime,
+                        pol.elgamal._find_safe_prime, bits, randfunc),
+                            repeat=3, number=1)))
+    data.append(('_find_safe_prime (512 bits, unsieved)',
+            timeit.repeat(functools.partial(_search_safe_prime,
+                    _find_safe_prime_unsieved, 512, randfunc),
+                        repeat=3, number=1)))
 
-    envelope = pol.envelope.Envelope.setup()
-    data.append(('envelope gen. keypair (50x)',
-            timeit.repeat(envelope.generate_keypair,
-                            repeat=3, number=50)))
-    pubkey, privkey = envelope.generate_keypair()
-    msg = envelope.seal('!', pubkey)
-    data.append(('envelope seal (50x)',
-            timeit.repeat(functools.partial(envelope.seal, '!'*128, pubkey), 
-                            repeat=3, number=50)))
-    data.append(('envelope open (50x)',
-            timeit.repeat(functools.partial(envelope.open, msg, privkey), 
-                            repeat=3, number=50)))
+    for typ in pol.envelope.AVAILABLE_TYPES:
+        envelope = pol.envelope.Envelope.setup(typ=typ)
+        data.append(('envelope gen. keypair (%s, 50x)' % typ,
+                timeit.repeat(envelope.generate_keypair,
+                                repeat=3, number=50)))
+        pubkey, privkey = envelope.generate_keypair()
+        msg = envelope.seal('!', pubkey)
+        data.append(('envelope seal (%s, 50x)' % typ,
+                timeit.repeat(functools.partial(envelope.seal, '!'*128,
+                                    pubkey), repeat=3, number=50)))
+        data.append(('envelope open (%s, 50x)' % typ,
+                timeit.repeat(functools.partial(envelope.open, msg, privkey),
+                                repeat=3, number=50)))
+        # As when listing a container with 50 entries, added one by one
+        msgs = [envelope.seal('!'*128, pubkey) for i in xrange(50)]
+        data.append(('envelope open_many (%s, 50 entries)' % typ,
+                timeit.repeat(functools.partial(envelope.open_many, msgs,
+                                    privkey), repeat=3, number=1)))
+        # As when saving a container with 50 new entries
+        data.append(('envelope seal_many (%s, 50 entries)' % typ,
+                timeit.repeat(functools.partial(envelope.seal_many,
+                                    ['!'*128]*50, pubkey), repeat=3, number=1)))
 
+    for n_blocks in (1024, 8192):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=n_blocks)
+        safe._new_slice(2).store('key', '!', annex=True)
+        for nworkers in sorted(set([1, 2, multiprocessing.cpu_count()])):
+            safe.nworkers = nworkers
+            # Forget the derived keys before every run, as a new pol
+            # process would.
+            data.append(('_find_slices (%s blocks, %s workers)' % (
+                                n_blocks, nworkers),
+                    timeit.repeat(lambda: list(safe._find_slices('key')),
+                                safe._key_contexts.clear,
+                                repeat=3, number=1)))
 
+    safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=1024)
+    for nworkers in sorted(set([1, multiprocessing.cpu_count()])):
+        safe.nworkers = nworkers
+        data.append(('trash_freespace (1024 blocks, %s workers)' % nworkers,
+                timeit.repeat(safe.trash_freespace,
+                              lambda: safe.mark_free(xrange(1024)),
+                              repeat=3, number=1)))
+
+    for typ in ('elgamal', 'elgamal-q'):
+        for bits in (1025, 2049):
+            safe = pol.safe.Safe.generate(typ, precomputed_gp=True,
+                                          gp_bits=bits, n_blocks=256)
+            safe.trash_freespace()
+            data.append(('rerandomize (%s, %s bits, 256 blocks)' % (typ, bits),
+                    timeit.repeat(functools.partial(safe.rerandomize,
+                                    nworkers=1), repeat=3, number=1)))
+    # A block of an `elgamal-ec' safe holds 240 bytes; one of the modular
+    # types 128 bytes with 1025 bits and 256 bytes with 2049 bits.
+    safe = pol.safe.Safe.generate('elgamal-ec', n_blocks=256)
+    safe.trash_freespace()
+    data.append(('rerandomize (elgamal-ec, secp256r1, 256 blocks)',
+            timeit.repeat(functools.partial(safe.rerandomize, nworkers=1),
+                            repeat=3, number=1)))
+    # Rerandomization computes factors for every block, which the
+    # background worker of `start_rerandomization_pool' precomputes while
+    # pol waits for the password, and applies them.
+    for typ in ('elgamal-q', 'elgamal-ec'):
+        safe = pol.safe.Safe.generate(typ, precomputed_gp=True, n_blocks=1)
+        safe.trash_freespace()
+        raw_b = safe.data['blocks'][0]
+        factors = safe._rerandomization_factors(raw_b[2])
+        data.append(('rerandomization factors (%s, 100x)' % typ,
+                timeit.repeat(functools.partial(
+                                    safe._rerandomization_factors, raw_b[2]),
+                                repeat=3, number=100)))
+        data.append(('apply rerand. factors (%s, 100x)' % typ,
+                timeit.repeat(functools.partial(
+                                    safe._apply_rerandomization_factors,
+                                    list(raw_b), factors),
+                                repeat=3, number=100)))
 
     for desc, res in data:
         print '%-40s %.4f %.4f %.4f' % (desc, res[0], res[1], res[2])
 
+    # Memory used per block by the blocks of a safe with 65536 blocks.
+    width = len(pol.serialization.number_to_string(gp.p))
+    blocks = [[randfunc(width), randfunc(width), randfunc(width),
+                    randfunc(pol.safe.MARKER_SIZE)] for i in xrange(65536)]
+    store = pol.blockstore.BlockStore.from_list(blocks,
+                    (width, width, width, pol.safe.MARKER_SIZE))
+    list_size = sys.getsizeof(blocks) + sum(sys.getsizeof(block)
+                    + sum(sys.getsizeof(x) for x in block)
+                        for block in blocks)
+    print '%-40s %.1f' % ('bytes/block (list)', float(list_size)
+                                                    / len(blocks))
+    print '%-40s %.1f' % ('bytes/block (BlockStore)',
+                                float(sys.getsizeof(store)) / len(blocks))
+    for index in xrange(len(store)):
+        store.numbers(index)
+    print '%-40s %.1f' % ('bytes/block (BlockStore, decoded)',
+                                float(sys.getsizeof(store)) / len(blocks))
+
 
 
 if __name__ == '__main__':
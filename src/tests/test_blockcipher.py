@@ -56,6 +56,42 @@ class TestAES(unittest.TestCase):
                                             'Sixteen byte IV!',
                                             offset=32)
         self.assertEqual(s.decrypt(c3), p3)
+class TestChaCha20(unittest.TestCase):
+    # Test vector of RFC 7539, section 2.4.2
+    key = binascii.unhexlify('000102030405060708090a0b0c0d0e0f'+
+                             '101112131415161718191a1b1c1d1e1f')
+    iv = binascii.unhexlify('000000000000004a00000000')
+    plaintext = ("Ladies and Gentlemen of the class of '99: If I could "+
+                 "offer you only one tip for the future, sunscreen would "+
+                 "be it.")
+    ciphertext = binascii.unhexlify(
+            '6e2e359a2568f98041ba0728dd0d6981e97e7aec1d4360c20a27afccfd9fae0b'+
+            'f91b65c5524733ab8f593dabcd62b3571639d624e65152ab8f530c359f0861d8'+
+            '07ca0dbf500d6a6156a38e088a22b65e52bc514d16ccf806818ce91ab7793736'+
+            '5af90bbf74a35be6b40b8eedf2785e42874d')
+    def setUp(self):
+        self.c = pol.blockcipher.BlockCipher.setup(typ='chacha20')
+    def test_params(self):
+        self.assertEqual(self.c.params, {'type': 'chacha20'})
+        self.assertEqual(self.c.blocksize, 12)
+        self.assertEqual(self.c.keysize, 32)
+        self.assertEqual(self.c.alignment, 1)
+    def test_encrypt(self):
+        # The RFC starts at block counter 1
+        s = self.c.new_stream(self.key, self.iv, offset=64)
+        self.assertEqual(s.encrypt(self.plaintext[:50]), self.ciphertext[:50])
+        self.assertEqual(s.encrypt(self.plaintext[50:]), self.ciphertext[50:])
+    def test_decrypt(self):
+        s = self.c.new_stream(self.key, self.iv, offset=64)
+        self.assertEqual(s.decrypt(self.ciphertext), self.plaintext)
+    def test_offset(self):
+        s = self.c.new_stream(self.key, self.iv, offset=64 + 37)
+        self.assertEqual(s.decrypt(self.ciphertext[37:]), self.plaintext[37:])
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.c.new_stream(self.key, 'Sixteen byte IV!')
+        with self.assertRaises(ValueError):
+            self.c.new_stream(self.key[:16], self.iv)
 
 if __name__ == '__main__':
     unittest.main()
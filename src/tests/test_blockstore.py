@@ -0,0 +1,48 @@
+import os
+import unittest
+
+import pol.blockstore
+import pol.serialization
+
+class TestBlockStore(unittest.TestCase):
+    def test_blockstore(self):
+        blocks = [['\x01\x02', '\x03', '\x05\x00\x06', 'marker'],
+                  ['', '', '', ''],
+                  ['\xff'*8, '\x00\x01', '\x07', '\x00'*4]]
+        store = pol.blockstore.BlockStore.from_list(blocks, (8, 8, 8, 6))
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store, blocks)
+        self.assertEqual(store[1:], blocks[1:])
+        self.assertEqual(store.get(0, 3), 'marker')
+        self.assertEqual(store.numbers(0)[0],
+                         pol.serialization.string_to_number('\x01\x02'))
+        store.write(0, ['\x09', None, None, 'other'])
+        self.assertEqual(store[0], ['\x09', '\x03', '\x05\x00\x06', 'other'])
+        self.assertEqual(store.numbers(0)[0], 9)
+        self.assertRaises(ValueError, store.set, 1, 3, 'too long')
+        self.assertRaises(IndexError, store.get, 3, 0)
+    def test_shared_copy(self):
+        blocks = [['\x01\x02', '\x03', '\x05', 'marker'],
+                  ['\x04', '', '\x06', 'other!']]
+        store = pol.blockstore.BlockStore.from_list(blocks, (4, 4, 4, 6))
+        # As a safe of version 2 in a file, with something before the blocks
+        buf = bytearray('header') + store._buf
+        store = pol.blockstore.BlockStore(2, (4, 4, 4, 6), buf, 6)
+        copy = store.shared_copy()
+        self.assertEqual(copy, blocks)
+        pid = os.fork()
+        if pid == 0:
+            copy.set(1, 0, '\x07')
+            copy.set(0, 1, '\x08')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(copy[1], ['\x07', '', '\x06', 'other!'])
+        self.assertEqual(copy.numbers(1)[0], 7)
+        self.assertEqual(store, blocks)
+        copy.copy_record(0, store)
+        self.assertEqual(copy[0], blocks[0])
+        self.assertRaises(ValueError, copy.copy_record, 0,
+                    pol.blockstore.BlockStore(2, (4, 4, 5, 6)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+import pol.ks
+import pol.calibrate
+
+class TestCalibrate(unittest.TestCase):
+    def test_calibrate(self):
+        c = pol.calibrate.calibrate(target_unlock=0.5, target_rerand=1,
+                                    use_threads=True, sample_blocks=32)
+        self.assertEqual(c.n_blocks % pol.calibrate.BLOCKS_STEP, 0)
+        self.assertGreaterEqual(c.n_blocks, pol.calibrate.MIN_BLOCKS)
+        self.assertLessEqual(c.n_blocks, pol.calibrate.MAX_BLOCKS)
+        self.assertGreaterEqual(c.m, pol.calibrate.MIN_ARGON2_MEMORY)
+        self.assertLessEqual(c.m, pol.calibrate.MAX_ARGON2_MEMORY)
+        self.assertGreaterEqual(c.t, 1)
+        self.assertAlmostEqual(c.unlock_time - c.stretch_time,
+                               max(0.5 - c.stretch_time, 0), delta=0.5)
+    def test_fixed_blocks(self):
+        c = pol.calibrate.calibrate(n_blocks=300, use_threads=True,
+                                    sample_blocks=32)
+        self.assertEqual(c.n_blocks, 300)
+
+class TestArgon2Setup(unittest.TestCase):
+    def test_setup(self):
+        ks = pol.ks.Argon2KeyStretching.setup(t=2, m=8192, p=1)
+        self.assertEqual((ks.params['t'], ks.params['m'], ks.params['p']),
+                         (2, 8192, 1))
+        self.assertEqual(ks.memory, 8192 * 1024)
+        self.assertEqual(pol.ks.KeyStretching.setup(ks.params).stretch('a'),
+                         ks.stretch('a'))
@@ -0,0 +1,77 @@
+import unittest
+
+import gmpy
+
+import pol.ecelgamal
+import pol.serialization
+
+import Crypto.Random
+import Crypto.Random.random as random
+
+class TestCurve(unittest.TestCase):
+    def setUp(self):
+        self.curve = pol.ecelgamal.CURVES['secp256r1']
+    def test_parameters(self):
+        self.assertEqual(self.curve.data_size, 30)
+        self.assertEqual(self.curve.point_size, 33)
+        x, y = self.curve.g
+        self.assertIn(pol.ecelgamal._y_for_x(self.curve, x),
+                      (y, self.curve.p - y))
+    def test_arithmetic(self):
+        c, g = self.curve, self.curve.g
+        self.assertEqual(pol.ecelgamal.add(c, g, g),
+                         pol.ecelgamal.mul(c, g, 2))
+        self.assertEqual(pol.ecelgamal.add(c, pol.ecelgamal.mul(c, g, 5), g),
+                         pol.ecelgamal.mul(c, g, 6))
+        self.assertEqual(pol.ecelgamal.mul(c, g, c.order + 1), g)
+        self.assertEqual(pol.ecelgamal.neg(c, g),
+                         pol.ecelgamal.mul(c, g, c.order - 1))
+        self.assertRaises(ValueError, pol.ecelgamal.add, c, g,
+                          pol.ecelgamal.neg(c, g))
+        self.assertRaises(ValueError, pol.ecelgamal.mul, c, g, c.order)
+    def test_serialization(self):
+        c = self.curve
+        points = [pol.ecelgamal.mul(c, c.g, random.getrandbits(248))
+                        for i in xrange(10)]
+        for P in points:
+            s = pol.ecelgamal.point_to_string(c, P)
+            self.assertEqual(len(s), c.point_size)
+            self.assertEqual(pol.ecelgamal.string_to_point(c, s), P)
+        self.assertEqual(pol.ecelgamal.string_to_points(c,
+                    pol.ecelgamal.points_to_string(c, points)), points)
+        self.assertRaises(ValueError, pol.ecelgamal.string_to_point, c,
+                          '\xff' * c.point_size)
+        self.assertRaises(ValueError, pol.ecelgamal.string_to_point, c,
+                          '\0' * (c.point_size - 1))
+        # About half of the x-coordinates are not on the curve.
+        self.assertRaises(ValueError, pol.ecelgamal.string_to_points, c,
+                          ''.join(pol.serialization.number_to_string(
+                                        gmpy.mpz(x)).ljust(c.point_size, '\0')
+                                    for x in xrange(1, 40)))
+    def test_encoding(self):
+        randfunc = Crypto.Random.new().read
+        for s in ['', '\0'*30, '\xff'*30, '\x01'] + [
+                    randfunc(30) for i in xrange(20)]:
+            P = pol.ecelgamal.string_to_curve(self.curve, s)
+            self.assertIsNotNone(pol.ecelgamal._y_for_x(self.curve, P[0]))
+            self.assertEqual(pol.ecelgamal.curve_to_string(self.curve, P),
+                             s.ljust(30, '\0'))
+    def test_encryption(self):
+        c = self.curve
+        randfunc = Crypto.Random.new().read
+        privkeys = [random.getrandbits(248) for i in xrange(4)]
+        pubkeys = [pol.ecelgamal.pubkey_from_privkey(c, x) for x in privkeys]
+        msg = randfunc(120)
+        c1, c2 = pol.ecelgamal.encrypt(c, msg, pubkeys,
+                                       random.getrandbits(248))
+        self.assertEqual(len(c2), 4)
+        self.assertEqual(pol.ecelgamal.decrypt(c, c1, c2, privkeys), msg)
+        factors = pol.ecelgamal.rerandomization_factors(c, pubkeys,
+                                        random.getrandbits(248))
+        c1b, c2b = pol.ecelgamal.rerandomize(c, c1, c2, factors)
+        self.assertNotEqual(c1b, c1)
+        self.assertNotEqual(c2b, c2)
+        self.assertEqual(pol.ecelgamal.decrypt(c, c1b, c2b, privkeys), msg)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,6 +4,8 @@ import functools
 import pol.elgamal
 
 import gmpy
+import Crypto.Random
+import Crypto.Random.random as random
 
 class TestGroupParametersBase(unittest.TestCase):
     def _test_gp(self, gp, bits):
@@ -36,6 +38,88 @@ for bits in (128, 256, 512):
         return lambda self: self._test_generated_group_parameters(bits)
     setattr(TestGeneratedGroupParameters, 'test_%s' % bits, ch(bits))
 
+class TestSafePrimeSieve(unittest.TestCase):
+    def test_sieve(self):
+        q0 = gmpy.mpz(2)**200 + 1
+        candidates = pol.elgamal._sieve_safe_prime_candidates(q0, 2048)
+        self.assertEqual(candidates, [i for i in xrange(2048)
+                    if all((q0 + 2*i) % s and (2*(q0 + 2*i) + 1) % s
+                        for s in pol.elgamal.SAFE_PRIME_SIEVE_PRIMES)])
+    def test_find_safe_prime(self):
+        randfunc = Crypto.Random.new().read
+        p = None
+        while p is None:
+            p = pol.elgamal._find_safe_prime(256, randfunc)
+        self.assertTrue(2**255 < p < 2**256)
+        self.assertTrue(gmpy.is_prime(p))
+        self.assertTrue(gmpy.is_prime((p - 1) / 2))
+
+class TestEncryption(unittest.TestCase):
+    def test_decrypt_many(self):
+        gp = pol.elgamal.precomputed_group_params(1025)
+        randfunc = Crypto.Random.new().read
+        privkeys = [pol.elgamal.string_to_group(randfunc(127))
+                        for i in xrange(5)]
+        msgs = [randfunc(127).ljust(128, '\0') for i in xrange(5)]
+        pairs = [pol.elgamal.encrypt(msg, pol.elgamal.pubkey_from_privkey(
+                                privkey, gp), gp, 127, randfunc)
+                    for msg, privkey in zip(msgs, privkeys)]
+        self.assertEqual(pol.elgamal.decrypt_many(pairs, privkeys, gp, 128),
+                         msgs)
+        self.assertEqual(pol.elgamal.decrypt_many(pairs[:1], privkeys[:1],
+                                                  gp, 128), msgs[:1])
+        self.assertEqual(pol.elgamal.decrypt_many([], [], gp, 128), [])
+
+class TestQuadraticResidues(unittest.TestCase):
+    def setUp(self):
+        self.gp = pol.elgamal.subgroup_params(
+                    pol.elgamal.precomputed_group_params(1025))
+        self.q = (self.gp.p - 1) / 2
+    def test_subgroup(self):
+        self.assertEqual(pow(self.gp.g, self.q, self.gp.p), 1)
+    def test_encoding(self):
+        randfunc = Crypto.Random.new().read
+        for s in ['', '\0'*127, '\xff'*127, '\x01'] + [
+                    randfunc(127) for i in xrange(20)]:
+            n = pol.elgamal.string_to_qr(s, self.gp)
+            self.assertEqual(pow(n, self.q, self.gp.p), 1)
+            self.assertEqual(pol.elgamal.qr_to_string(n, self.gp, 127),
+                             s.ljust(127, '\0'))
+    def test_encryption(self):
+        randfunc = Crypto.Random.new().read
+        privkey = pol.elgamal.string_to_group(randfunc(32))
+        pubkey = pol.elgamal.pubkey_from_privkey(privkey, self.gp)
+        msg = randfunc(127)
+        c1, c2 = pol.elgamal.encrypt_qr(msg, pubkey, self.gp, 32, randfunc)
+        self.assertEqual(pol.elgamal.decrypt_qr(c1, c2, privkey, self.gp, 127),
+                         msg)
+        self.assertEqual(pol.elgamal.decrypt_many_qr([(c1, c2)], [privkey],
+                                self.gp, 127), [msg])
+
+class TestFixedBaseExp(unittest.TestCase):
+    def setUp(self):
+        self.gp = pol.elgamal.precomputed_group_params(1025)
+    def test_window(self):
+        self.assertEqual(pol.elgamal.fixed_base_window(1025), 8)
+        self.assertEqual(pol.elgamal.fixed_base_window(2049), 6)
+        self.assertEqual(pol.elgamal.fixed_base_window(4097), 4)
+    def test_exponent_bits(self):
+        gexp = pol.elgamal.FixedBaseExp(self.gp, exponent_bits=256)
+        self.assertEqual(gexp.rows * gexp.window, 256)
+        for x in (0, 2**256 - 1, 2**256, gmpy.mpz(random.getrandbits(256))):
+            self.assertEqual(gexp(x), pow(self.gp.g, x, self.gp.p))
+    def test_pow(self):
+        for window in (1, 3, 8):
+            gexp = pol.elgamal.FixedBaseExp(self.gp, window)
+            for x in [0, 1, 2, 255, 256, self.gp.p - 1, self.gp.p,
+                        self.gp.p ** 2] + [
+                        gmpy.mpz(random.getrandbits(1025)) for i in xrange(10)]:
+                self.assertEqual(gexp(x), pow(self.gp.g, x, self.gp.p))
+    def test_memo(self):
+        gexp = pol.elgamal.fixed_base_exp(self.gp, 256)
+        self.assertIs(pol.elgamal.fixed_base_exp(self.gp, 256), gexp)
+        self.assertEqual(gexp.exponent_bits, 256)
+
 if __name__ == '__main__':
     unittest.main()
 
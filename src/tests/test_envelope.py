@@ -21,6 +21,72 @@ class TestSeccure(unittest.TestCase):
         msg = 'these are sekrits'
         pubk, privk = self.env.generate_keypair()
         self.assertEqual(self.env.open(self.env.seal(msg, pubk), privk), msg)
+    def test_many(self):
+        msgs = ['a', 'b', 'c']
+        pubk, privk = self.env.generate_keypair()
+        self.assertEqual(self.env.open_many(self.env.seal_many(msgs, pubk),
+                                            privk), msgs)
+
+class TestAvailability(unittest.TestCase):
+    def test_unavailable_x25519(self):
+        have_x25519 = pol.envelope.have_x25519
+        pol.envelope.have_x25519 = False
+        try:
+            with self.assertRaises(pol.envelope.EnvelopeParameterError):
+                pol.envelope.Envelope.setup(typ='x25519')
+        finally:
+            pol.envelope.have_x25519 = have_x25519
+    def test_available_types(self):
+        self.assertIn('seccure', pol.envelope.AVAILABLE_TYPES)
+        self.assertEqual('x25519' in pol.envelope.AVAILABLE_TYPES,
+                         pol.envelope.have_x25519)
+
+@unittest.skipIf(not pol.envelope.have_x25519,
+                 'requires PyCryptodome >= 3.21')
+class TestX25519(unittest.TestCase):
+    def setUp(self):
+        self.env = pol.envelope.Envelope.setup(typ='x25519')
+    def test_params(self):
+        self.assertEqual(self.env.params, {'type': 'x25519'})
+    def test_generate_keypair(self):
+        # Test vector of RFC 7748, section 6.1
+        privk = binascii.unhexlify('77076d0a7318a57d3c16c17251b26645'+
+                                   'df4c2f87ebc0992ab177fba51db92c2a')
+        pubk, privk2 = self.env.generate_keypair(lambda n: privk)
+        self.assertEqual(privk2, privk)
+        self.assertEqual(binascii.hexlify(pubk),
+                        '8520f0098930a754748b7ddcb43ef75a'+
+                        '0dbf3a0d26381af4eba4a98eaa9b4e6a')
+    def test_roundtrip(self):
+        msg = 'these are sekrits'
+        pubk, privk = self.env.generate_keypair()
+        ct = self.env.seal(msg, pubk)
+        self.assertEqual(len(ct), len(msg) + 32 + 12 + 16)
+        self.assertEqual(self.env.open(ct, privk), msg)
+        self.assertNotEqual(self.env.seal(msg, pubk), ct)
+    def test_many(self):
+        msgs = ['a', '', 'c'*1000]
+        pubk, privk = self.env.generate_keypair()
+        cts = self.env.seal_many(msgs, pubk)
+        cts2 = self.env.seal_many(msgs, pubk)
+        self.assertEqual(self.env.open_many(cts + cts2, privk), msgs + msgs)
+        # Messages sealed together share the ephemeral key
+        self.assertEqual(len(set(ct[:32] for ct in cts + cts2)), 2)
+        self.assertEqual(self.env.open_many([], privk), [])
+    def test_tampered(self):
+        pubk, privk = self.env.generate_keypair()
+        ct = self.env.seal('message', pubk)
+        for i in (0, 40, 50, len(ct) - 1):
+            tampered = ct[:i] + chr(ord(ct[i]) ^ 1) + ct[i+1:]
+            self.assertRaises(ValueError, self.env.open, tampered, privk)
+        self.assertRaises(ValueError, self.env.open, ct[:59], privk)
+        self.assertRaises(ValueError, self.env.open, ct,
+                                self.env.generate_keypair()[1])
+    def test_no_privkey_kept(self):
+        pubk, privk = self.env.generate_keypair()
+        self.assertEqual(self.env.open(self.env.seal('message', pubk), privk),
+                         'message')
+        self.assertNotIn(repr(privk)[1:-1], repr(vars(self.env)))
 
 if __name__ == '__main__':
     unittest.main()
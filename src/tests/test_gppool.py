@@ -0,0 +1,81 @@
+import os
+import shutil
+import os.path
+import unittest
+import tempfile
+
+import gmpy
+import msgpack
+
+import pol.safe
+import pol.gppool
+import pol.elgamal
+import pol.serialization
+
+class TestGroupParameterPool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'gp-pool')
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def test_take(self):
+        self.assertEqual(pol.gppool.count(1025, self.path), 0)
+        self.assertIsNone(pol.gppool.take(1025, self.path))
+        gp1 = pol.elgamal.precomputed_group_params(1025)
+        gp2 = pol.elgamal.precomputed_group_params(2049)
+        pol.gppool.add(gp1, self.path)
+        pol.gppool.add(gp2, self.path)
+        self.assertEqual(pol.gppool.count(1025, self.path), 1)
+        self.assertEqual(pol.gppool.count(2049, self.path), 1)
+        self.assertEqual(pol.gppool.take(1025, self.path), gp1)
+        self.assertIsNone(pol.gppool.take(1025, self.path))
+        self.assertEqual(pol.gppool.take(2049, self.path), gp2)
+        self.assertEqual(os.listdir(self.path), [])
+    def test_malformed(self):
+        gp = pol.elgamal.precomputed_group_params(1025)
+        pol.gppool.add(gp, self.path)
+        with open(os.path.join(self.path, '1025-0.gp'), 'w') as f:
+            f.write('garbage')
+        self.assertEqual(pol.gppool.take(1025, self.path), gp)
+        self.assertEqual(os.listdir(self.path), [])
+    def test_weak(self):
+        gp = pol.elgamal.precomputed_group_params(1025)
+        weak = [
+            # p is not a safe prime
+            pol.elgamal.group_parameters(p=gp.p + 2, g=gp.g),
+            # g only generates the quadratic residues
+            pol.elgamal.group_parameters(p=gp.p, g=pow(gp.g, 2, gp.p)),
+            # g generates a subgroup of order 2
+            pol.elgamal.group_parameters(p=gp.p, g=gp.p - 1),
+            pol.elgamal.group_parameters(p=gp.p, g=gmpy.mpz(1)),
+            # p has the wrong size
+            pol.elgamal.precomputed_group_params(2049)]
+        os.makedirs(self.path)
+        for weak_gp in weak:
+            self.assertRaises(ValueError, pol.elgamal.verify_group_params,
+                              weak_gp, 1025)
+            # Plant the entry under the name of a 1025 bit entry.
+            with open(os.path.join(self.path, '1025-0.gp'), 'w') as f:
+                f.write(msgpack.packb([pol.serialization.number_to_string(x)
+                                            for x in weak_gp]))
+            self.assertIsNone(pol.gppool.take(1025, self.path))
+            self.assertEqual(os.listdir(self.path), [])
+        pol.elgamal.verify_group_params(gp, 1025)
+    def test_fill(self):
+        self.assertEqual(pol.gppool.fill(256, 2, self.path), 2)
+        self.assertEqual(pol.gppool.fill(256, 2, self.path), 0)
+        self.assertEqual(pol.gppool.count(256, self.path), 2)
+    def test_generate(self):
+        gp = pol.elgamal.precomputed_group_params(1025)
+        pol.gppool.add(gp, self.path)
+        pol.gppool.add(gp, self.path)
+        safe = pol.safe.Safe.generate(n_blocks=10, gp_pool=self.path)
+        self.assertEqual(safe.group_params, gp)
+        safe = pol.safe.Safe.generate('elgamal-q', n_blocks=10,
+                                      gp_pool=self.path)
+        self.assertEqual(safe.group_params,
+                         pol.elgamal.subgroup_params(gp))
+        self.assertEqual(pol.gppool.count(1025, self.path), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -50,6 +50,55 @@ class TestSHA(unittest.TestCase):
                 '996059a8fe87e36dde9c60b1e3838d5a891d023f58b73667672d3b796224e'+
                 '6b7c617bb6b20a9c08b49f40f9b37f5f34be841e957e415638b6cc03cb4c5'+
                 '2906044e65e5')
+    def test_prefixed(self):
+        kd = pol.kd.KeyDerivation.setup({'bits': 256, 'type': 'sha','salt':'c'})
+        f = kd.prefixed(['a', 'b'])
+        self.assertEqual(f(['c'], 128), kd(['a', 'b', 'c'], 128))
+        self.assertEqual(f(['d'], 13), kd(['a', 'b', 'd'], 13))
+        self.assertEqual(f([]), kd(['a', 'b']))
+    def test_counter_digest(self):
+        kd = pol.kd.KeyDerivation.setup({'bits': 256, 'type': 'sha','salt':'c'})
+        kd2 = pol.kd.KeyDerivation.setup({'bits': 256, 'type': 'sha','salt':'c'})
+        # The digests do not depend on the order in which they are needed.
+        self.assertEqual(kd._counter_digest(3), kd2._counter_digest(3))
+        self.assertEqual(kd._counter_digest(0), kd2._counter_digest(0))
+        self.assertNotEqual(kd._counter_digest(0), kd._counter_digest(3))
+
+class TestBLAKE2(unittest.TestCase):
+    def setUp(self):
+        self.kd = pol.kd.KeyDerivation.setup(typ='blake2')
+    def test_restore(self):
+        self.assertEqual(self.kd.params['type'], 'blake2')
+        kd2 = pol.kd.KeyDerivation.setup(self.kd.params)
+        self.assertEqual(kd2(['abc'], 100), self.kd(['abc'], 100))
+    def test_single(self):
+        kd = pol.kd.KeyDerivation.setup({'type': 'blake2', 'salt': 'c'})
+        self.assertEqual(binascii.hexlify(kd(['ab'])),
+                        '06808b43f6cc2f471bbf806f5493a7f6'+
+                        '2b61354389bb0e22b30f6a632de2072d')
+    def test_short(self):
+        kd = pol.kd.KeyDerivation.setup({'type': 'blake2', 'salt': 'c'})
+        self.assertEqual(binascii.hexlify(kd(['a', 'b', ''], 13)),
+                        '77898c86b6c46ef7d8a221c69a')
+    def test_unambiguous(self):
+        self.assertNotEqual(self.kd(['ab', 'c']), self.kd(['a', 'bc']))
+        self.assertNotEqual(self.kd(['a']), self.kd(['a', '']))
+    def test_lengths(self):
+        keys = [self.kd(['a'], length) for length in (16, 64, 65, 128, 200)]
+        self.assertEqual(map(len, keys), [16, 64, 65, 128, 200])
+        # Keys of different lengths are unrelated
+        self.assertNotEqual(keys[1], keys[2][:64])
+        self.assertNotEqual(keys[2], keys[3][:65])
+        self.assertNotEqual(keys[3][64:], keys[4][64:128])
+    def test_prefixed(self):
+        f = self.kd.prefixed(['a', 'b'])
+        self.assertEqual(f(['c'], 128), self.kd(['a', 'b', 'c'], 128))
+        self.assertEqual(f(['d'], 13), self.kd(['a', 'b', 'd'], 13))
+        self.assertEqual(f(['c'], 128), self.kd(['a', 'b', 'c'], 128))
+        self.assertEqual(f([]), self.kd(['a', 'b']))
+    def test_long_salt(self):
+        with self.assertRaises(pol.kd.KeyDerivationParameterError):
+            pol.kd.KeyDerivation.setup({'type': 'blake2', 'salt': 'x'*65})
 
 
 if __name__ == '__main__':
@@ -10,6 +10,11 @@ class TestSCrypt(unittest.TestCase):
         self.ks2 = pol.ks.KeyStretching.setup(self.ks.params)
         self.assertEqual(self.ks2.params['salt'], self.ks.params['salt'])
         self.assertEqual(self.ks2('abc'), self.ks('abc'))
+    def test_stretch_many(self):
+        pws = ['a', 'b', 'a', 'c']
+        self.assertEqual(self.ks.stretch_many(pws),
+                         [self.ks(pw) for pw in pws])
+        self.assertEqual(self.ks.stretch_many([]), [])
     def test_value(self):
         ks = pol.ks.KeyStretching.setup({
                 'type': 'scrypt', 'Nexp': 15, 'salt': 'waasdasdaa'})
@@ -31,6 +36,14 @@ class TestArgon2(unittest.TestCase):
         self.ks2 = pol.ks.KeyStretching.setup(self.ks.params)
         self.assertEqual(self.ks2.params['salt'], self.ks.params['salt'])
         self.assertEqual(self.ks2('abc'), self.ks('abc'))
+    def test_stretch_many(self):
+        pws = ['a', 'b', 'a', 'c', 'd']
+        keys = [self.ks(pw) for pw in pws]
+        self.assertEqual(self.ks.stretch_many(pws), keys)
+        self.assertEqual(self.ks.memory, 102400 * 1024)
+        # The memory cap allows only a single stretch at a time.
+        self.assertEqual(self.ks.stretch_many(pws, nworkers=4,
+                                max_memory=self.ks.memory), keys)
     def test_value_v10(self):
         ks = pol.ks.KeyStretching.setup({
             'type': 'argon2', 't': 1, 'm':8, 'p':1, 'salt': 'waasdasdaa'})
@@ -1,8 +1,15 @@
 import os
+import sys
 import unittest
+import StringIO
 import tempfile
+import threading
+
+import lockfile
 
 import pol.main
+import pol.envelope
+import pol.safe
 
 class TestMain(unittest.TestCase):
     def setUp(self):
@@ -32,6 +39,131 @@ class TestMain(unittest.TestCase):
         self.assertEqual(self.pol('list', '-p', 'b'), 0)
         self.assertEqual(self.pol('touch'), 0)
         self.assertEqual(self.pol('export', '-p', 'a'), 0)
+        self.assertEqual(self.pol('--read-only', 'get', '-p', 'a', '-n', '1',
+                                  'key'), 0)
+        self.assertEqual(self.pol('--read-only', 'list', '-p', 'b'), 0)
+        self.assertEqual(self.pol('--read-only', 'raw', '-p', 'a', 'b', 'c'),
+                         0)
+    def test_elgamal_q(self):
+        self.pol('init', '-P', '-p', 'a', 'b', 'c', '-f', '-T', 'elgamal-q',
+                    '--i-know-its-unsafe', '-N', '128')
+        self.assertEqual(self.pol('put', '-p', 'a', '-s', 'a secret', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'b', 'key'), -4)
+    def test_elgamal_ec(self):
+        self.pol('init', '-p', 'a', 'b', 'c', '-f', '-T', 'elgamal-ec',
+                    '--i-know-its-unsafe', '-N', '64')
+        self.assertEqual(self.pol('put', '-p', 'a', '-s', 'a secret', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'b', 'key'), -4)
+        with open(self.safe.name) as f:
+            safe = pol.safe.Safe.load_from_stream(f, None, False)
+        self.assertEqual(safe.data['type'], 'elgamal-ec')
+    def test_blake2_kd(self):
+        self.pol('init', '-P', '-p', 'a', '-f', '--key-derivation', 'blake2',
+                    '--i-know-its-unsafe', '-N', '128')
+        self.assertEqual(self.pol('put', '-p', 'a', '-s', 'a secret', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        with open(self.safe.name) as f:
+            safe = pol.safe.Safe.load_from_stream(f, None, False)
+        self.assertEqual(safe.kd.params['type'], 'blake2')
+    def test_chacha20(self):
+        self.pol('init', '-P', '-p', 'a', '-f', '--block-cipher', 'chacha20',
+                    '--i-know-its-unsafe', '-N', '128')
+        self.assertEqual(self.pol('put', '-p', 'a', '-s', 'a secret', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        with open(self.safe.name) as f:
+            safe = pol.safe.Safe.load_from_stream(f, None, False)
+        self.assertEqual(safe.cipher.params['type'], 'chacha20')
+    def test_x25519_envelope(self):
+        if not pol.envelope.have_x25519:
+            self.skipTest('requires PyCryptodome >= 3.21')
+        self.pol('init', '-P', '-p', 'a', 'b', 'c', '-f', '--envelope',
+                    'x25519', '--i-know-its-unsafe', '-N', '128')
+        self.assertEqual(self.pol('put', '-p', 'c', '-s', 'a secret', 'key'), 0)
+        self.assertEqual(self.pol('put', '-p', 'c', '-s', 'a secret', 'key2'),
+                         0)
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        with open(self.safe.name) as f:
+            safe = pol.safe.Safe.load_from_stream(f, None, False)
+        self.assertEqual(safe.envelope.params['type'], 'x25519')
+    def test_rerandomize_options(self):
+        self.config.write('rerandomize:\n'+
+                          '    workers: 1\n'+
+                          '    nice: 1\n'+
+                          '    max-duration: 0\n')
+        self.config.flush()
+        self.pol('init', '-P', '-p', 'a', 'b', 'c', '-f',
+                    '--i-know-its-unsafe', '-N', '128')
+        self.assertEqual(self.pol('put', '-p', 'a', '-s', 'a secret', 'key'), 0)
+        self.assertEqual(self.pol('get', '-p', 'a', 'key'), 0)
+        with open(self.safe.name) as f:
+            safe = pol.safe.Safe.load_from_stream(f, None, False)
+        self.assertNotIn(safe.data.get('rerandomize-offset'), (None, 0))
+    def test_calibrate(self):
+        self.pol('init', '-P', '-p', 'a', '-f', '--i-know-its-unsafe',
+                    '-N', '128', '--target-unlock', '0.2s')
+        with open(self.safe.name) as f:
+            safe = pol.safe.Safe.load_from_stream(f, None, False)
+        self.assertEqual(safe.nblocks, 128)
+        self.assertEqual(safe.ks.params['type'], 'argon2')
+        self.assertEqual(self.pol('list', '-p', 'a'), 0)
+    def test_negative_nice(self):
+        self.config.write('rerandomize:\n'+
+                          '    nice: -5\n')
+        self.config.flush()
+        self.assertEqual(self.pol('list', '-p', 'a'), -18)
+    def test_lock_wait_notice(self):
+        self.config.write('lock-timeout: 0.2\n')
+        self.config.flush()
+        self.pol('init', '-P', '-p', 'a', '-f', '--i-know-its-unsafe',
+                    '-N', '128')
+        # Hold the lock from another thread, for which it is not reentrant.
+        locked = threading.Event()
+        done = threading.Event()
+        def holder():
+            lock = lockfile.FileLock(self.safe.name)
+            lock.acquire(0)
+            locked.set()
+            done.wait(10)
+            lock.release()
+        thread = threading.Thread(target=holder)
+        thread.start()
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            self.assertTrue(locked.wait(10))
+            self.assertEqual(self.pol('list', '-p', 'a'), -6)
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            done.set()
+            thread.join(10)
+        self.assertIn('Waiting for lock on %s' % self.safe.name, output)
+        self.assertEqual(self.pol('list', '-p', 'a'), 0)
+    def test_prompt_before_loading(self):
+        self.pol('init', '-P', '-p', 'a', '-f', '--i-know-its-unsafe',
+                    '-N', '128')
+        events = []
+        def fake_getpass(prompt):
+            events.append('prompt')
+            return 'a'
+        original_prestretch = pol.safe.ElGamalSafe.prestretch
+        def prestretch(safe, passwords, *args, **kwargs):
+            events.append(('prestretch', list(passwords)))
+            return original_prestretch(safe, passwords, *args, **kwargs)
+        original_getpass = pol.main.getpass.getpass
+        pol.main.getpass.getpass = fake_getpass
+        pol.safe.ElGamalSafe.prestretch = prestretch
+        try:
+            self.assertEqual(self.pol('put', '-s', 'a secret', 'key'), 0)
+            self.assertEqual(self.pol('get', 'key'), 0)
+            self.assertEqual(self.pol('--read-only', 'list'), 0)
+        finally:
+            pol.main.getpass.getpass = original_getpass
+            pol.safe.ElGamalSafe.prestretch = original_prestretch
+        # The password is stretched while the safe is loaded.
+        self.assertEqual(events, ['prompt', ('prestretch', ['a'])] * 3)
     def test_cracktime_names(self):
         self.assertEqual(frozenset(pol.main.cracktime_names),
                          frozenset(pol.main.cracktimes.keys()))
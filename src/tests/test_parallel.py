@@ -0,0 +1,48 @@
+import time
+import unittest
+import multiprocessing
+
+import pol.parallel
+
+def _square(x):
+    return x * x
+
+def _slow_square(x):
+    time.sleep(0.01)
+    return x * x
+
+def _fail(x):
+    if x == 7:
+        raise ValueError("seven")
+    return x
+
+class TestParallelMap(unittest.TestCase):
+    def test_parallel_map(self):
+        for use_threads in (False, True):
+            self.assertEqual(pol.parallel.parallel_map(_square, range(100),
+                                    nworkers=3, chunk_size=4,
+                                    use_threads=use_threads),
+                             [x * x for x in range(100)])
+    def test_close_early(self):
+        for use_threads in (False, True):
+            it = pol.parallel.parallel_imap(_slow_square, range(1000),
+                                    nworkers=4, chunk_size=2,
+                                    use_threads=use_threads)
+            self.assertEqual(it.next(), 0)
+            it.close()
+            self.assertEqual(multiprocessing.active_children(), [])
+    def test_worker_error(self):
+        for use_threads in (False, True):
+            with self.assertRaises(pol.parallel.WorkerError):
+                pol.parallel.parallel_map(_fail, range(100), nworkers=2,
+                                          chunk_size=4,
+                                          use_threads=use_threads)
+            self.assertEqual(multiprocessing.active_children(), [])
+    def test_worker_error_single_worker(self):
+        # Enough chunks to fill the pipe to the only worker.
+        with self.assertRaises(pol.parallel.WorkerError):
+            pol.parallel.parallel_map(_fail, range(20000), nworkers=1)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+if __name__ == '__main__':
+    unittest.main()
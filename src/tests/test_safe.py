@@ -1,8 +1,26 @@
+import os
+import sys
+import time
+import shutil
 import unittest
+import StringIO
+import tempfile
+import threading
+import multiprocessing
+
+import lockfile
+import msgpack
 
 import Crypto.Random
 
+import pol.kd
 import pol.safe
+import pol.envelope
+import pol.blockcipher
+import pol.elgamal
+import pol.ecelgamal
+import pol.blockstore
+import pol.serialization
 
 class TestElgamalSafe(unittest.TestCase):
     def test_generate(self):
@@ -24,6 +42,61 @@ class TestElgamalSafe(unittest.TestCase):
         safe._write_block(0, safe._eg_encrypt_block(
                         'key', 0, data, randfunc))
         self.assertEqual(safe._eg_decrypt_block('key', 0), data)
+    def test_key_context(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        kc = safe._key_context('key')
+        self.assertIs(safe._key_context('key'), kc)
+        self.assertEqual(kc.cipherstream_key, safe.kd(['key', pol.safe.KD_SYMM],
+                                            length=safe.cipher.keysize))
+        self.assertEqual(kc.marker(3), safe.kd(['key', pol.safe.KD_MARKER,
+                                            safe._index_to_bytes(3)]))
+        self.assertEqual(kc.privkey(3), pol.serialization.string_to_number(
+                    safe.kd(['key', pol.safe.KD_ELGAMAL,
+                                safe._index_to_bytes(3)],
+                            length=safe.bytes_per_block)))
+        safe._forget_key('key')
+        self.assertIsNot(safe._key_context('key'), kc)
+        # Keys that open nothing are forgotten.
+        self.assertEqual(list(safe._find_slices('wrong key')), [])
+        self.assertNotIn('wrong key', safe._key_contexts)
+        # We keep a limited amount of keys.
+        for i in xrange(2 * pol.safe.KEY_CONTEXT_CACHE_SIZE):
+            safe._key_context(str(i))
+        self.assertEqual(len(safe._key_contexts),
+                         pol.safe.KEY_CONTEXT_CACHE_SIZE)
+    def test_key_context_threads(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=40,
+                                      nworkers=4, use_threads=True)
+        sl = safe._new_slice(3)
+        sl.store('good', '!!!!', annex=True)
+        # Switch between threads as often as possible.
+        old_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for i in xrange(20):
+                safe._forget_key('good')
+                self.assertEqual([s.first_index for s in
+                                    safe._find_slices('good')],
+                                 [sl.first_index])
+            safe._forget_key('good')
+            kcs = []
+            errors = []
+            def lookup():
+                try:
+                    for i in xrange(500):
+                        kcs.append(safe._key_context('same'))
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=lookup) for i in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(old_interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(map(id, kcs))), 1)
+        self.assertEqual(safe._key_contexts.items(), [('same', kcs[0])])
     def test_slice_store(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
         sl = safe._new_slice(10)
@@ -57,6 +130,252 @@ class TestElgamalSafe(unittest.TestCase):
         data = randfunc(sl.size)
         sl.store('key', data)
         self.assertEqual(safe._load_slice('key', sl.first_index).value, data)
+    def test_rerandomize(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        sl = safe._new_slice(5)
+        sl.store('key', '!!!!', annex=True)
+        blocks = [list(b) for b in safe.data['blocks']]
+        safe.rerandomize()
+        self.assertNotEqual(safe.data['blocks'][sl.first_index][0],
+                            blocks[sl.first_index][0])
+        self.assertEqual(safe._load_slice('key', sl.first_index).value,
+                            '!!!!')
+    def test_rerandomize_in_workers(self):
+        # More than one chunk: the worker processes rerandomize the
+        # blocks in shared memory.
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=40)
+        sl = safe._new_slice(20)
+        sl.store('key', '!!!!', annex=True)
+        safe.trash_freespace()
+        blocks = [list(b) for b in safe.data['blocks']]
+        safe.rerandomize(nworkers=2)
+        for index in xrange(40):
+            self.assertNotEqual(safe.data['blocks'][index][0],
+                                blocks[index][0])
+            self.assertEqual(safe.data['blocks'][index][2:],
+                                blocks[index][2:])
+        self.assertEqual(safe._load_slice('key', sl.first_index).value,
+                            '!!!!')
+    def _test_rerandomization_pool(self, use_threads):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10,
+                                      use_threads=use_threads)
+        sl = safe._new_slice(5)
+        sl.store('key', '!!!!', annex=True)
+        safe.start_rerandomization_pool()
+        # Wait for the pool to finish.
+        safe._rerandomization_pool._worker.join()
+        # Blocks that change after the factors were computed, are
+        # rerandomized as usual.
+        sl2 = safe._new_slice(2)
+        sl2.store('key2', '????', annex=True)
+        safe.rerandomize(use_threads=use_threads)
+        self.assertEqual(safe.rerandomization_stats['blocks'], 10)
+        self.assertEqual(safe.rerandomization_stats['precomputed'], 5)
+        self.assertEqual(safe._load_slice('key', sl.first_index).value,
+                            '!!!!')
+        self.assertEqual(safe._load_slice('key2', sl2.first_index).value,
+                            '????')
+        self.assertEqual(safe.stop_rerandomization_pool(), {})
+    def _reload(self, safe):
+        stream = StringIO.StringIO()
+        safe.store_to_stream(stream)
+        stream.seek(0)
+        return pol.safe.Safe.load_from_stream(stream, None, False)
+    def test_blocks_format_validation(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=2)
+        safe._new_slice(2).store('key', '!!!!', annex=True)
+        safe2 = self._reload(safe)
+        self.assertIsInstance(safe2.data['blocks'],
+                              pol.blockstore.BlockStore)
+        self.assertEqual(safe2.data['blocks'], safe.data['blocks'])
+        p = safe.group_params.p
+        for block in (['', ''],
+                      ['', '', '', 3],
+                      [pol.serialization.number_to_string(p * 256),
+                            '', '', '']):
+            data = dict(safe.data)
+            data['blocks'] = [block, ['', '', '', '']]
+            self.assertRaises(pol.safe.SafeFormatError, pol.safe.ElGamalSafe,
+                                    data, None, False)
+    def test_load_version_1(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        sl = safe._new_slice(5)
+        sl.store('key', '!!!!', annex=True)
+        data = dict(safe.data)
+        data['blocks'] = data['blocks'].to_list()
+        data['rerandomize-offset'] = 3
+        stream = StringIO.StringIO()
+        stream.write(pol.safe.SAFE_MAGIC)
+        stream.write(msgpack.packb(data))
+        stream.seek(0)
+        safe2 = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertEqual(safe2.data['blocks'], safe.data['blocks'])
+        self.assertEqual(safe2.data['rerandomize-offset'], 3)
+        # It is stored as version 2.
+        safe3 = self._reload(safe2)
+        self.assertEqual(safe3.data['blocks'], safe.data['blocks'])
+        self.assertEqual(safe3.data['rerandomize-offset'], 3)
+        self.assertEqual(safe3._load_slice('key', sl.first_index).value,
+                            '!!!!')
+    def test_load_mapped(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        sl = safe._new_slice(5)
+        sl.store('key', '!!!!', annex=True)
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'safe')
+            with open(path, 'w') as f:
+                safe.store_to_stream(f)
+            with open(path) as f:
+                safe2 = pol.safe.Safe.load_from_stream(f, None, False)
+            self.assertEqual(safe2.data['blocks'], safe.data['blocks'])
+            # Changes to a mapped safe do not end up in its file.
+            pol.safe.ElGamalSafe.Slice(safe2, sl.indices).store('key', '????')
+            with open(path) as f:
+                safe3 = pol.safe.Safe.load_from_stream(f, None, False)
+            self.assertEqual(safe3.data['blocks'], safe.data['blocks'])
+            pol.safe._store_safe(safe2, path)
+            with open(path) as f:
+                safe3 = pol.safe.Safe.load_from_stream(f, None, False)
+            self.assertEqual(safe3._load_slice('key', sl.first_index).value,
+                                '????')
+            # A truncated safe is rejected.
+            with open(path, 'r+') as f:
+                f.truncate(os.path.getsize(path) - 1)
+            with open(path) as f:
+                self.assertRaises(pol.safe.SafeFormatError,
+                        pol.safe.Safe.load_from_stream, f, None, False)
+        finally:
+            shutil.rmtree(d)
+    def test_rerandomize_partially(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=40)
+        sl = safe._new_slice(40)
+        sl.store('key', '!!!!', annex=True)
+        # A touched safe is always rerandomized completely.
+        safe.rerandomize(max_duration=0)
+        self.assertEqual(safe.rerandomization_stats['blocks'], 40)
+        safe = self._reload(safe)
+        blocks = [list(b) for b in safe.data['blocks']]
+        safe.rerandomize(max_duration=0)
+        self.assertEqual(safe.data['rerandomize-offset'], 1)
+        self.assertEqual(safe.rerandomization_stats['blocks'], 1)
+        self.assertNotEqual(safe.data['blocks'][0][0], blocks[0][0])
+        self.assertEqual(safe.data['blocks'][1:], blocks[1:])
+        # We continue where we stopped.
+        safe.rerandomize(max_duration=0)
+        self.assertEqual(safe.data['rerandomize-offset'], 2)
+        self.assertNotEqual(safe.data['blocks'][1][0], blocks[1][0])
+        self.assertEqual(safe.data['blocks'][2:], blocks[2:])
+        checkpoints = []
+        def checkpoint():
+            checkpoints.append(safe.data.get('rerandomize-offset', 0))
+        safe.rerandomize(checkpoint=checkpoint, checkpoint_interval=0)
+        self.assertEqual(checkpoints, range(3, 40) + [0, 1, 2])
+        self.assertEqual(safe.data['rerandomize-offset'], 2)
+        self.assertEqual(safe.rerandomization_stats['blocks'], 40)
+        self.assertEqual(safe._load_slice('key', sl.first_index).value,
+                            '!!!!')
+        # Without `checkpoint_interval', there are no checkpoints.
+        del checkpoints[:]
+        safe.rerandomize(checkpoint=checkpoint)
+        self.assertEqual(checkpoints, [])
+    def test_rerandomize_to_stream(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=40)
+        sl = safe._new_slice(40)
+        sl.store('key', '!!!!', annex=True)
+        stream = StringIO.StringIO()
+        safe.rerandomize(stream=stream)
+        stream.seek(0)
+        safe2 = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertEqual(safe2.data['blocks'], safe.data['blocks'])
+        self.assertEqual(safe2.data.get('rerandomize-offset', 0), 0)
+        self.assertEqual(safe2._load_slice('key', sl.first_index).value,
+                            '!!!!')
+        # If we are stopped, the other blocks are stored as they are.
+        blocks = [list(b) for b in safe2.data['blocks']]
+        stream = StringIO.StringIO()
+        safe2.rerandomize(stream=stream, stop=lambda: True)
+        stream.seek(0)
+        safe3 = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertEqual(safe3.data['rerandomize-offset'], 1)
+        self.assertNotEqual(safe3.data['blocks'][0], blocks[0])
+        self.assertEqual(safe3.data['blocks'][1:], blocks[1:])
+        # Starting at block 1, we store afterwards.
+        stream = StringIO.StringIO()
+        safe3.rerandomize(stream=stream)
+        self.assertEqual(safe3.rerandomization_stats['blocks'], 40)
+        stream.seek(0)
+        safe4 = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertEqual(safe4.data['rerandomize-offset'], 1)
+        self.assertEqual(safe4._load_slice('key', sl.first_index).value,
+                            '!!!!')
+    def test_trash_freespace(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=40)
+        safe.nworkers = 2
+        sl = safe._new_slice(10)
+        sl.store('key', '!!!!', annex=True)
+        blocks = [list(b) for b in safe.data['blocks']]
+        safe.trash_freespace()
+        self.assertFalse(safe.free_blocks)
+        for index in xrange(40):
+            block = safe.data['blocks'][index]
+            if index in sl.indices:
+                self.assertEqual(block, blocks[index])
+            else:
+                self.assertEqual(len(block[3]), pol.safe.MARKER_SIZE)
+                self.assertTrue(all(block[:3]))
+        self.assertEqual(len(set(b[2] for b in safe.data['blocks'])), 40)
+        self.assertEqual(len(set(b[3] for b in safe.data['blocks'])), 40)
+        safe.rerandomize(nworkers=2)
+        self.assertEqual(safe._load_slice('key', sl.first_index).value,
+                            '!!!!')
+    def test_rerandomization_pool_order(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        safe.trash_freespace()
+        safe = self._reload(safe)
+        safe.use_threads = True
+        safe.data['rerandomize-offset'] = 7
+        pubkeys = []
+        rerandomization_factors = safe._rerandomization_factors
+        def _rerandomization_factors(raw_pubkey):
+            pubkeys.append(raw_pubkey)
+            return rerandomization_factors(raw_pubkey)
+        safe._rerandomization_factors = _rerandomization_factors
+        safe.start_rerandomization_pool()
+        safe._rerandomization_pool._worker.join()
+        factors = safe.stop_rerandomization_pool()
+        self.assertEqual(sorted(factors), range(10))
+        for index, f in factors.iteritems():
+            self.assertEqual(f[0], safe.data['blocks'][index][2])
+        # The pool starts where `rerandomize' will start.
+        self.assertEqual(pubkeys, [safe.data['blocks'][index][2]
+                                    for index in range(7, 10) + range(7)])
+    def test_rerandomization_pool(self):
+        self._test_rerandomization_pool(False)
+        self._test_rerandomization_pool(True)
+    def test_load_slice_batches(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70,
+                                      nworkers=4, use_threads=True)
+        small = safe._new_slice(pol.safe.LOAD_BATCH_SIZE + 1)
+        large = safe._new_slice(60)
+        randfunc = Crypto.Random.new().read
+        small.store('key', randfunc(small.size), annex=True)
+        large.store('key', randfunc(large.size), annex=True)
+        batches = []
+        load_blocks = safe._load_blocks
+        def _load_blocks(offset_indices, *args):
+            batches.append(len(offset_indices[1]))
+            return load_blocks(offset_indices, *args)
+        safe._load_blocks = _load_blocks
+        # The first block is decrypted on its own, the others in batches.
+        self.assertEqual(safe._load_slice('key', small.first_index).value,
+                         small.value)
+        self.assertEqual(batches, [pol.safe.LOAD_BATCH_SIZE])
+        del batches[:]
+        self.assertEqual(safe._load_slice('key', large.first_index).value,
+                         large.value)
+        # (The indices of the large slice take more than its first block.)
+        self.assertEqual(batches, [15, 15, 15, 13])
     def test_large_slice(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         sl = safe._new_slice(70)
@@ -86,6 +405,36 @@ class TestElgamalSafe(unittest.TestCase):
         c_a = cs_a[0]
         self.assertTrue(c_a.can_add)
         del(cs_a, c_a); self._assert_no_open_containers(safe)
+    def test_new_containers(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=100)
+        cs = safe.new_containers([('m1', 'l1', 'a1'), ('m2', None, None)],
+                                 nblocks=30, trash_freespace=True)
+        self.assertEqual(len(cs), 2)
+        self.assertFalse(safe.free_blocks)
+        self.assertTrue(all(block[3] for block in safe.data['blocks']))
+        del(cs); self._assert_no_open_containers(safe)
+        for pw in ('m1', 'l1', 'a1', 'm2'):
+            cs = list(safe.open_containers(pw))
+            self.assertEqual(len(cs), 1)
+            self.assertTrue(cs[0].can_add)
+            del(cs); self._assert_no_open_containers(safe)
+        self.assertEqual(list(safe.open_containers('l2')), [])
+    def test_prestretch(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
+        safe.new_container('m', 'l', 'a', nblocks=70)
+        stretched = []
+        ks = safe.ks
+        class KS(object):
+            def __call__(self, pw):
+                stretched.append(pw)
+                return ks(pw)
+            def stretch_many(self, pws, nworkers=None):
+                return ks.stretch_many(pws, nworkers)
+        safe.ks = KS()
+        safe.prestretch(['m', 'l'])
+        for pw in ('m', 'l', 'm'):
+            self.assertEqual(len(list(safe.open_containers(pw))), 1)
+        self.assertEqual(stretched, ['m'])
     def test_additional_keys(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container('m', 'l', 'a', nblocks=30,
@@ -143,6 +492,40 @@ class TestElgamalSafe(unittest.TestCase):
         c = list(safe.open_containers('l'))[0]
         self._check_container(c)
         del(c); self._assert_no_open_containers(safe)
+    def test_blake2_kd(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70,
+                        kd=pol.kd.KeyDerivation.setup(typ='blake2'))
+        safe.new_container('m', 'l', None, nblocks=70)
+        c = list(safe.open_containers('m'))[0]
+        self._fill_container(c)
+        c.save()
+        del(c); self._assert_no_open_containers(safe)
+        stream = StringIO.StringIO()
+        safe.store_to_stream(stream)
+        stream.seek(0)
+        safe = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertEqual(safe.kd.params['type'], 'blake2')
+        c = list(safe.open_containers('m'))[0]
+        self._check_container(c)
+        self._check_container_secrets(c)
+        del(c); self._assert_no_open_containers(safe)
+    def test_chacha20(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70,
+                blockcipher=pol.blockcipher.BlockCipher.setup(typ='chacha20'))
+        # A stream cipher needs no alignment: every byte of a block is used
+        self.assertEqual(safe.bytes_per_block, 128)
+        safe.new_container('m', 'l', 'a', nblocks=70)
+        c = list(safe.open_containers('m'))[0]
+        self._fill_container(c)
+        c.save()
+        del(c); self._assert_no_open_containers(safe)
+        c = list(safe.open_containers('m'))[0]
+        self._check_container(c)
+        self._check_container_secrets(c)
+        del(c); self._assert_no_open_containers(safe)
+        c = list(safe.open_containers('a'))[0]
+        self.assertTrue(c.can_add)
+        del(c); self._assert_no_open_containers(safe)
     def test_append_data(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container('m', 'l', 'a', nblocks=70)
@@ -172,6 +555,31 @@ class TestElgamalSafe(unittest.TestCase):
 
         c = list(safe.open_containers('l', move_append_entries=False))[0]
         self._check_container(c)
+    @unittest.skipIf(not pol.envelope.have_x25519,
+                     'requires PyCryptodome >= 3.21')
+    def test_x25519_envelope(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70,
+                envelope=pol.envelope.Envelope.setup(typ='x25519'))
+        safe.new_container('m', 'l', 'a', nblocks=70)
+        c = list(safe.open_containers('a'))[0]
+        self._fill_container(c)
+        c.save()
+        del(c); self._assert_no_open_containers(safe)
+
+        c = list(safe.open_containers('m', move_append_entries=False))[0]
+        self.assertEqual(sorted(e.key for e in c.list()),
+                         ['key1', 'key2', 'key3', 'key4', 'key4'])
+        self._check_container(c)
+        self._check_container_secrets(c)
+        self.assertEqual(c.get_by_id(('a', 1)).secret, 'secret2')
+        list(c.get('key1'))[0].secret = 'secret1!'
+        c.save()
+        del(c); self._assert_no_open_containers(safe)
+
+        c = list(safe.open_containers('m'))[0]
+        self.assertFalse(c.append_data.entries)
+        self.assertEqual(list(c.get('key1'))[0].secret, 'secret1!')
+        del(c); self._assert_no_open_containers(safe)
     def test_removal(self):
         safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=70)
         safe.new_container('m', 'l', 'a', nblocks=70)
@@ -264,6 +672,305 @@ class TestElgamalSafe(unittest.TestCase):
         self.assertEqual(list(c.get('key4'))[0].note, 'note4')
         self.assertEqual(list(c.get('key4'))[1].note, 'note4')
 
+class TestLocking(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'safe')
+        with pol.safe.create(self.path, n_blocks=10, precomputed_gp=True):
+            pass
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def _hold_lock(self, until_preempted):
+        """ Locks the safe from another process until `done' is set or,
+            if `until_preempted', until preemption is requested.  Returns
+            the process and `done'.  (Within a process, a lockfile.FileLock
+            is reentrant.) """
+        locked = multiprocessing.Event()
+        done = multiprocessing.Event()
+        def holder():
+            lock = lockfile.FileLock(self.path)
+            lock.acquire(0)
+            locked.set()
+            deadline = time.time() + 10
+            while not done.is_set() and time.time() < deadline:
+                if (until_preempted
+                        and pol.safe._preemption_requested(self.path)):
+                    break
+                time.sleep(0.01)
+            lock.release()
+        process = multiprocessing.Process(target=holder)
+        process.start()
+        self.assertTrue(locked.wait(10))
+        return process, done
+    def test_locked(self):
+        process, done = self._hold_lock(False)
+        try:
+            waits = []
+            with self.assertRaises(pol.safe.SafeLocked):
+                with pol.safe.open(self.path,
+                                   on_lock_wait=lambda: waits.append(1)):
+                    pass
+            self.assertEqual(waits, [])
+            with self.assertRaises(pol.safe.SafeLocked):
+                with pol.safe.open(self.path, lock_timeout=0.2,
+                                   on_lock_wait=lambda: waits.append(1)):
+                    pass
+            self.assertEqual(waits, [1])
+        finally:
+            done.set()
+            process.join(10)
+        self.assertFalse(pol.safe._preemption_requested(self.path))
+    def test_readonly(self):
+        process, done = self._hold_lock(False)
+        try:
+            # Readers do not wait for the lock, nor for each other.
+            with pol.safe.open(self.path, readonly=True) as safe:
+                with pol.safe.open(self.path, readonly=True) as safe2:
+                    self.assertEqual(safe2.data['blocks'],
+                                     safe.data['blocks'])
+            # But they wait for a safe that is being replaced, and then
+            # load the new one.  (A forked process would inherit our lock:
+            # we use a thread.)
+            loaded = threading.Event()
+            nblocks = []
+            def reader():
+                with pol.safe.open(self.path, readonly=True) as safe:
+                    nblocks.append(safe.nblocks)
+                    loaded.set()
+            with pol.safe._commit_lock(self.path, exclusive=True):
+                reader_thread = threading.Thread(target=reader)
+                reader_thread.start()
+                self.assertFalse(loaded.wait(0.2))
+                new_path = os.path.join(self.tmpdir, 'new')
+                with open(new_path, 'w') as f:
+                    pol.safe.Safe.generate(n_blocks=20,
+                            precomputed_gp=True).store_to_stream(f)
+                os.rename(new_path, self.path)
+            reader_thread.join(10)
+            self.assertEqual(nblocks, [20])
+        finally:
+            done.set()
+            process.join(10)
+        self.assertFalse(pol.safe._preemption_requested(self.path))
+        # We leave nothing next to the safe.
+        self.assertEqual(os.listdir(self.tmpdir), ['safe'])
+    def test_preemption(self):
+        # Pretend to be a pol that rerandomizes until asked to stop.
+        process, done = self._hold_lock(True)
+        try:
+            with pol.safe.open(self.path, lock_timeout=5,
+                               always_rerandomize=False):
+                pass
+        finally:
+            done.set()
+            process.join(10)
+        self.assertFalse(pol.safe._preemption_requested(self.path))
+    def test_stale_preemption_request(self):
+        pol.safe._request_preemption(self.path)
+        self.assertTrue(pol.safe._preemption_requested(self.path))
+        old = time.time() - pol.safe.PREEMPTION_REQUEST_TIMEOUT - 1
+        os.utime(pol.safe._preemption_request_path(self.path), (old, old))
+        self.assertFalse(pol.safe._preemption_requested(self.path))
+    def test_no_preemption_when_touched(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        self.assertIsNotNone(pol.safe._preemption_check(safe, self.path))
+        safe.touch()
+        self.assertIsNone(pol.safe._preemption_check(safe, self.path))
+    def test_rerandomize_stop(self):
+        safe = pol.safe.Safe.generate(precomputed_gp=True, n_blocks=10)
+        safe.rerandomize(stop=lambda: True)
+        self.assertEqual(safe.rerandomization_stats['blocks'], 1)
+        self.assertEqual(safe.data['rerandomize-offset'], 1)
+
+class TestOpen(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'safe')
+        with pol.safe.create(self.path, n_blocks=20,
+                             precomputed_gp=True) as safe:
+            safe.trash_freespace()
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+    def test_prestretch(self):
+        with pol.safe.create(self.path, override=True, n_blocks=70,
+                             precomputed_gp=True) as safe:
+            safe.new_container('m', nblocks=70)
+        for readonly in (False, True):
+            with pol.safe.open(self.path, readonly=readonly,
+                               prestretch=['m', 'x']) as safe:
+                self.assertEqual(len(list(safe.open_containers('m'))), 1)
+                self.assertEqual(safe._prestretched.keys(), ['x'])
+    def test_rerandomization_pool(self):
+        for use_threads in (False, True):
+            with pol.safe.open(self.path, use_threads=use_threads) as safe:
+                # Pretend the user took a while to enter the password.
+                safe._rerandomization_pool._worker.join()
+            self.assertEqual(safe.rerandomization_stats['blocks'], 20)
+            self.assertEqual(safe.rerandomization_stats['precomputed'], 20)
+            self.assertEqual(multiprocessing.active_children(), [])
+            with pol.safe.open(self.path, readonly=True) as safe:
+                self.assertIsNone(safe._rerandomization_pool)
+    def test_store_safe(self):
+        with open(self.path) as f:
+            original = f.read()
+        with pol.safe.open(self.path, readonly=True) as safe:
+            pass
+        def store_to_stream(stream):
+            stream.write('garbage')
+            raise IOError
+        safe.store_to_stream = store_to_stream
+        with self.assertRaises(IOError):
+            pol.safe._store_safe(safe, self.path)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['safe'])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), original)
+
+    def test_create_override(self):
+        with open(self.path) as f:
+            original = f.read()
+        with self.assertRaises(ValueError):
+            with pol.safe.create(self.path, override=True, n_blocks=10,
+                                 precomputed_gp=True):
+                raise ValueError
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['safe'])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), original)
+        with pol.safe.create(self.path, override=True, n_blocks=20,
+                             precomputed_gp=True):
+            pass
+        with pol.safe.open(self.path, readonly=True) as safe:
+            self.assertEqual(safe.nblocks, 20)
+
+class TestElgamalQSafe(unittest.TestCase):
+    def _generate(self, **kwargs):
+        return pol.safe.Safe.generate('elgamal-q', precomputed_gp=True,
+                                      **kwargs)
+    def test_generate(self):
+        safe = self._generate(n_blocks=10)
+        self.assertIsInstance(safe, pol.safe.ElGamalQSafe)
+        self.assertEqual(safe.bytes_per_block, 112)
+        self.assertEqual(safe.exponent_size, 32)
+        gp = safe.group_params
+        self.assertEqual(pow(gp.g, (gp.p - 1) / 2, gp.p), 1)
+    def test_load_slice(self):
+        safe = self._generate(n_blocks=10)
+        sl = safe._new_slice(5)
+        randfunc = Crypto.Random.new().read
+        data = randfunc(sl.size)
+        sl.store('key', data, annex=True)
+        self.assertEqual(safe._load_slice('key', sl.first_index).value, data)
+        safe.trash_freespace()
+        gp = safe.group_params
+        q = (gp.p - 1) / 2
+        for block in safe.data['blocks']:
+            self.assertEqual(pow(pol.serialization.string_to_number(
+                                    block[2]), q, gp.p), 1)
+        safe.rerandomize()
+        self.assertEqual(safe._load_slice('key', sl.first_index).value, data)
+        self.assertEqual(len(list(safe._find_slices('key'))), 1)
+    def test_store_and_load(self):
+        safe = self._generate(n_blocks=70)
+        safe.new_container('m', 'l', 'a', nblocks=70)
+        c = list(safe.open_containers('m'))[0]
+        c.add('key1', 'note1', 'secret1')
+        c.save()
+        del c
+        stream = StringIO.StringIO()
+        safe.store_to_stream(stream)
+        stream.seek(0)
+        safe2 = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertIsInstance(safe2, pol.safe.ElGamalQSafe)
+        c = list(safe2.open_containers('m'))[0]
+        self.assertEqual(list(c.get('key1'))[0].secret, 'secret1')
+    def test_format_validation(self):
+        safe = self._generate(n_blocks=1)
+        gp = pol.elgamal.precomputed_group_params(1025)
+        for attr, value in (('exponent-size', 8),
+                            ('exponent-size', 128),
+                            ('exponent-size', '32'),
+                            ('bytes-per-block', 128),
+                            ('group-params', [
+                                pol.serialization.number_to_string(x)
+                                    for x in gp])):
+            data = dict(safe.data)
+            data[attr] = value
+            self.assertRaises(pol.safe.SafeFormatError, pol.safe.ElGamalQSafe,
+                                    data, None, False)
+        data = dict(safe.data)
+        del data['exponent-size']
+        self.assertRaises(pol.safe.SafeFormatError, pol.safe.ElGamalQSafe,
+                                data, None, False)
+
+class TestECElgamalSafe(unittest.TestCase):
+    def _generate(self, **kwargs):
+        return pol.safe.Safe.generate('elgamal-ec', **kwargs)
+    def test_generate(self):
+        safe = self._generate(n_blocks=10)
+        self.assertIsInstance(safe, pol.safe.ECElGamalSafe)
+        self.assertEqual(safe.bytes_per_block, 240)
+        self.assertEqual(safe.curve.name, 'secp256r1')
+        self.assertEqual(safe.privkey_size, 8 * 31)
+        self.assertEqual(safe.data['blocks'].widths, (33, 264, 264, 32))
+        self.assertFalse(pol.safe.ECElGamalSafe.uses_group_params)
+    def test_elgamal(self):
+        safe = self._generate(n_blocks=10)
+        randfunc = Crypto.Random.new().read
+        data = randfunc(safe.bytes_per_block)
+        safe._write_block(0, safe._eg_encrypt_block('key', 0, data,
+                                randfunc, annex=True))
+        self.assertEqual(len(safe.data['blocks'][0][1]),
+                         8 * safe.curve.point_size)
+        self.assertEqual(safe._eg_decrypt_block('key', 0), data)
+        safe.rerandomize()
+        self.assertEqual(safe._eg_decrypt_block('key', 0), data)
+    def test_load_slice(self):
+        safe = self._generate(n_blocks=10)
+        sl = safe._new_slice(5)
+        randfunc = Crypto.Random.new().read
+        data = randfunc(sl.size)
+        sl.store('key', data, annex=True)
+        self.assertEqual(safe._load_slice('key', sl.first_index).value, data)
+        safe.trash_freespace()
+        for block in safe.data['blocks']:
+            self.assertEqual(len(pol.ecelgamal.string_to_points(safe.curve,
+                                    block[2])), 8)
+        # The factors go through a queue to the workers.
+        safe.start_rerandomization_pool()
+        safe.rerandomize(nworkers=2)
+        self.assertEqual(safe._load_slice('key', sl.first_index).value, data)
+        self.assertEqual(len(list(safe._find_slices('key'))), 1)
+    def test_store_and_load(self):
+        safe = self._generate(n_blocks=20)
+        safe.new_container('m', 'l', 'a', nblocks=20)
+        c = list(safe.open_containers('m'))[0]
+        c.add('key1', 'note1', 'secret1')
+        c.save()
+        del c
+        stream = StringIO.StringIO()
+        safe.store_to_stream(stream)
+        stream.seek(0)
+        safe2 = pol.safe.Safe.load_from_stream(stream, None, False)
+        self.assertIsInstance(safe2, pol.safe.ECElGamalSafe)
+        c = list(safe2.open_containers('m'))[0]
+        self.assertEqual(list(c.get('key1'))[0].secret, 'secret1')
+    def test_format_validation(self):
+        safe = self._generate(n_blocks=1)
+        for attr, value in (('exponent-size', 8),
+                            ('exponent-size', 32),
+                            ('exponent-size', '31'),
+                            ('points-per-block', 0),
+                            ('bytes-per-block', 256),
+                            ('curve', 'secp256k1'),
+                            ('curve', 256)):
+            data = dict(safe.data)
+            data[attr] = value
+            self.assertRaises(pol.safe.SafeFormatError,
+                              pol.safe.ECElGamalSafe, data, None, False)
+        for attr in ('curve', 'exponent-size', 'points-per-block'):
+            data = dict(safe.data)
+            del data[attr]
+            self.assertRaises(pol.safe.SafeFormatError,
+                              pol.safe.ECElGamalSafe, data, None, False)
 
 if __name__ == '__main__':
     unittest.main()